@@ -0,0 +1,65 @@
+"""
+Latency and throughput benchmark of QueryProcessor: one nlp() call per question
+(process_query) vs. batched nlp.pipe (process_queries).
+
+Run from backend/src: python benchmark_query_processor.py --num_queries 2000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from service.query_processor import QueryProcessor
+
+TEMPLATES = [
+    "Can you suggest {adj} {topic} dishes without {a}?",
+    "What are some {topic} recipes with {a} and {b}?",
+    "Recommend {topic} or {topic2} recipes.",
+    "What about {topic} food?",
+    "What {adj} dishes can I make without {a} or {b}?",
+]
+TOPICS = ["italian", "turkish", "chicken", "pasta", "georgian", "beef-ribs", "vegan", "mexican"]
+ADJS = ["spicy", "high-fiber", "quick", "low-carb", "healthy"]
+INGREDIENTS = ["onions", "garlic", "tomatoes", "oregano", "red onions", "cilantro", "mushrooms", "basil"]
+
+
+def make_questions(n, seed=1234):
+    rng = random.Random(seed)
+    return [
+        rng.choice(TEMPLATES).format(
+            adj=rng.choice(ADJS), topic=rng.choice(TOPICS), topic2=rng.choice(TOPICS),
+            a=rng.choice(INGREDIENTS), b=rng.choice(INGREDIENTS),
+        )
+        for _ in range(n)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_queries", default=1000, type=int, help="number of synthetic questions")
+    parser.add_argument("--batch_sizes", default="1,16,64,256", type=str, help="nlp.pipe batch sizes to try")
+    args = parser.parse_args()
+
+    processor = QueryProcessor()
+    questions = make_questions(args.num_queries)
+    prohibited = [["cilantro"]] * len(questions)
+    processor.process_query(questions[0], prohibited[0])  # Warm-up
+
+    latencies = []
+    start = time.perf_counter()
+    for question, user_prohibited in zip(questions, prohibited):
+        t = time.perf_counter()
+        processor.process_query(question, user_prohibited)
+        latencies.append(time.perf_counter() - t)
+    runtime = time.perf_counter() - start
+    expected = [processor.process_query(q, p) for q, p in zip(questions, prohibited)]
+    print(f"process_query: {len(questions) / runtime:.1f} queries/s, "
+          f"p50 {np.percentile(latencies, 50) * 1000:.2f}ms, p99 {np.percentile(latencies, 99) * 1000:.2f}ms")
+
+    for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+        start = time.perf_counter()
+        results = processor.process_queries(questions, prohibited, batch_size=batch_size)
+        runtime = time.perf_counter() - start
+        assert results == expected, "Batched results differ from process_query"
+        print(f"process_queries (batch_size={batch_size}): {len(questions) / runtime:.1f} queries/s")
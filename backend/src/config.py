@@ -70,6 +70,12 @@ config = {
     'grad_accumulated_steps': 1,
     'num_epochs': 100,
     'valid_patience': 10,
+    'valid_every': 1, # Validate every K epochs
+    'valid_sample_size': None, # Validate on a fixed random subsample (None: full set)
+    'valid_batch_size': 32,
+    'checkpoint_every_epochs': 1, # Full (resumable) training checkpoints, None or 0 to disable
+    'checkpoint_every_minutes': None,
+    'keep_last_checkpoints': 3, # None keeps all of them
     'margin': 1.0, # Converted to float
 
     # --- Testing Settings ---
@@ -81,14 +87,49 @@ config = {
     'gpu': 0,
     
     # --- Other options from kbqa.py that might be needed ---
-    'augment_similar_dishs': False,
+    'augment_similar_dishs': False, # Needed for QuestionRequest.similar_to; the similarity data then loads at startup
     'similarity_score_ratio': 0.2,
+    'num_similar_recipes': 10, # Neighbors per recipe in QuestionRequest.similar_to
+    'max_batch_questions': 32, # Max questions per /api/v1/recipes/ask/batch request
+    'query_batch_size': 64, # spaCy batch size of QueryProcessor.process_queries
+    'query_cache_size': 10000, # Max number of cached question parses
+    'query_cache_file': os.path.join(DATA_DIR, 'query_parse_cache.json'), # Persisted at shutdown, None to disable
+    'query_log_file': None, # Questions (one per line) parsed at startup to warm the cache
+    'fast_path_parsing': True, # Parse common question shapes with rules over the KG ingredient lexicon
+    'ingredient_linking': True, # Link extracted ingredients to KG ingredient URIs
+    'exclude_disliked_ingredients': True, # Drop the dishes containing linked disliked ingredients before ranking
+    'startup_workers': 3, # Threads loading the model, the KG extractor and spaCy concurrently
+    'tracing': True, # Per-stage latency histograms of the recipe path, served at /metrics
+    'server_timing_header': False, # Also send each request's stage durations in a Server-Timing header
+    'profile_header': None, # e.g. 'X-Profile': requests with this header set to 1 profile KBQA.answer (before authentication!)
+    'profile_dir': os.path.join(RUNS_DIR, 'profiles'), # Where profiles are written, KBQA_PROFILE_DIR overrides it
+    'profile_mode': 'sampling', # 'sampling' (collapsed stacks) or 'cprofile' (pstats dump)
+    'profile_max_per_minute': 6, # Cap on the profiled requests, header and KBQA_PROFILE sampling together
+    'profile_max_files': 100, # Only the newest files in profile_dir are kept
+    'diagnostics': False, # Serve the memory report and tracemalloc snapshots under /api/v1/diagnostics
+    'tracemalloc_at_startup': False, # Trace allocations from before the models load (slows loading down)
+
+    # --- Database ---
+    'database_url': None, # Defaults to sqlite:///./recipe_finder.db, postgresql://... uses asyncpg
+    'db_pool_size': 5, # db_pool_* only apply to non-SQLite databases
+    'db_max_overflow': 10,
+    'db_pool_timeout': 30,
+    'sqlite_busy_timeout_ms': 5000, # Writers wait this long for the SQLite lock
+
+    # --- Authentication ---
+    'user_cache_ttl_seconds': 60, # Authenticated users are cached for this long, 0 to disable
+    'user_cache_max_size': 10000,
+    'bcrypt_rounds': 12, # Stored hashes with another cost are re-hashed on login
+    'password_hash_workers': None, # Processes running bcrypt, None for cpu_count // 4 capped to 2
+    'password_hash_queue_per_worker': 4, # Max queued hashes per worker before callers wait
     
     # These paths are needed by the KBQA class if similarity features are used.
     # We add them here for completeness.
     'dish_info_file': os.path.join(DATA_DIR, 'kbqa', 'dish_info_map.json'),
     'recipe_emb_file': os.path.join(DATA_DIR, 'kbqa', 'recipe_embeddings.npy'),
     'dish_name2id_file': os.path.join(DATA_DIR, 'kbqa', 'dish_name2id.json'),
+    # Binary store written by BAMnet/src/build_recipe_store.py, used instead of the three files above when present
+    'recipe_store_dir': os.path.join(DATA_DIR, 'kbqa', 'recipe_store'),
 }
 
 # Define STOPWORDS here if it's used by other modules that import this config.
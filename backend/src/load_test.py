@@ -0,0 +1,219 @@
+"""
+Load test of one API instance: register, login and ask traffic at fixed arrival
+rates (open loop), run in-process through httpx's ASGI transport against the
+FastAPI app with a fresh SQLite user store. The recipe model is replaced by
+FakeRecipeService, whose latency is configurable, unless --real_service is given;
+then the real RecipeService is loaded on a synthetic KG (see
+BAMnet/src/benchmarks/synthetic.py).
+
+Run from backend/src: python load_test.py --num_users 100 --ask_rate 20 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from config import config
+
+BAMNET_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "service", "BAMnet", "src")
+
+
+class FakeRecipeService:
+    """
+    Stands in for RecipeService in the API: ranking sleeps for a log-normally
+    jittered latency (blocking, like the model) and the recipes are canned.
+    """
+
+    def __init__(self, latency_ms: float = 50.0, jitter: float = 0.2, num_recipes: int = 20, seed: int = 1234):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.num_recipes = num_recipes
+        self.startup_timings = {"total": 0.0}
+        self._rng = random.Random(seed)
+
+    def rank_recipes(self, request, user, processed_query=None, top_k: Optional[int] = None) -> Tuple[Optional[str], List[str]]:
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms * self._rng.lognormvariate(0, self.jitter) / 1000)
+        num_recipes = self.num_recipes if top_k is None else min(top_k, self.num_recipes)
+        return "fake-tag", [f"http://example.com/recipe/{i}" for i in range(num_recipes)]
+
+    def format_recipes(self, primary_tag_url: Optional[str], dish_urls: List[str]) -> Iterator[Dict[str, Any]]:
+        for url in dish_urls:
+            yield {
+                "dish_url": url,
+                "dish_name": f"Recipe {url.rsplit('/', 1)[-1]}",
+                "ingredients": ["flour", "salt", "water"],
+                "nutrition": {"calories": 420.0, "protein": 12.0, "carbohydrates": 60.0},
+            }
+
+    def find_recipes(self, request, user, processed_query=None, limit: Optional[int] = None, offset: int = 0,
+                     top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+        primary_tag_url, dish_urls = self.rank_recipes(request, user, processed_query, top_k=top_k)
+        page = dish_urls[offset:] if limit is None else dish_urls[offset:offset + limit]
+        return list(self.format_recipes(primary_tag_url, page))
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+    def shutdown(self) -> None:
+        pass
+
+
+def make_real_service(work_dir: str, num_tags: int, dishes_per_tag: int, seed: int):
+    """The real RecipeService (random BAMnet weights) on a synthetic KG, and questions about its tags."""
+    # The benchmark package imports the model code as `core`, like the other BAMnet scripts
+    sys.path.insert(0, BAMNET_SRC)
+    from benchmarks.synthetic import make_questions, make_synthetic_kb, write_synthetic_data
+    from service.recipe_service import RecipeService
+
+    kb = make_synthetic_kb(num_tags, dishes_per_tag, ingredients_per_dish=8, seed=seed)
+    questions = make_questions(kb, 64, seed=seed)
+    service_config = dict(config)
+    service_config.update(write_synthetic_data(work_dir, kb, questions))
+    service_config.update({"query_cache_file": None, "query_log_file": None, "recipe_store_dir": None})
+    service = RecipeService(config=service_config)
+    return service, [{"question": q["question"], "tags": [q["entities"][0][0]]} for q in questions]
+
+
+def fake_questions() -> List[Dict[str, Any]]:
+    return [
+        {"question": "italian dishes with chicken", "tags": ["italian"]},
+        {"question": "can you suggest vegan recipes without nuts", "tags": ["vegan"]},
+        {"question": "what about mexican dishes with beans and rice", "tags": ["mexican"]},
+    ]
+
+
+async def run_open_loop(client: httpx.AsyncClient, make_request: Callable[[int], Tuple[str, str, Dict]],
+                        rate: float, count: int, poisson: bool = False, seed: int = 1234) -> Dict[str, Any]:
+    """
+    Sends `count` requests at `rate` per second whatever the response times are. The
+    latency is measured from the scheduled send time, so queueing delay is included.
+    """
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    responses: List[Optional[httpx.Response]] = [None] * count
+
+    async def send(i: int, scheduled: float):
+        method, url, kwargs = make_request(i)
+        try:
+            response = await client.request(method, url, **kwargs)
+            statuses[response.status_code] += 1
+            responses[i] = response
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+        latencies.append(loop.time() - scheduled)
+
+    start = loop.time()
+    scheduled = start
+    tasks = []
+    for i in range(count):
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        tasks.append(asyncio.create_task(send(i, scheduled)))
+        scheduled += rng.expovariate(rate) if poisson else 1.0 / rate
+    await asyncio.gather(*tasks)
+    runtime = loop.time() - start
+
+    latencies.sort()
+    errors = sum(n for status, n in statuses.items() if not (isinstance(status, int) and status < 400))
+
+    def percentile(q):
+        return latencies[int(q * (len(latencies) - 1))] * 1000 if latencies else 0.0
+
+    return {
+        "requests": count,
+        "target_rate": rate,
+        "throughput_per_s": (count - errors) / runtime if runtime > 0 else 0.0,
+        "error_rate": errors / count if count else 0.0,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "status_codes": {str(status): n for status, n in statuses.items()},
+        "responses": responses,
+    }
+
+
+async def run_load_test(app, questions: List[Dict[str, Any]], args) -> Dict[str, Dict[str, Any]]:
+    from repository.database import async_engine
+
+    users = [(f"load{i}@example.com", f"password-{i}") for i in range(args.num_users)]
+    transport = httpx.ASGITransport(app=app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=args.timeout) as client:
+        results["register"] = await run_open_loop(
+            client, lambda i: ("POST", "/api/v1/users/register", {"json": {"email": users[i][0], "password": users[i][1]}}),
+            args.register_rate, len(users), args.poisson, args.seed)
+        results["login"] = await run_open_loop(
+            client, lambda i: ("POST", "/api/v1/users/token", {"data": {"username": users[i][0], "password": users[i][1]}}),
+            args.login_rate, len(users), args.poisson, args.seed)
+        tokens = [r.json()["access_token"] for r in results["login"]["responses"] if r is not None and r.status_code == 200]
+        if not tokens:
+            raise RuntimeError("No user could log in, see the login status codes")
+
+        def ask(i):
+            body = dict(questions[i % len(questions)], limit=args.limit)
+            return "POST", "/api/v1/recipes/ask", {"json": body, "headers": {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}}
+        results["ask"] = await run_open_loop(
+            client, ask, args.ask_rate, int(args.ask_rate * args.duration), args.poisson, args.seed)
+    await async_engine.dispose()
+    for result in results.values():
+        del result["responses"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_users", default=50, type=int, help="number of users to register and log in")
+    parser.add_argument("--register_rate", default=20.0, type=float, help="registrations per second")
+    parser.add_argument("--login_rate", default=20.0, type=float, help="logins per second")
+    parser.add_argument("--ask_rate", default=10.0, type=float, help="recipe questions per second")
+    parser.add_argument("--duration", default=30.0, type=float, help="seconds of ask traffic")
+    parser.add_argument("--limit", default=10, type=int, help="page size of the ask requests")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times instead of fixed ones")
+    parser.add_argument("--timeout", default=60.0, type=float, help="client timeout in seconds")
+    parser.add_argument("--fake_latency_ms", default=50.0, type=float, help="mean latency of the fake recipe service")
+    parser.add_argument("--fake_jitter", default=0.2, type=float, help="sigma of the log-normal latency jitter")
+    parser.add_argument("--real_service", action="store_true", help="load the real RecipeService on a synthetic KG")
+    parser.add_argument("--num_tags", default=4, type=int, help="tags of the synthetic KG (--real_service)")
+    parser.add_argument("--dishes_per_tag", default=500, type=int, help="dishes per tag of the synthetic KG (--real_service)")
+    parser.add_argument("--seed", default=1234, type=int)
+    parser.add_argument("--out", default=None, type=str, help="also write the results as JSON to this path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Must be set before the repository modules are imported, they create the engines on import
+        config["database_url"] = "sqlite:///" + os.path.join(tmp_dir, "load_test.db")
+        if args.real_service:
+            service, questions = make_real_service(os.path.join(tmp_dir, "kg"), args.num_tags, args.dishes_per_tag, args.seed)
+        else:
+            service, questions = FakeRecipeService(args.fake_latency_ms, args.fake_jitter, seed=args.seed), fake_questions()
+
+        import main as api
+        from utils import password
+        api.service = service  # The startup event (which loads the real service) does not run without a lifespan
+        try:
+            results = asyncio.run(run_load_test(api.app, questions, args))
+        finally:
+            password.shutdown_hash_pool()
+            api.engine.dispose()
+
+    for phase, result in results.items():
+        print(f"{phase:>8}: {result['throughput_per_s']:8.1f} req/s (target {result['target_rate']:.1f}), "
+              f"p50 {result['p50_ms']:7.1f}ms, p95 {result['p95_ms']:7.1f}ms, p99 {result['p99_ms']:7.1f}ms, "
+              f"errors {result['error_rate']:.1%} {result['status_codes']}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Load test of the register / login / me endpoints with the synchronous
+repository (sync endpoints in the threadpool) vs. the async repository, each on
+a fresh SQLite database. Runs in-process through httpx's ASGI transport.
+
+Run from backend/src: python load_test_auth.py --num_users 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import schemas
+import security
+from repository import repository
+from repository.database import Base, create_async_db_engine, create_db_engine, get_async_db, get_db
+from repository.user_cache import user_cache
+from utils import password
+
+
+def make_sync_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/register", response_model=schemas.User)
+    def register(user: schemas.UserCreate, user_repo=Depends(repository.get_user_repository)):
+        if user_repo.get_by_email(email=user.email):
+            raise HTTPException(status_code=400, detail="Email already registered")
+        return user_repo.create(user_create=user)
+
+    @app.post("/token")
+    def login(form_data: OAuth2PasswordRequestForm = Depends(), user_repo=Depends(repository.get_user_repository)):
+        user = security.authenticate_user(user_repo=user_repo, email=form_data.username, password=form_data.password)
+        if not user:
+            raise HTTPException(status_code=401)
+        return {"access_token": password.create_access_token({"sub": user.email}, timedelta(minutes=10))}
+
+    @app.get("/me", response_model=schemas.User)
+    def me(current_user=Depends(security.get_current_user)):
+        return current_user
+
+    return app
+
+
+def make_async_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/register", response_model=schemas.User)
+    async def register(user: schemas.UserCreate, user_repo=Depends(repository.get_async_user_repository)):
+        if await user_repo.get_by_email(email=user.email):
+            raise HTTPException(status_code=400, detail="Email already registered")
+        return await user_repo.create(user_create=user)
+
+    @app.post("/token")
+    async def login(form_data: OAuth2PasswordRequestForm = Depends(), user_repo=Depends(repository.get_async_user_repository)):
+        user = await security.authenticate_user_async(user_repo=user_repo, email=form_data.username, password=form_data.password)
+        if not user:
+            raise HTTPException(status_code=401)
+        return {"access_token": password.create_access_token({"sub": user.email}, timedelta(minutes=10))}
+
+    @app.get("/me", response_model=schemas.User)
+    async def me(current_user=Depends(security.get_current_user_async)):
+        return current_user
+
+    return app
+
+
+async def run_phase(client, requests, concurrency):
+    """Sends the (method, url, kwargs) requests with at most `concurrency` in flight, returns (req/s, p99 ms)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def send(method, url, kwargs):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+            return response
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[send(*r) for r in requests])
+    runtime = time.perf_counter() - start
+    latencies.sort()
+    return responses, len(requests) / runtime, latencies[int(0.99 * (len(latencies) - 1))] * 1000
+
+
+async def run_load_test(app, num_users, me_requests_per_user, concurrency, async_engine=None):
+    users = [(f"user{i}@example.com", f"password-{i}") for i in range(num_users)]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        results = {}
+        _, *results["register"] = await run_phase(
+            client, [("POST", "/register", {"json": {"email": e, "password": p}}) for e, p in users], concurrency)
+        responses, *results["login"] = await run_phase(
+            client, [("POST", "/token", {"data": {"username": e, "password": p}}) for e, p in users], concurrency)
+        tokens = [r.json()["access_token"] for r in responses]
+        _, *results["me"] = await run_phase(
+            client, [("GET", "/me", {"headers": {"Authorization": f"Bearer {t}"}}) for t in tokens * me_requests_per_user],
+            concurrency)
+    if async_engine is not None:
+        await async_engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_users", default=100, type=int, help="number of users to register and log in")
+    parser.add_argument("--me_requests_per_user", default=10, type=int, help="number of /me calls per user")
+    parser.add_argument("--concurrency", default=32, type=int, help="max number of requests in flight")
+    args = parser.parse_args()
+
+    user_cache.ttl_seconds = 0  # Measure the database, not the user cache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ("sync", "async"):
+            url = "sqlite:///" + os.path.join(tmp_dir, f"{name}.db")
+            sync_engine = create_db_engine(url)
+            Base.metadata.create_all(bind=sync_engine)
+            if name == "sync":
+                app = make_sync_app()
+                session_factory = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+
+                def override_get_db():
+                    db = session_factory()
+                    try:
+                        yield db
+                    finally:
+                        db.close()
+                app.dependency_overrides[get_db] = override_get_db
+            else:
+                app = make_async_app()
+                async_engine = create_async_db_engine(url)
+                async_session_factory = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+                async def override_get_async_db():
+                    async with async_session_factory() as db:
+                        yield db
+                app.dependency_overrides[get_async_db] = override_get_async_db
+
+            results = asyncio.run(run_load_test(app, args.num_users, args.me_requests_per_user, args.concurrency,
+                                                async_engine=async_engine if name == "async" else None))
+            for phase, (throughput, p99) in results.items():
+                print(f"{name:>5} {phase:>8}: {throughput:8.1f} req/s, p99 {p99:7.1f}ms")
+            sync_engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,30 @@
 import logging
+import os
+import threading
 from datetime import timedelta
 from typing import List, Optional, Dict, Any
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 from repository import repository, models
 import schemas
 import security
 from repository.database import engine
+from repository.user_cache import user_cache
 from utils import password
 from config import config
 
 # Import  service
-from service.recipe_service import RecipeService
+from service.recipe_service import RecipeService, paginate, ranking_depth
+from service.BAMnet.src.core.utils.tracing import tracer
+from service.BAMnet.src.core.utils.profiling import profiler
+from service.BAMnet.src.core.utils.memory import tracemalloc_snapshots
 
 # Create DB tables on startup
 models.Base.metadata.create_all(bind=engine)
@@ -42,11 +50,58 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Tracing ---
+# Spans of the recipe path feed the /metrics histograms; with server_timing_header
+# the stage durations of each request are also sent back in a Server-Timing header.
+tracer.enabled = config.get('tracing', True)
+
+async def add_server_timing(request: Request, call_next):
+    with tracer.trace() as trace:
+        response = await call_next(request)
+    # Streamed bodies are formatted after this point, so their timings only cover ranking
+    if trace.durations:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+if tracer.enabled and config.get('server_timing_header', False):
+    app.middleware("http")(add_server_timing)
+
+# --- Profiling ---
+# KBQA.answer is profiled for requests sending the profile header, when one is configured
+# (e.g. X-Profile: 1; any client can send it, so only set it where that is fine), and, with
+# the KBQA_PROFILE env var set to a fraction, for that share of all requests.
+# The ids of the profiles taken are sent back in an X-Profile-Id header.
+profiler.out_dir = os.environ.get('KBQA_PROFILE_DIR', config.get('profile_dir', 'profiles'))
+profiler.mode = config.get('profile_mode', 'sampling')
+profiler.max_per_minute = config.get('profile_max_per_minute', 6)
+profiler.max_files = config.get('profile_max_files', 100)
+PROFILE_HEADER = config.get('profile_header')
+
+async def profile_request(request: Request, call_next):
+    if request.headers.get(PROFILE_HEADER, "").lower() not in ("1", "true", "yes"):
+        return await call_next(request)
+    with profiler.request() as profile_ids:
+        response = await call_next(request)
+    if profile_ids:
+        response.headers["X-Profile-Id"] = ",".join(profile_ids)
+    return response
+
+if PROFILE_HEADER:
+    app.middleware("http")(profile_request)
+
 # --- API Data Models ---
 
 class QuestionRequest(BaseModel):
     question: str
     tags: List[str] = []
+    # Names of recipes the user liked; similar recipes are looked up server-side.
+    # Only with the augment_similar_dishs config, requests using it are rejected (400) otherwise.
+    similar_to: List[str] = []
+    # Page of the ranked recipes to return (all of them by default)
+    limit: Optional[int] = Field(None, ge=0)
+    offset: int = Field(0, ge=0)
+    # Only the top_k best recipes are ranked (all of them by default); pages beyond it are empty
+    top_k: Optional[int] = Field(None, ge=1)
 
 class NutritionInfo(BaseModel):
     calories: Optional[float] = None
@@ -69,33 +124,72 @@ class FormattedRecipe(BaseModel):
 class RecipeResponse(BaseModel):
     recipes: List[FormattedRecipe]
 
+class BatchQuestionRequest(BaseModel):
+    questions: List[QuestionRequest] = Field(..., min_items=1, max_items=config.get('max_batch_questions', 32))
+
+class BatchRecipeResponse(BaseModel):
+    # One per question, in the same order
+    results: List[RecipeResponse]
+
 # --- Service Initialization ---
-try:
-    service = RecipeService(config=config)
-except ValueError as e:
-    logger.critical(f"Failed to initialize RecipeService: {e}")
-    # Exit if the service can't be initialized (e.g., missing config)
-    exit(1)
+# The service is loaded in the background so the server can bind right away;
+# readiness is reported by /health/ready and recipe requests get a 503 until then.
+service: Optional[RecipeService] = None
+service_error: Optional[str] = None
+
+def load_service():
+    global service, service_error
+    if config.get('tracemalloc_at_startup', False):
+        tracemalloc_snapshots.start()
+    try:
+        service = RecipeService(config=config)
+    except Exception as e:
+        logger.critical(f"Failed to initialize RecipeService: {e}", exc_info=True)
+        service_error = str(e)
+
+@app.on_event("startup")
+def start_loading_service():
+    threading.Thread(target=load_service, name="service-loader", daemon=True).start()
+
+def get_service() -> RecipeService:
+    """Dependency of the endpoints which need the models, fails fast while they are loading."""
+    if service is None:
+        detail = "Service failed to start" if service_error else "Service is starting up"
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail, headers={"Retry-After": "5"})
+    return service
+
+@app.get("/health/live")
+def liveness():
+    if service_error:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Service failed to start: {service_error}")
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def readiness():
+    if service is None:
+        detail = f"Service failed to start: {service_error}" if service_error else "Service is starting up"
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail, headers={"Retry-After": "5"})
+    return {"status": "ready", "startup_timings": service.startup_timings}
 
 
 # --- USER & AUTHENTICATION ENDPOINTS (UNCHANGED) ---
 
 @app.post("/api/v1/users/register", response_model=schemas.User, status_code=status.HTTP_201_CREATED)
-def register_user(
+async def register_user(
     user: schemas.UserCreate, 
-    user_repo: repository.UserRepository = Depends(repository.get_user_repository)
+    user_repo: repository.AsyncUserRepository = Depends(repository.get_async_user_repository)
 ):
-    db_user = user_repo.get_by_email(email=user.email)
+    db_user = await user_repo.get_by_email(email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return user_repo.create(user_create=user)
+    return await user_repo.create(user_create=user)
 
 @app.post("/api/v1/users/token", response_model=schemas.Token)
-def login_for_access_token(
+async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    user_repo: repository.UserRepository = Depends(repository.get_user_repository)
+    user_repo: repository.AsyncUserRepository = Depends(repository.get_async_user_repository)
 ):
-    user = security.authenticate_user(
+    user = await security.authenticate_user_async(
         user_repo=user_repo, email=form_data.username, password=form_data.password
     )
     if not user:
@@ -111,16 +205,19 @@ def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/api/v1/users/me", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(security.get_current_user)):
+async def read_users_me(current_user: schemas.User = Depends(security.get_current_user_async)):
     return current_user
 
 @app.put("/api/v1/users/me/preferences", response_model=schemas.User)
-def update_preferences(
+async def update_preferences(
     preferences: schemas.Preferences,
-    current_user: models.User = Depends(security.get_current_user),
-    user_repo: repository.UserRepository = Depends(repository.get_user_repository)
+    current_user: schemas.User = Depends(security.get_current_user_async),
+    user_repo: repository.AsyncUserRepository = Depends(repository.get_async_user_repository)
 ):
-    return user_repo.update_preferences(user=current_user, preferences=preferences)
+    db_user = await user_repo.update_preferences(user=current_user, preferences=preferences)
+    if db_user is None:  # Deleted since it was cached
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return db_user
 
 
 # --- RECIPE ENDPOINT (ADAPTED FOR NEW SERVICE RESPONSE) ---
@@ -128,16 +225,23 @@ def update_preferences(
 @app.post("/api/v1/recipes/ask", response_model=RecipeResponse)
 async def ask_for_recipe(
     request: QuestionRequest,
-    current_user: models.User = Depends(security.get_current_user)
+    # Listed first so requests are rejected before authentication while loading
+    recipe_service: RecipeService = Depends(get_service),
+    current_user: schemas.User = Depends(security.get_current_user_async)
 ):
     """
     Accepts a user's question and tags, and returns a list of formatted recipes
     including names, URLs, ingredients, and nutrition info.
     """
     try:
-        formatted_recipes = service.find_recipes(
+        # The model is blocking and CPU-heavy, it must not stall the auth endpoints on the event loop
+        formatted_recipes = await run_in_threadpool(
+            recipe_service.find_recipes,
             request=request,
-            user=current_user
+            user=current_user,
+            limit=request.limit,
+            offset=request.offset,
+            top_k=request.top_k,
         )
         return RecipeResponse(recipes=formatted_recipes)
 
@@ -148,6 +252,123 @@ async def ask_for_recipe(
         logger.exception("An unexpected error occurred while processing recipe request.")
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
 
+@app.post("/api/v1/recipes/ask/batch", response_model=BatchRecipeResponse)
+async def ask_for_recipes_batch(
+    batch: BatchQuestionRequest,
+    recipe_service: RecipeService = Depends(get_service),
+    current_user: schemas.User = Depends(security.get_current_user_async)
+):
+    """
+    Same as /api/v1/recipes/ask for several questions at once (e.g. a client
+    prefetching suggestions), which are parsed in one spaCy batch. An error in
+    any of them fails the whole batch.
+    """
+    try:
+        results = await run_in_threadpool(
+            recipe_service.find_recipes_batch,
+            requests=batch.questions,
+            users=[current_user] * len(batch.questions),
+        )
+        return BatchRecipeResponse(results=[RecipeResponse(recipes=recipes) for recipes in results])
+
+    except ValueError as e:
+        logger.error(f"Service layer error for user {current_user.email}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        logger.exception("An unexpected error occurred while processing recipe batch request.")
+        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+
+@app.post("/api/v1/recipes/ask/stream")
+async def ask_for_recipe_stream(
+    request: QuestionRequest,
+    format: str = Query("ndjson", regex="^(ndjson|sse)$"),
+    recipe_service: RecipeService = Depends(get_service),
+    current_user: schemas.User = Depends(security.get_current_user_async)
+):
+    """
+    Same as /api/v1/recipes/ask, but the recipes are streamed in rank order as
+    soon as each one is formatted: one JSON object per line (ndjson) or one
+    server-sent event per recipe followed by an "end" event (sse).
+    """
+    # Ranking happens before the response starts so errors still get a proper status code
+    try:
+        primary_tag_url, answer_id_list = await run_in_threadpool(
+            recipe_service.rank_recipes,
+            request=request,
+            user=current_user,
+            top_k=ranking_depth(request.top_k, request.limit, request.offset),
+        )
+    except ValueError as e:
+        logger.error(f"Service layer error for user {current_user.email}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        logger.exception("An unexpected error occurred while processing recipe request.")
+        raise HTTPException(status_code=500, detail="An internal server error occurred.")
+
+    recipes = recipe_service.format_recipes(primary_tag_url, paginate(answer_id_list, request.limit, request.offset))
+
+    # A sync generator: Starlette iterates it in the threadpool
+    def encode():
+        for recipe in recipes:
+            data = FormattedRecipe.parse_obj(recipe).json()
+            yield f"data: {data}\n\n" if format == "sse" else data + "\n"
+        if format == "sse":
+            yield "event: end\ndata: {}\n\n"
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(encode(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/v1/stats")
+def read_stats(recipe_service: RecipeService = Depends(get_service)):
+    return {**recipe_service.stats(), 'user_cache': user_cache.stats(), 'login': security.login_stats.summary()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Per-stage latency and size histograms in the Prometheus text format."""
+    return PlainTextResponse(tracer.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+# --- Diagnostics ---
+# Only served with the diagnostics config: the memory report walks the whole loaded
+# state, and tracing allocations slows every allocation down.
+memory_report_lock = threading.Lock()
+
+def read_memory_report(recipe_service: RecipeService = Depends(get_service)):
+    """Approximate deep memory per component of the loaded models and data, and the process RSS."""
+    if not memory_report_lock.acquire(blocking=False):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A memory report is already running")
+    try:
+        return recipe_service.memory_report()
+    finally:
+        memory_report_lock.release()
+
+def start_tracemalloc(nframes: int = Query(1, ge=1, le=64)):
+    tracemalloc_snapshots.start(nframes)
+    return {"tracing": True}
+
+def stop_tracemalloc():
+    tracemalloc_snapshots.stop()
+    return {"tracing": False}
+
+def read_tracemalloc_snapshot(limit: int = Query(20, ge=1, le=500),
+                              key_type: str = Query("lineno", regex="^(lineno|filename|traceback)$")):
+    """Top allocation sites, and their growth since the previous snapshot."""
+    try:
+        return tracemalloc_snapshots.take(limit=limit, key_type=key_type)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+if config.get('diagnostics', False):
+    app.get("/api/v1/diagnostics/memory")(read_memory_report)
+    app.post("/api/v1/diagnostics/tracemalloc/start")(start_tracemalloc)
+    app.post("/api/v1/diagnostics/tracemalloc/stop")(stop_tracemalloc)
+    app.get("/api/v1/diagnostics/tracemalloc")(read_tracemalloc_snapshot)
+
+@app.on_event("shutdown")
+def shutdown_service():
+    password.shutdown_hash_pool()
+    if service is not None:
+        service.shutdown()
+
 @app.get("/")
 def read_root():
     return {"status": "Recipe Finder API is running"}
\ No newline at end of file
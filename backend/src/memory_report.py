@@ -0,0 +1,63 @@
+"""
+Memory accounting of the serving state: loads RecipeService like the API does and
+reports the approximate deep memory of each component (see
+BAMnet/src/core/utils/memory.py) next to the process RSS. With --tracemalloc the
+allocations of the load are traced too, and their top sites are printed.
+
+Run from backend/src: python memory_report.py --tracemalloc --out memory.json
+"""
+import argparse
+import json
+
+from config import config
+from service.BAMnet.src.core.utils.memory import process_rss, tracemalloc_snapshots
+
+
+def format_bytes(n):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(n) < 1024 or unit == "GiB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+
+
+def print_report(report):
+    print(f"{'component':<28} {'bytes':>12} {'mapped':>12}")
+    for row in report["components"]:
+        if not row["loaded"]:
+            print(f"{row['component']:<28} {'not loaded':>12}")
+            continue
+        print(f"{row['component']:<28} {format_bytes(row['bytes']):>12} {format_bytes(row['mapped_bytes']):>12}")
+    print(f"{'total':<28} {format_bytes(report['total_bytes']):>12} {format_bytes(report['total_mapped_bytes']):>12}")
+    if report["rss_bytes"] is not None:
+        print(f"{'process RSS':<28} {format_bytes(report['rss_bytes']):>12}")
+    print(f"(walked in {report['report_seconds']:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracemalloc", action="store_true", help="trace the allocations of the load (slows it down)")
+    parser.add_argument("--nframes", default=1, type=int, help="frames per traced allocation")
+    parser.add_argument("--limit", default=20, type=int, help="number of allocation sites to print")
+    parser.add_argument("--out", default=None, type=str, help="also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc_snapshots.start(args.nframes)
+    rss_before = process_rss()
+
+    from service.recipe_service import RecipeService
+    service = RecipeService(config=config)
+
+    report = service.memory_report()
+    report["rss_before_load_bytes"] = rss_before
+    print_report(report)
+
+    if args.tracemalloc:
+        report["tracemalloc"] = tracemalloc_snapshots.take(limit=args.limit)
+        print(f"\nTop allocation sites ({format_bytes(report['tracemalloc']['traced_bytes'])} traced):")
+        for stat in report["tracemalloc"]["top"]:
+            print(f"{format_bytes(stat['bytes']):>12} {stat['count']:>10} {stat['traceback'][0]}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
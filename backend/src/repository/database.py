@@ -1,14 +1,70 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./recipe_finder.db"
+from config import config
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+SQLALCHEMY_DATABASE_URL = config.get('database_url') or "sqlite:///./recipe_finder.db"
+
+# Async drivers of the supported databases
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def to_async_url(url: str) -> str:
+    """sqlite:///x.db -> sqlite+aiosqlite:///x.db, postgresql://... -> postgresql+asyncpg://..."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database '{backend}'")
+    return str(parsed.set(drivername=ASYNC_DRIVERS[backend]))
+
+def set_sqlite_pragmas(sync_engine, busy_timeout_ms: int = 5000) -> None:
+    """
+    WAL lets readers proceed while a write is in progress, and the busy timeout
+    makes a writer wait for the lock instead of failing with "database is locked".
+    """
+    @event.listens_for(sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+def create_db_engine(url: str = SQLALCHEMY_DATABASE_URL):
+    is_sqlite = make_url(url).get_backend_name() == "sqlite"
+    db_engine = create_engine(url, connect_args={"check_same_thread": False} if is_sqlite else {})
+    if is_sqlite:
+        set_sqlite_pragmas(db_engine, config.get('sqlite_busy_timeout_ms', 5000))
+    return db_engine
+
+def create_async_db_engine(url: str = SQLALCHEMY_DATABASE_URL):
+    is_sqlite = make_url(url).get_backend_name() == "sqlite"
+    if is_sqlite:
+        # aiosqlite gets a pool class (NullPool, StaticPool, ...) that doesn't take the sizing arguments
+        async_engine = create_async_engine(to_async_url(url))
+        set_sqlite_pragmas(async_engine.sync_engine, config.get('sqlite_busy_timeout_ms', 5000))
+    else:
+        async_engine = create_async_engine(
+            to_async_url(url),
+            pool_size=config.get('db_pool_size', 5),
+            max_overflow=config.get('db_max_overflow', 10),
+            pool_timeout=config.get('db_pool_timeout', 30),
+            pool_pre_ping=True,
+        )
+    return async_engine
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_db_engine()
+# expire_on_commit=False: returned objects stay readable without a lazy (sync) refresh
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 # Dependency to get a DB session
@@ -17,4 +73,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Dependency to get an async DB session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
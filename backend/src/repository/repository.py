@@ -1,12 +1,15 @@
-from typing import Generic, List, Optional, Type, TypeVar
+from typing import Generic, List, Optional, Type, TypeVar, Union
 from fastapi import Depends
 from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from repository import models
-from repository.database import get_db
+from repository.database import get_async_db, get_db
+from repository.user_cache import user_cache
 import schemas
-from utils.password import get_password_hash
+from utils.password import get_password_hash, get_password_hash_async
 
 from sqlalchemy.ext.declarative import DeclarativeMeta
 
@@ -52,17 +55,84 @@ class UserRepository(BaseRepository[models.User, schemas.UserCreate]):
 
     def update_preferences(
         self,
-        user: models.User,
+        user: Union[models.User, schemas.User],
         preferences: schemas.Preferences
-    ) -> models.User:
-        """Updates a user's ingredient preferences."""
+    ) -> Optional[models.User]:
+        """
+        Updates a user's ingredient preferences (user can be a cached schemas.User).
+        Returns None if the user no longer exists.
+        """
+        if not isinstance(user, models.User):
+            cached_user, user = user, self.get(user.id)
+            if user is None:
+                user_cache.invalidate(cached_user.email)
+                return None
         user.prohibited_ingredients = preferences.prohibited_ingredients
         self.db.commit()
         self.db.refresh(user)
+        user_cache.invalidate(user.email)
         return user
 
+    def update_password_hash(self, user: models.User, hashed_password: str) -> None:
+        """Stores a re-hashed password (e.g. after the bcrypt cost factor changed)."""
+        user.hashed_password = hashed_password
+        self.db.commit()
+
+class AsyncUserRepository:
+    """
+    Async version of UserRepository over an AsyncSession, for the async endpoints.
+    """
+    def __init__(self, db: AsyncSession):
+        self.model = models.User
+        self.db = db
+
+    async def get(self, id: int) -> Optional[models.User]:
+        return await self.db.get(self.model, id)
+
+    async def get_by_email(self, email: str) -> Optional[models.User]:
+        """Fetches a user by their email address."""
+        result = await self.db.execute(select(self.model).where(self.model.email == email).limit(1))
+        return result.scalars().first()
+
+    async def create(self, user_create: schemas.UserCreate) -> models.User:
+        """Creates a new user with a hashed password."""
+        # bcrypt is CPU-bound, keep it off the event loop and the request threads
+        hashed_password = await get_password_hash_async(user_create.password)
+        db_user = self.model(email=user_create.email, hashed_password=hashed_password)
+        self.db.add(db_user)
+        await self.db.commit()
+        await self.db.refresh(db_user)
+        return db_user
+
+    async def update_preferences(
+        self,
+        user: Union[models.User, schemas.User],
+        preferences: schemas.Preferences
+    ) -> Optional[models.User]:
+        """
+        Updates a user's ingredient preferences (user can be a cached schemas.User).
+        Returns None if the user no longer exists.
+        """
+        db_user = await self.get(user.id)
+        if db_user is None:
+            user_cache.invalidate(user.email)
+            return None
+        db_user.prohibited_ingredients = preferences.prohibited_ingredients
+        await self.db.commit()
+        await self.db.refresh(db_user)
+        user_cache.invalidate(db_user.email)
+        return db_user
+
+    async def update_password_hash(self, user: models.User, hashed_password: str) -> None:
+        """Stores a re-hashed password (e.g. after the bcrypt cost factor changed)."""
+        user.hashed_password = hashed_password
+        await self.db.commit()
+
 # --- FastAPI Dependency ---
 # This function will be used in our API endpoints to get an instance
 # of the UserRepository, which already has a db session.
 def get_user_repository(db: Session = Depends(get_db)) -> UserRepository:
-    return UserRepository(db)
\ No newline at end of file
+    return UserRepository(db)
+
+async def get_async_user_repository(db: AsyncSession = Depends(get_async_db)) -> AsyncUserRepository:
+    return AsyncUserRepository(db)
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import schemas
+from config import config
+
+
+class UserCache:
+    """
+    Short-TTL in-process cache of authenticated users, keyed by email and the
+    token's issued-at time. Entries are dropped when the user's preferences are
+    updated (in this process; other workers see the change after the TTL).
+    """
+
+    def __init__(self, ttl_seconds: float = 60, max_size: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Tuple[str, Any], Tuple[float, schemas.User]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email: str, issued_at: Any) -> Optional[schemas.User]:
+        key = (email, issued_at)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, email: str, issued_at: Any, user: schemas.User) -> None:
+        if self.ttl_seconds <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[(email, issued_at)] = (time.monotonic() + self.ttl_seconds, user)
+            self._entries.move_to_end((email, issued_at))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email: str) -> None:
+        """Drops the entries of all the tokens of a user."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == email]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "db_round_trips_saved": self.hits,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+# Shared by security.get_current_user and UserRepository.update_preferences
+user_cache = UserCache(
+    ttl_seconds=config.get('user_cache_ttl_seconds', 60),
+    max_size=config.get('user_cache_max_size', 10000),
+)
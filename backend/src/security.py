@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -7,10 +8,12 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 
 # Import the repository and its dependency function
-from repository.repository import UserRepository, get_user_repository
+from repository.repository import AsyncUserRepository, UserRepository, get_async_user_repository, get_user_repository
 from repository import models
+from repository.user_cache import user_cache
 import schemas
-from utils.password import verify_password, decode_access_token
+from utils.latency import LatencyStats
+from utils.password import decode_access_token, verify_and_rehash, verify_and_rehash_async
 
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
@@ -21,6 +24,9 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # --- Authentication & Authorization (UPDATED) ---
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/v1/users/token")
 
+# Latency of the password logins (failed ones count as errors)
+login_stats = LatencyStats()
+
 def authenticate_user(
     user_repo: UserRepository,
     email: str,
@@ -28,30 +34,81 @@ def authenticate_user(
 ) -> Optional[models.User]:
     """Authenticates a user using the UserRepository."""
     user = user_repo.get_by_email(email=email)
-    if not user or not verify_password(password, user.hashed_password):
+    if not user:
+        return None
+    valid, new_hash = verify_and_rehash(password, user.hashed_password)
+    if not valid:
         return None
+    if new_hash is not None:
+        user_repo.update_password_hash(user, new_hash)
     return user
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    user_repo: UserRepository = Depends(get_user_repository)
-) -> models.User:
-    """Decodes JWT and retrieves the current user via the UserRepository."""
-    credentials_exception = HTTPException(
+async def authenticate_user_async(
+    user_repo: AsyncUserRepository,
+    email: str,
+    password: str
+) -> Optional[models.User]:
+    """
+    Authenticates a user using the AsyncUserRepository. bcrypt runs in the
+    password hashing process pool, and the stored hash is upgraded when the
+    configured cost factor changed.
+    """
+    start = time.perf_counter()
+    user = await user_repo.get_by_email(email=email)
+    valid, new_hash = (False, None) if not user else await verify_and_rehash_async(password, user.hashed_password)
+    if valid and new_hash is not None:
+        await user_repo.update_password_hash(user, new_hash)
+    login_stats.record(time.perf_counter() - start, error=not valid)
+    return user if valid else None
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = decode_access_token(token)
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(email=email)
-    except JWTError:
-        raise credentials_exception
-    
-    user = user_repo.get_by_email(email=token_data.email)
-    if user is None:
-        raise credentials_exception
-    return user
\ No newline at end of file
+
+def _decode_token(token: str):
+    """(email, issued-at) of a valid access token, else raises a 401."""
+    payload = decode_access_token(token)
+    if payload is None or payload.get("sub") is None:
+        raise _credentials_exception()
+    token_data = schemas.TokenData(email=payload.get("sub"))
+    return token_data.email, payload.get("iat")
+
+def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    user_repo: UserRepository = Depends(get_user_repository)
+) -> schemas.User:
+    """
+    Decodes JWT and retrieves the current user, from the user cache when the
+    same token was seen recently, else via the UserRepository.
+    """
+    email, issued_at = _decode_token(token)
+    user = user_cache.get(email, issued_at)
+    if user is not None:
+        return user
+
+    db_user = user_repo.get_by_email(email=email)
+    if db_user is None:
+        raise _credentials_exception()
+    user = schemas.User.from_orm(db_user)
+    user_cache.put(email, issued_at, user)
+    return user
+
+async def get_current_user_async(
+    token: str = Depends(oauth2_scheme),
+    user_repo: AsyncUserRepository = Depends(get_async_user_repository)
+) -> schemas.User:
+    """Async version of get_current_user."""
+    email, issued_at = _decode_token(token)
+    user = user_cache.get(email, issued_at)
+    if user is not None:
+        return user
+
+    db_user = await user_repo.get_by_email(email=email)
+    if db_user is None:
+        raise _credentials_exception()
+    user = schemas.User.from_orm(db_user)
+    user_cache.put(email, issued_at, user)
+    return user
@@ -0,0 +1,82 @@
+'''
+Throughput benchmark of the negative sampler used by BAMnetAgent.train_step
+on synthetic candidate memories (no data needed).
+
+'''
+import timeit
+import argparse
+import numpy as np
+
+from core.bamnet.bamnet import make_ctx_matcher
+from core.bamnet.sampling import prepare_memories, sample_ctx_memories, sample_negative_inds
+from core.bamnet.utils import next_batch
+from core.config import *
+
+
+def make_synthetic_data(num_examples, num_cands, num_ctx_ents, vocab_size=2000, query_len=12, seed=1234):
+    rng = np.random.RandomState(seed)
+    words = ['w{}'.format(i) for i in range(vocab_size)]
+    vocab2id = dict(RESERVED_TOKENS)
+    vocab2id.update({w: i + len(RESERVED_TOKENS) for i, w in enumerate(words)})
+
+    memories, queries, raw_queries, query_mentions, query_marks, gold_ans_inds = [], [], [], [], [], []
+    for _ in range(num_examples):
+        n = num_cands + 1 # The last element is a dummy candidate
+        raw_query = [words[i] for i in rng.randint(0, vocab_size, query_len)]
+        # A few context entity names share tokens with the query
+        ctx_ents = [[[raw_query[rng.randint(query_len)] if rng.rand() < 0.1 else words[rng.randint(vocab_size)] \
+                    for _ in range(rng.randint(1, 4))] for _ in range(num_ctx_ents)] for _ in range(num_cands)] + [[]]
+        memories.append((rng.randint(2, vocab_size, (n, 3)).tolist(), rng.randint(1, 4, n).tolist(), rng.randint(2, 100, n).tolist(), \
+                    rng.randint(2, vocab_size, (n, 2)).tolist(), rng.randint(2, 7, (n, 1)).tolist(), rng.randint(1, 3, n).tolist(), \
+                    rng.randint(2, vocab_size, (n, 2)).tolist(), rng.randint(2, 11, (n, 2)).tolist(), rng.randint(1, 3, n).tolist(), \
+                    ctx_ents, np.zeros((n, 1), dtype=int).tolist(), rng.randint(2, vocab_size, (n, 2)).tolist(), \
+                    rng.randint(2, 7, (n, 1)).tolist(), rng.randint(1, 3, n).tolist()))
+        queries.append([vocab2id[w] for w in raw_query])
+        raw_queries.append(raw_query)
+        query_mentions.append([])
+        query_marks.append(np.zeros(query_len))
+        gold_ans_inds.append(rng.choice(num_cands, rng.randint(1, 4), replace=False).tolist())
+    return vocab2id, memories, queries, raw_queries, query_mentions, query_marks, gold_ans_inds
+
+def run_epoch(memories, queries, raw_queries, query_mentions, query_marks, gold_ans_inds, vocab2id, batch_size, mem_size, ctx_bow_size):
+    start = timeit.default_timer()
+    for batch_xs, batch_ys in next_batch(memories, queries, queries, raw_queries, query_mentions, query_marks, queries, gold_ans_inds, batch_size):
+        ctx_matches = make_ctx_matcher(vocab2id, STOPWORDS, batch_xs[3], batch_xs[4], batch_xs[1], batch_xs[5])
+        sample_ctx_memories(batch_xs[0], batch_ys, mem_size, ctx_bow_size, ctx_matches)
+    return timeit.default_timer() - start
+
+def check_uniformity(num_cands, gold_inds, num_negs, trials):
+    '''Chi-square statistic of the negative index frequencies against the uniform distribution.'''
+    counts = np.zeros(num_cands)
+    for _ in range(trials):
+        for inds in sample_negative_inds([num_cands], [gold_inds], [num_negs]):
+            counts[inds] += 1
+    valid = np.ones(num_cands, dtype=bool)
+    valid[gold_inds] = False
+    expected = trials * num_negs / valid.sum()
+    return float(((counts[valid] - expected) ** 2 / expected).sum()), int(valid.sum() - 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_examples', default=256, type=int, help='number of synthetic examples')
+    parser.add_argument('--num_cands', default=2000, type=int, help='number of candidate answers per example')
+    parser.add_argument('--num_ctx_ents', default=5, type=int, help='number of context entities per candidate')
+    parser.add_argument('--batch_size', default=32, type=int, help='batch size')
+    parser.add_argument('--mem_size', default=96, type=int, help='number of sampled candidates per example')
+    parser.add_argument('--ctx_bow_size', default=16, type=int, help='max context bow size')
+    parser.add_argument('--epochs', default=3, type=int, help='number of epochs')
+    args = parser.parse_args()
+
+    vocab2id, memories, queries, raw_queries, query_mentions, query_marks, gold_ans_inds = make_synthetic_data(args.num_examples, args.num_cands, args.num_ctx_ents)
+
+    start = timeit.default_timer()
+    memories = prepare_memories(memories)
+    print('Prepared {} examples in {:.2f}s'.format(len(memories), timeit.default_timer() - start))
+
+    for epoch in range(1, args.epochs + 1):
+        runtime = run_epoch(memories, queries, raw_queries, query_mentions, query_marks, gold_ans_inds, vocab2id, args.batch_size, args.mem_size, args.ctx_bow_size)
+        print('Epoch {}: {:.2f}s, {:.1f} examples/s'.format(epoch, runtime, len(memories) / runtime))
+
+    chi2, dof = check_uniformity(200, [3, 17, 42], 50, 2000)
+    print('Negative sampling uniformity: chi2 = {:.1f} with {} degrees of freedom'.format(chi2, dof))
@@ -0,0 +1,66 @@
+'''
+Latency benchmark of the similarity-augmented answer scoring of KBQA.personalized_answer
+on a synthetic tag with many candidate recipes (no data needed).
+
+'''
+import timeit
+import argparse
+import numpy as np
+
+from core.kbqa import KBQA
+from core.recipe_similarity import RecipeSimilarity
+
+
+def make_synthetic_similarity(num_recipes, dim, seed=1234):
+    rng = np.random.RandomState(seed)
+    names = ['recipe {}'.format(i) for i in range(num_recipes)]
+    ids = ['r{}'.format(i) for i in range(num_recipes)]
+    emb = rng.randn(num_recipes, dim).astype(np.float32)
+    return names, RecipeSimilarity.from_arrays(dict(zip(names, ids)), ids, emb)
+
+def loop_scores(sim, kbqa_scores, answers, similar_recipes, ratio):
+    '''Per-candidate scoring (one cosine distance call and python merge per answer).'''
+    max_score, min_score = max(kbqa_scores), min(kbqa_scores)
+    scores = []
+    for kbqa_score, answer in zip(kbqa_scores, answers):
+        distance = similar_recipes.get(answer, {}).get('distance', None)
+        if distance is None:
+            ret_sim = sim.get_cosine_distance(answer, similar_recipes)
+            distance = KBQA.max_similarity_distance if ret_sim is None else ret_sim.min()
+        scores.append(KBQA.merge_kbqa_similarity_score(None, kbqa_score, distance, ratio, max_score, min_score))
+    return np.array(scores)
+
+def vectorized_scores(sim, kbqa_scores, answers, similar_recipes, ratio):
+    kbqa = KBQA.__new__(KBQA) # Only the scoring state is needed
+    kbqa._recipe_similarity = sim
+    kbqa.config = {'similarity_score_ratio': ratio}
+    kbqa.find_min_similarity_distance = float('inf')
+    return kbqa.get_final_answer_scores(kbqa_scores, answers, similar_recipes,
+                                        max_kbqa_score=kbqa_scores.max(), min_kbqa_score=kbqa_scores.min())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_recipes', default=50000, type=int, help='number of recipes with embeddings')
+    parser.add_argument('--num_cands', default=2000, type=int, help='number of candidate answers of the tag')
+    parser.add_argument('--num_similar', default=10, type=int, help='number of similar recipes in the request')
+    parser.add_argument('--dim', default=300, type=int, help='embedding size')
+    parser.add_argument('--repeat', default=20, type=int, help='number of timed runs')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(1234)
+    names, sim = make_synthetic_similarity(args.num_recipes, args.dim)
+    answers = [names[i] for i in rng.choice(args.num_recipes, args.num_cands, replace=False)]
+    answers[::50] = ['unknown recipe {}'.format(i) for i in range(len(answers[::50]))]
+    similar_recipes = {names[i]: {} for i in rng.choice(args.num_recipes, args.num_similar, replace=False)}
+    similar_recipes[answers[1]] = {'distance': 0.1} # Explicit distances take precedence
+    kbqa_scores = rng.randn(args.num_cands)
+
+    expected = loop_scores(sim, kbqa_scores, answers, similar_recipes, 0.2)
+    result = vectorized_scores(sim, kbqa_scores, answers, similar_recipes, 0.2)
+    assert np.allclose(expected, result, atol=1e-6)
+    assert (np.argsort(-expected, kind='stable') == np.argsort(-result, kind='stable')).all(), 'Rankings differ'
+
+    for name, fn in [('loop', loop_scores), ('vectorized', vectorized_scores)]:
+        runtime = min(timeit.repeat(lambda: fn(sim, kbqa_scores, answers, similar_recipes, 0.2), number=1, repeat=args.repeat))
+        print('{}: {:.2f}ms for {} candidates'.format(name, runtime * 1000, args.num_cands))
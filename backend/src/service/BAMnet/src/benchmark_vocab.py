@@ -0,0 +1,45 @@
+'''
+Benchmark of the parallel vocab builder against the sequential one on the real KB.
+Also checks that both produce identical counts.
+
+'''
+import timeit
+import argparse
+
+from core.build_data.foodkg.build_data import build_kb_data, build_qa_vocab, build_kb_data_parallel, build_qa_vocab_parallel
+from core.utils.utils import *
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-data_dir', '--data_dir', required=True, type=str, help='path to the data dir')
+    parser.add_argument('-kb_path', '--kb_path', required=True, type=str, help='path to the kb path')
+    parser.add_argument('-num_workers', '--num_workers', default=os.cpu_count(), type=int, help='number of processes')
+    parser.add_argument('--all_keys', action='store_true', help='flag: count the whole KB instead of the topic keys of the train set')
+    parser.add_argument('--no_query_expansion', action='store_true', help='flag: no query expansion')
+    args = parser.parse_args()
+
+    question_field = 'qText' if not args.no_query_expansion else 'qOriginText'
+    train_data = load_ndjson(os.path.join(args.data_dir, 'train_qas.json'))
+    kb = load_ndjson(args.kb_path, return_type='dict')
+    used_kbkeys = None
+    if not args.all_keys:
+        used_kbkeys = set()
+        for each in train_data:
+            used_kbkeys.update(each['topicKey'] if isinstance(each['topicKey'], list) else [each['topicKey']])
+
+    start = timeit.default_timer()
+    _, entity_types, relations, kb_vocabs = build_kb_data(kb, used_kbkeys)
+    qa_vocabs = build_qa_vocab(train_data, question_field)
+    sequential_time = timeit.default_timer() - start
+    print('Sequential: {:.2f}s'.format(sequential_time))
+
+    start = timeit.default_timer()
+    _, entity_types2, relations2, kb_vocabs2 = build_kb_data_parallel(kb, used_kbkeys, num_workers=args.num_workers)
+    qa_vocabs2 = build_qa_vocab_parallel(train_data, question_field, num_workers=args.num_workers)
+    parallel_time = timeit.default_timer() - start
+    print('Parallel ({} workers): {:.2f}s, speedup: {:.2f}x'.format(args.num_workers, parallel_time, sequential_time / parallel_time))
+
+    identical = dict(entity_types) == dict(entity_types2) and dict(relations) == dict(relations2) \
+                and dict(kb_vocabs) == dict(kb_vocabs2) and dict(qa_vocabs) == dict(qa_vocabs2)
+    print('Identical counts: {}'.format(identical))
@@ -0,0 +1,7 @@
+'''
+Benchmarks of the KBQA serving path on synthetic data (see synthetic.py), run from BAMnet/src:
+
+    python -m benchmarks --cand_sizes 100,500,2000 --threads 1,4 --out results.json
+    python -m benchmarks --out new.json --baseline results.json
+
+'''
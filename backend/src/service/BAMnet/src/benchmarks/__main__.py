@@ -0,0 +1,177 @@
+'''
+End-to-end and per-stage benchmarks of KBQA.answer on a synthetic KB with a
+randomly initialized BAMnet (no data needed).
+
+For each candidate-set size (dishes per tag) it measures:
+ - KBQA.answer latency percentiles and throughput for each number of client threads,
+ - build_ans_cands and create_kg_view on one tag,
+ - build_all_data, vectorize_data, pad_ctx_memory and BAMnet.forward for each batch size.
+Results are written as JSON; with --baseline the p50 latencies are compared to a previous run.
+
+'''
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from core.kbqa import KBQA
+from core.bamnet.utils import to_cuda
+from core.build_data.foodkg.build_data import build_all_data, build_ans_cands, create_kg_view
+from core.build_data.utils import vectorize_data
+from .synthetic import NUTRITION_RANGES, make_questions, make_synthetic_kb, to_question_dict, write_synthetic_data
+from .timing import compare_results, summarize, time_calls
+
+
+def answer_benchmark(kbqa, questions, num_threads, num_requests, top_k=None):
+    def timed_answer(question):
+        start = timeit.default_timer()
+        kbqa.answer(top_k=top_k, **question)
+        return timeit.default_timer() - start
+
+    requests = [questions[i % len(questions)] for i in range(num_requests)]
+    timed_answer(requests[0]) # Warm-up
+    start = timeit.default_timer()
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        latencies = list(pool.map(timed_answer, requests))
+    return summarize(latencies, wall_time=timeit.default_timer() - start)
+
+def vectorize(kbqa, queries, query_mentions, query_marks, memories):
+    '''Same arguments as KBQA.personalized_answer.'''
+    return vectorize_data(queries, query_mentions, query_marks, memories, \
+                        max_query_size=kbqa.config['query_size'], \
+                        max_ans_type_bow_size=kbqa.config['ans_type_bow_size'], \
+                        max_ans_path_bow_size=kbqa.config['ans_path_bow_size'], \
+                        max_ans_path_size=kbqa.config['ans_path_size'], \
+                        vocab2id=kbqa.vocab2id, \
+                        fixed_size=True, \
+                        verbose=False)
+
+def stage_benchmarks(kbqa, questions, batch_sizes, repeat):
+    '''Yields (benchmark, batch_size, latencies) of the stages of KBQA.personalized_answer.'''
+    preferred_ans_type = set(['dish_recipe'])
+    graph = kbqa.local_kb[questions[0]['topic_entities'][0]]
+    yield 'build_ans_cands', 1, time_calls(lambda: build_ans_cands(graph, kbqa.entity2id, kbqa.entityType2id, \
+                                        kbqa.relation2id, kbqa.vocab2id, preferred_ans_type=preferred_ans_type, kg_augmentation=False), repeat)
+    # The serving path has no nutrition constraints (the view is the KG itself), so some are given here
+    nutrition_range = {k: [low + (high - low) / 3., low + 2 * (high - low) / 3.] for k, (low, high) in NUTRITION_RANGES.items()}
+    yield 'create_kg_view', 1, time_calls(lambda: create_kg_view(graph, nutrition_range, None, None), repeat)
+
+    agent = kbqa.agent
+    agent.model.train(mode=False)
+    for batch_size in batch_sizes:
+        batch = [to_question_dict(questions[i % len(questions)]) for i in range(batch_size)]
+        build = lambda: build_all_data(batch, kbqa.local_kb, kbqa.entity2id, kbqa.entityType2id, kbqa.relation2id, kbqa.vocab2id, \
+                                    preferred_ans_type=preferred_ans_type)
+        yield 'build_all_data', batch_size, time_calls(build, repeat)
+
+        queries, raw_queries, query_mentions, query_marks, memories, _, _, _, _, _ = build()
+        yield 'vectorize_data', batch_size, time_calls(lambda: vectorize(kbqa, queries, query_mentions, query_marks, memories), repeat)
+
+        queries, query_words, query_marks, query_lengths, memories_vec, _ = vectorize(kbqa, queries, query_mentions, query_marks, memories)
+        pad = lambda: agent.pad_ctx_memory(memories_vec, kbqa.config['ans_ctx_entity_bow_size'], raw_queries, query_mentions, queries, query_marks)
+        yield 'pad_ctx_memory', batch_size, time_calls(pad, repeat)
+
+        # Same tensors as BAMnetAgent.predict_step
+        use_cuda = agent.opt['cuda']
+        pad_memories, _ = pad()
+        memories_t = [to_cuda(torch.LongTensor(np.array(x)), use_cuda) for x in zip(*pad_memories)]
+        queries_t = to_cuda(torch.LongTensor(queries), use_cuda)
+        query_words_t = to_cuda(torch.LongTensor(query_words), use_cuda)
+        query_marks_t = to_cuda(torch.LongTensor(query_marks), use_cuda)
+        query_lengths_t = to_cuda(torch.LongTensor(query_lengths), use_cuda)
+
+        def forward():
+            with torch.set_grad_enabled(False):
+                agent.model(memories_t, queries_t, query_marks_t, query_lengths_t, query_words_t, ctx_mask=None)
+            if use_cuda:
+                torch.cuda.synchronize()
+        yield 'bamnet_forward', batch_size, time_calls(forward, repeat)
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_cands in args.cand_sizes:
+            print('Candidate set size: {}'.format(num_cands))
+            kb = make_synthetic_kb(args.num_tags, num_cands, args.ingredients_per_dish, \
+                                num_ingredients=args.num_ingredients, seed=args.seed)
+            questions = make_questions(kb, args.num_questions, seed=args.seed)
+            config = write_synthetic_data(os.path.join(args.work_dir or tmp_dir, 'cands_{}'.format(num_cands)), kb, questions)
+            config['no_cuda'] = args.no_cuda
+            kbqa = KBQA(config)
+
+            for benchmark, batch_size, latencies in stage_benchmarks(kbqa, questions, args.batch_sizes, args.repeat):
+                row = {'benchmark': benchmark, 'candidates': num_cands, 'batch_size': batch_size}
+                row.update(summarize(latencies))
+                print('  {:<16} batch {:>4}: p50 {:9.2f}ms, p99 {:9.2f}ms'.format(benchmark, batch_size, row['p50_ms'], row['p99_ms']))
+                results.append(row)
+
+            for num_threads in args.threads:
+                row = {'benchmark': 'kbqa_answer', 'candidates': num_cands, 'threads': num_threads, 'top_k': args.top_k}
+                row.update(answer_benchmark(kbqa, questions, num_threads, args.num_requests, top_k=args.top_k))
+                print('  {:<16} {:>2} threads: p50 {:9.2f}ms, p99 {:9.2f}ms, {:8.1f} questions/s'.format(
+                        'kbqa_answer', num_threads, row['p50_ms'], row['p99_ms'], row['throughput_per_s']))
+                results.append(row)
+    return results
+
+def parse_sizes(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cand_sizes', default='100,500,2000', type=parse_sizes, help='comma-separated numbers of dishes per tag (answer candidates)')
+    parser.add_argument('--batch_sizes', default='1,8,32', type=parse_sizes, help='comma-separated batch sizes of the stage benchmarks')
+    parser.add_argument('--threads', default='1,2,4', type=parse_sizes, help='comma-separated numbers of threads calling KBQA.answer')
+    parser.add_argument('--num_tags', default=4, type=int, help='number of tags of the synthetic KB')
+    parser.add_argument('--ingredients_per_dish', default=8, type=int, help='number of ingredients per dish')
+    parser.add_argument('--num_ingredients', default=2000, type=int, help='number of distinct ingredients')
+    parser.add_argument('--num_questions', default=32, type=int, help='number of distinct synthetic questions')
+    parser.add_argument('--num_requests', default=64, type=int, help='number of KBQA.answer calls per thread count')
+    parser.add_argument('--repeat', default=20, type=int, help='number of timed runs of the stage benchmarks')
+    parser.add_argument('--top_k', default=None, type=int, help='top_k of KBQA.answer (all the answers by default)')
+    parser.add_argument('--torch_threads', default=None, type=int, help='torch intra-op threads (torch default if not set)')
+    parser.add_argument('--no_cuda', action='store_true', help='flag: run the model on the CPU')
+    parser.add_argument('--seed', default=1234, type=int, help='seed of the synthetic data')
+    parser.add_argument('--work_dir', default=None, type=str, help='keep the synthetic data in this dir (a temp dir by default)')
+    parser.add_argument('--out', default='benchmark_results.json', type=str, help='path to the JSON results')
+    parser.add_argument('--baseline', default=None, type=str, help='JSON results of a previous run to compare to')
+    parser.add_argument('--max_regression', default=0.2, type=float, help='allowed relative p50 slowdown vs. the baseline')
+    args = parser.parse_args()
+
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed) # Same random BAMnet weights across runs
+
+    output = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'work_dir')},
+        },
+        'results': run(args),
+    }
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('Saved results to {}'.format(args.out))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, output, max_regression=args.max_regression)
+        if regressions:
+            print('{} benchmark(s) regressed by more than {:.0f}%'.format(len(regressions), args.max_regression * 100))
+            sys.exit(1)
@@ -0,0 +1,141 @@
+'''
+Synthetic FoodKG-shaped data: tags -> tagged dishes -> ingredients (plus the
+nutrition values of the dishes), the vocab files built from it with build_vocab,
+questions in the shape RecipeService sends them, and a KBQA config with a
+randomly initialized BAMnet. Nothing is downloaded or read from the real data.
+
+'''
+import os
+import numpy as np
+
+from core.build_data.foodkg.build_data import build_vocab
+from core.utils.utils import dump_json, dump_ndjson
+
+
+TAG_PREFIX = 'http://idea.rpi.edu/heals/kb/tag/'
+RECIPE_PREFIX = 'http://idea.rpi.edu/heals/kb/recipe/'
+INGREDIENT_PREFIX = 'http://idea.rpi.edu/heals/kb/ingredientname/'
+NUTRITION_RANGES = {
+    'calories': (50, 1200),
+    'protein': (0, 80),
+    'carbohydrates': (0, 150),
+    'saturated fat': (0, 30),
+    'monounsaturated fat': (0, 30),
+    'polyunsaturated fat': (0, 20),
+}
+
+# Model hyperparameters of the served model (see backend/src/config.py)
+MODEL_CONFIG = {
+    'num_query_words': 10,
+    'no_filter_answer_type': False,
+    'query_size': 64,
+    'ans_type_bow_size': 6,
+    'ans_path_bow_size': 6,
+    'ans_path_size': 2,
+    'ans_ctx_entity_bow_size': 16,
+    'use_entity_name': False,
+    'fix_word_emb': False,
+    'constraint_mark_emb': 40,
+    'vocab_embed_size': 300,
+    'hidden_size': 128,
+    'o_embed_size': 128,
+    'mem_size': 96,
+    'word_emb_dropout': 0.3,
+    'que_enc_dropout': 0.3,
+    'ans_enc_dropout': 0.2,
+    'attention': 'add',
+    'num_hops': 1,
+    'learning_rate': 0.001,
+    'valid_patience': 10,
+    'test_margin': [0.9],
+    'no_cuda': True,
+    'gpu': 0,
+    'augment_similar_dishs': False,
+}
+
+
+def make_synthetic_kb(num_tags, dishes_per_tag, ingredients_per_dish, num_ingredients=2000, num_words=5000, seed=1234):
+    '''Returns {tag uri: tag node} with dishes_per_tag dishes (i.e., answer candidates) per tag.'''
+    rng = np.random.RandomState(seed)
+    words = ['w{}'.format(i) for i in range(num_words)]
+    ingredients = [(INGREDIENT_PREFIX + 'i{}'.format(i), ' '.join(rng.choice(words, rng.randint(1, 3)))) \
+                    for i in range(num_ingredients)]
+
+    kb = {}
+    for t in range(num_tags):
+        dishes = []
+        for d in range(dishes_per_tag):
+            dish_uri = RECIPE_PREFIX + 't{}d{}'.format(t, d)
+            nbrs = {'contains_ingredients': [{uri: {'name': [name], 'alias': [], 'type': ['ingredient'], 'uri': uri}} \
+                        for uri, name in (ingredients[i] for i in rng.choice(num_ingredients, ingredients_per_dish, replace=False))]}
+            for nutrition, (low, high) in NUTRITION_RANGES.items():
+                nbrs[nutrition] = ['{:.2f}'.format(rng.uniform(low, high))]
+            name = ' '.join(rng.choice(words, rng.randint(2, 5)))
+            dishes.append({dish_uri: {'name': [name], 'alias': [], 'type': ['dish_recipe'], 'uri': dish_uri, 'neighbors': nbrs}})
+        tag_uri = TAG_PREFIX + 'tag{}'.format(t)
+        kb[tag_uri] = {'name': ['tag{}'.format(t)], 'alias': [], 'type': ['tag'], 'uri': tag_uri, 'neighbors': {'tagged_dishes': dishes}}
+    return kb
+
+def make_questions(kb, num_questions, seed=1234):
+    '''Keyword arguments of KBQA.answer, built like RecipeService.rank_recipes does.'''
+    rng = np.random.RandomState(seed)
+    tag_uris = sorted(kb.keys())
+    questions = []
+    for _ in range(num_questions):
+        tag_uri = tag_uris[rng.randint(len(tag_uris))]
+        tag = kb[tag_uri]['name'][0]
+        dishes = kb[tag_uri]['neighbors']['tagged_dishes']
+        ingredients = [list(x.values())[0]['name'][0] for dish in rng.choice(len(dishes), 2) \
+                        for x in list(dishes[dish].values())[0]['neighbors']['contains_ingredients'][:1]]
+        likes, dislikes = ingredients[:1], ingredients[1:]
+        questions.append({
+            'question': '{} dishes with {} without {}'.format(tag, likes[0], dislikes[0]),
+            'question_type': 'constraint',
+            'topic_entities': [tag_uri],
+            'entities': [[tag, 'tag']],
+            'persona': {'ingredient_likes': likes, 'ingredient_dislikes': dislikes,
+                        'constrained_entities': {'1': likes, '2': dislikes}},
+            'guideline': {},
+            'explicit_nutrition': [],
+            'similar_recipes': {},
+        })
+    return questions
+
+def to_question_dict(question):
+    '''The build_all_data input of KBQA.personalized_answer for a make_questions entry.'''
+    return {'qType': 'constraint',
+            'topicKey': question['topic_entities'],
+            'multi_tag_type': 'none',
+            'persona': question['persona'],
+            'guideline': question['guideline'],
+            'explicit_nutrition': question['explicit_nutrition'],
+            'qText': question['question'],
+            'entities': question['entities'],
+            'rel_path': [],
+            'similar_recipes': question['similar_recipes'],
+            'answers': []}
+
+def write_synthetic_data(out_dir, kb, questions):
+    '''Writes the KB (ndjson, one tag per line) and the vocab files, returns a KBQA config.'''
+    os.makedirs(out_dir, exist_ok=True)
+    kb_path = os.path.join(out_dir, 'recipe_kg.json')
+    dump_ndjson([{k: v} for k, v in kb.items()], kb_path)
+
+    qa = [{'qText': x['question']} for x in questions]
+    entity2id, entityType2id, relation2id, vocab2id = build_vocab(qa, kb, min_freq=1)
+    dump_json(entity2id, os.path.join(out_dir, 'entity2id.json'))
+    dump_json(entityType2id, os.path.join(out_dir, 'entityType2id.json'))
+    dump_json(relation2id, os.path.join(out_dir, 'relation2id.json'))
+    dump_json(vocab2id, os.path.join(out_dir, 'vocab2id.json'))
+
+    config = dict(MODEL_CONFIG)
+    config.update({
+        'data_dir': out_dir,
+        'kb_path': kb_path,
+        'model_file': None, # Randomly initialized
+        'pre_word2vec': None,
+        'vocab_size': len(vocab2id),
+        'num_ent_types': len(entityType2id),
+        'num_relations': len(relation2id),
+    })
+    return config
@@ -0,0 +1,53 @@
+'''
+Timing helpers and the JSON result comparison of the benchmarks.
+
+'''
+import timeit
+import numpy as np
+
+
+def time_calls(fn, repeat, warmup=1):
+    '''Seconds of `repeat` calls of fn, after `warmup` untimed ones.'''
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        fn()
+        latencies.append(timeit.default_timer() - start)
+    return latencies
+
+def summarize(latencies, wall_time=None):
+    '''Latency percentiles in ms, plus the throughput if the calls ran within wall_time seconds.'''
+    ms = np.array(latencies) * 1000
+    summary = {
+        'count': len(latencies),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+    if wall_time is not None:
+        summary['throughput_per_s'] = len(latencies) / wall_time if wall_time > 0 else 0.
+    return summary
+
+def result_key(row):
+    '''Rows of two runs are compared when they have the same benchmark and parameters.'''
+    return tuple(sorted((k, v) for k, v in row.items() if k in ('benchmark', 'candidates', 'batch_size', 'threads', 'top_k')))
+
+def compare_results(baseline, current, metric='p50_ms', max_regression=0.2):
+    '''Prints the change of `metric` per benchmark row, returns the rows slower than (1 + max_regression) x baseline.'''
+    baseline_rows = {result_key(row): row for row in baseline['results']}
+    regressions = []
+    for row in current['results']:
+        base = baseline_rows.get(result_key(row))
+        if base is None or not base.get(metric):
+            continue
+        ratio = row[metric] / base[metric]
+        flag = ' REGRESSION' if ratio > 1 + max_regression else ''
+        print('{:<60} {}: {:9.2f} -> {:9.2f} ({:+.1f}%){}'.format(
+            ', '.join('{}={}'.format(k, v) for k, v in result_key(row)), metric, base[metric], row[metric], (ratio - 1) * 100, flag))
+        if flag:
+            regressions.append(row)
+    return regressions
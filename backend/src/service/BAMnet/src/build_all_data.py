@@ -18,6 +18,7 @@ if __name__ == '__main__':
     parser.add_argument('-kb_path', '--kb_path', required=True, type=str, help='path to the kb path')
     parser.add_argument('-out_dir', '--out_dir', required=True, type=str, help='path to the output dir')
     parser.add_argument('-min_freq', '--min_freq', default=2, type=int, help='min word vocab freq')
+    parser.add_argument('-num_workers', '--num_workers', default=1, type=int, help='number of processes used to build the vocabs')
     parser.add_argument('--no_filter_answer_type', action='store_true', help='flag: filter answer type')
     parser.add_argument('--no_query_expansion', action='store_true', help='flag: no query expansion')
     parser.add_argument('--no_kg_augmentation', action='store_true', help='flag: no query expansion')
@@ -48,7 +49,7 @@ if __name__ == '__main__':
                 used_kbkeys.add(each['topicKey'])
         print('# of used_kbkeys: {}'.format(len(used_kbkeys)))
 
-        entity2id, entityType2id, relation2id, vocab2id = build_vocab(built_data_set, kb, used_kbkeys, min_freq=args.min_freq, question_field=question_field)
+        entity2id, entityType2id, relation2id, vocab2id = build_vocab(built_data_set, kb, used_kbkeys, min_freq=args.min_freq, question_field=question_field, num_workers=args.num_workers)
         dump_json(entity2id, os.path.join(args.out_dir, 'entity2id.json'))
         dump_json(entityType2id, os.path.join(args.out_dir, 'entityType2id.json'))
         dump_json(relation2id, os.path.join(args.out_dir, 'relation2id.json'))
@@ -6,19 +6,25 @@ Created on Oct, 2017
 '''
 import argparse
 import os
+import numpy as np
 
 from core.utils.utils import load_json
-from core.utils.generic_utils import load_embeddings
+from core.utils.generic_utils import load_embeddings, dump_embedding_cache
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-emb', '--embed_path', required=True, type=str, help='path to the pretrained word embeddings')
-    parser.add_argument('-data_dir', '--data_dir', required=True, type=str, help='path to the data dir')
+    parser.add_argument('-emb', '--embed_path', required=True, type=str, help='path to the pretrained word embeddings (text, binary *.bin or *.npy cache)')
+    parser.add_argument('-data_dir', '--data_dir', type=str, help='path to the data dir')
     parser.add_argument('-out', '--out_path', required=True, type=str, help='path to the output path')
-    # parser.add_argument('-emb_size', '--emb_size', required=True, type=int, help='embedding size')
-    # parser.add_argument('--binary', action='store_true', help='flag: binary file')
+    parser.add_argument('-num_workers', '--num_workers', default=os.cpu_count(), type=int, help='number of processes scanning a text embedding file')
+    parser.add_argument('--float16', action='store_true', help='flag: save the embeddings in float16')
+    parser.add_argument('--to_cache', action='store_true', help='flag: convert the text embedding file into an out_path.npy/.vocab cache instead')
     args = parser.parse_args()
 
-    vocab_dict = load_json(os.path.join(args.data_dir, 'vocab2id.json'))
-    load_embeddings(vocab_dict, args.embed_path, args.out_path)
+    if args.to_cache:
+        dump_embedding_cache(args.embed_path, args.out_path)
+    else:
+        vocab_dict = load_json(os.path.join(args.data_dir, 'vocab2id.json'))
+        load_embeddings(vocab_dict, args.embed_path, args.out_path, num_workers=args.num_workers, \
+                        out_dtype=np.float16 if args.float16 else None)
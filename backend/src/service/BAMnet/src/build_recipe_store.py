@@ -0,0 +1,22 @@
+'''
+Converts the pickled recipe embeddings, the tab-separated recipe name mapping and
+the dish info json into a memory-mappable store (see core/recipe_store.py).
+
+'''
+import argparse
+import timeit
+
+from core.recipe_store import build_recipe_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-emb', '--recipe_emb_file', required=True, type=str, help='path to the pickled recipe embeddings')
+    parser.add_argument('-name2id', '--dish_name2id_file', required=True, type=str, help='path to the tab-separated recipe name mapping')
+    parser.add_argument('-dish_info', '--dish_info_file', default=None, type=str, help='path to the dish info json')
+    parser.add_argument('-out', '--out_dir', required=True, type=str, help='path to the output store dir')
+    args = parser.parse_args()
+
+    start = timeit.default_timer()
+    build_recipe_store(args.recipe_emb_file, args.dish_name2id_file, args.dish_info_file, args.out_dir)
+    print('Runtime: %ss' % (timeit.default_timer() - start))
@@ -5,6 +5,7 @@ Created on Sep, 2017
 
 '''
 import os
+import random
 import timeit
 import numpy as np
 
@@ -12,17 +13,20 @@ import torch
 from torch import optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.nn import MultiLabelMarginLoss
+from torch.nn.parallel import DistributedDataParallel
 import torch.backends.cudnn as cudnn
 
 from .modules import BAMnet
-from .utils import to_cuda, next_batch
+from .sampling import CTX_BOW_INDEX, PreparedMemory, prepare_memories, sample_ctx_memories
+from .utils import to_cuda, next_batch, is_distributed, get_rank, get_world_size, broadcast_scalar, all_reduce_mean, gather_objects
 from ..utils.utils import load_ndarray
 from ..utils.generic_utils import unique
 from ..utils.metrics import *
+from ..utils.tracing import tracer
+from ..utils.profiling import profiler
 from .. import config
 
 
-CTX_BOW_INDEX = -5
 def get_text_overlap(raw_query, query_mentions, ctx_ent_names, vocab2id, ctx_stops, query):
     def longest_common_substring(s1, s2):
        m = [[0] * (1 + len(s2)) for i in range(1 + len(s1))]
@@ -67,10 +71,27 @@ def string_search(src, tgt):
     return (start_idx, end_idx) if hit else (-1, -1)
 
 
+def make_ctx_matcher(vocab2id, ctx_stops, raw_queries, query_mentions, queries, query_marks):
+    '''Returns a function computing the (sub_seq, mark_vec) overlaps between the i-th query
+    of the batch and the context entity names of one candidate.
+    '''
+    def ctx_matches(i, ctx_ent_names_list):
+        matches = []
+        for ctx_ent_names in ctx_ent_names_list:
+            sub_seq = get_text_overlap(raw_queries[i], query_mentions[i], ctx_ent_names, vocab2id, ctx_stops, queries[i])
+            if len(sub_seq) > 0:
+                start_idx, end_idx = string_search(queries[i], sub_seq)
+                matches.append((sub_seq, query_marks[i][start_idx: end_idx].tolist()))
+        return matches
+    return ctx_matches
+
+
 class BAMnetAgent(object):
     """ Bidirectional attentive memory network agent.
+    With inference_only (serving) no optimizer or scheduler is created, and the
+    optimizer state of checkpoints is not loaded.
     """
-    def __init__(self, opt, ctx_stops, vocab2id):
+    def __init__(self, opt, ctx_stops, vocab2id, inference_only=False):
         self.ctx_stops = ctx_stops
         self.vocab2id = vocab2id
         opt['cuda'] = not opt['no_cuda'] and torch.cuda.is_available()
@@ -82,8 +103,10 @@ class BAMnetAgent(object):
             cudnn.benchmark = True
 
         self.opt = opt
-        if self.opt['pre_word2vec'] and os.path.exists(self.opt['pre_word2vec']):
-            pre_w2v = load_ndarray(self.opt['pre_word2vec'])
+        # Pretrained vectors would be overwritten right away by an existing checkpoint
+        has_checkpoint = bool(opt.get('model_file')) and os.path.isfile(opt['model_file'])
+        if not has_checkpoint and self.opt['pre_word2vec'] and os.path.exists(self.opt['pre_word2vec']):
+            pre_w2v = load_ndarray(self.opt['pre_word2vec'], mmap_mode='r')
         else:
             pre_w2v = None
 
@@ -109,10 +132,20 @@ class BAMnetAgent(object):
         # loss(x, y) = sum_ij(max(0, 1 - (x[y[j]] - x[i]))) / x.size(0)
         self.loss_fn = MultiLabelMarginLoss()
 
-        optim_params = [p for p in self.model.parameters() if p.requires_grad]
-        self.optimizer = optim.Adam(optim_params, lr=opt['learning_rate'])
-        self.scheduler = ReduceLROnPlateau(self.optimizer, mode='max', \
-                    patience=self.opt['valid_patience'] // 3)
+        self.inference_only = inference_only
+        if inference_only:
+            self.optimizer = None
+            self.scheduler = None
+        else:
+            optim_params = [p for p in self.model.parameters() if p.requires_grad]
+            self.optimizer = optim.Adam(optim_params, lr=opt['learning_rate'])
+            # The scheduler is only stepped on validation epochs, so its patience is scaled
+            # down accordingly (but kept at least 1, else it would cut the LR on every non-improving one)
+            valid_every = self.opt.get('valid_every', 1)
+            patience = self.opt['valid_patience'] // 3
+            if valid_every > 1:
+                patience = max(1, patience // valid_every)
+            self.scheduler = ReduceLROnPlateau(self.optimizer, mode='max', patience=patience)
 
         if opt.get('model_file'):
             if os.path.isfile(opt['model_file']):
@@ -121,71 +154,161 @@ class BAMnetAgent(object):
             else:
                 os.makedirs(os.path.dirname(opt['model_file']), exist_ok=True)
 
+        # Data-parallel training: the process group is set up by the caller (see train.py).
+        # self.model stays the plain BAMnet so that save/load and inference are unaffected,
+        # only training steps go through the DDP wrapper to get gradient all-reduce.
+        self.distributed = opt.get('distributed', False) and is_distributed()
+        self.rank = get_rank() if self.distributed else 0
+        self.world_size = get_world_size() if self.distributed else 1
+        if self.distributed:
+            print('[ Using DistributedDataParallel: rank {}/{} ]'.format(self.rank, self.world_size))
+            self.train_model = DistributedDataParallel(self.model, find_unused_parameters=True)
+        else:
+            self.train_model = self.model
+        self.epoch_train_times = []
+
+        if opt.get('checkpoint_dir'):
+            self.checkpoint_dir = opt['checkpoint_dir']
+        elif opt.get('model_file'):
+            self.checkpoint_dir = os.path.join(os.path.dirname(opt['model_file']), 'checkpoints')
+        else:
+            self.checkpoint_dir = None
+
         super(BAMnetAgent, self).__init__()
 
-    def train(self, train_X, train_y, valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels, seed=1234):
-        print('Training size: {}, Validation size: {}'.format(len(train_y), len(valid_y)))
-        random1 = np.random.RandomState(seed)
-        random2 = np.random.RandomState(seed)
-        random3 = np.random.RandomState(seed)
-        random4 = np.random.RandomState(seed)
-        random5 = np.random.RandomState(seed)
-        random6 = np.random.RandomState(seed)
-        random7 = np.random.RandomState(seed)
-        random8 = np.random.RandomState(seed)
+    @property
+    def is_master(self):
+        return self.rank == 0
+
+    def train(self, train_X, train_y, valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels, seed=1234, resume_from=None):
+        '''In distributed mode train_X/train_y are expected to be this worker's shard,
+        while validation only runs on rank 0 and its F1 is broadcast to all workers.
+        If resume_from is given, training continues from that checkpoint (see save_checkpoint).
+        '''
+        if self.inference_only:
+            raise RuntimeError('Cannot train an inference-only BAMnetAgent')
+        if self.is_master:
+            print('Training size: {}, Validation size: {}'.format(len(train_y) * self.world_size, len(valid_y)))
+        # The training lists stay untouched, we shuffle an index permutation instead
+        # so that the data order can be stored in (and restored from) checkpoints.
+        shuffler = np.random.RandomState(seed)
+        order = np.arange(len(train_y))
         memories, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths = train_X
+        memories = prepare_memories(memories) # Convert once instead of on every sampling call
         gold_ans_inds = train_y
 
-        valid_memories, valid_queries, valid_query_words, valid_raw_queries, valid_query_mentions, valid_query_marks, valid_query_lengths = valid_X
-        valid_gold_ans_inds = valid_y
-
-        n_incr_error = 0  # nb. of consecutive increase in error
+        # Optionally validate on a fixed random subsample (same examples every epoch)
+        valid_sample_size = self.opt.get('valid_sample_size', None)
+        if valid_sample_size and valid_sample_size < len(valid_y):
+            inds = sorted(np.random.RandomState(seed).choice(len(valid_y), valid_sample_size, replace=False).tolist())
+            valid_X = [[x[i] for i in inds] for x in valid_X]
+            valid_y = [valid_y[i] for i in inds]
+            valid_cand_labels = [valid_cand_labels[i] for i in inds]
+            valid_gold_ans_labels = [valid_gold_ans_labels[i] for i in inds]
+            if self.is_master:
+                print('Validating on a subsample of {} examples'.format(valid_sample_size))
+        valid_every = self.opt.get('valid_every', 1)
+
+        n_incr_error = 0  # nb. of consecutive epochs without improvement
         best_loss = float("inf")
         best_f1 = 0
+        start_epoch = 1
+        resume_step = 0 # nb. of batches of start_epoch which were already trained on
+        train_loss = 0
+        if resume_from:
+            state = self.load_checkpoint(resume_from)
+            start_epoch, resume_step = state['epoch'], state['step']
+            best_f1, n_incr_error, train_loss = state['best_f1'], state['n_incr_error'], state['train_loss']
+            order = np.array(state['order'])
+            shuffler.set_state(state['shuffler'])
+            if self.is_master:
+                print('Resuming training from {} (epoch {}, step {})'.format(resume_from, start_epoch, resume_step))
+
+        last_checkpoint_time = timeit.default_timer()
         num_batches = len(queries) // self.opt['batch_size'] + (len(queries) % self.opt['batch_size'] != 0)
-        num_valid_batches = len(valid_queries) // self.opt['batch_size'] + (len(valid_queries) % self.opt['batch_size'] != 0)
-        for epoch in range(1, self.opt['num_epochs'] + 1):
+        for epoch in range(start_epoch, self.opt['num_epochs'] + 1):
             start = timeit.default_timer()
-            n_incr_error += 1
-            random1.shuffle(memories)
-            random2.shuffle(queries)
-            random3.shuffle(query_words)
-            random4.shuffle(raw_queries)
-            random5.shuffle(query_mentions)
-            random6.shuffle(query_marks)
-            random7.shuffle(query_lengths)
-            random8.shuffle(gold_ans_inds)
-
-            train_gen = next_batch(memories, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths, gold_ans_inds, self.opt['batch_size'])
+            if resume_step == 0:
+                n_incr_error += 1
+                shuffler.shuffle(order)
+                train_loss = 0
+
+            train_gen = next_batch(*[[x[i] for i in order] for x in (memories, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths, gold_ans_inds)], self.opt['batch_size'])
             self.optimizer.zero_grad()
-            train_loss = 0
             for step, (batch_xs, batch_ys) in enumerate(train_gen):
+                if step < resume_step:
+                    continue
                 train_loss += self.train_step(batch_xs, batch_ys, step) / num_batches
-
-            valid_gen = next_batch(valid_memories, valid_queries, valid_query_words, valid_raw_queries, valid_query_mentions, valid_query_marks, valid_query_lengths, valid_gold_ans_inds, self.opt['batch_size'])
-            valid_loss = 0
-            for step, (batch_valid_xs, batch_valid_ys) in enumerate(valid_gen):
-                valid_loss += self.train_step(batch_valid_xs, batch_valid_ys, step, is_training=False) / num_valid_batches
-
-            pred, _ = self.predict(valid_X, valid_cand_labels, batch_size=1, margin=self.opt['test_margin'][0], silence=True)
-            predictions = [unique([valid_cand_labels[qid][x[0]] for x in each]) for qid, each in enumerate(pred)]
-            valid_f1 = calc_avg_f1(valid_gold_ans_labels, predictions, verbose=False)[-1]
-            print('Epoch {}/{}: Runtime: {}s, Train loss: {:.4}, valid loss: {:.4}, valid F1: {:.4}'.format(epoch, self.opt['num_epochs'], \
-                                                    int(timeit.default_timer() - start), train_loss, valid_loss, valid_f1))
-
-            self.scheduler.step(valid_f1)
-            if valid_f1 > best_f1:
-                best_f1 = valid_f1
-                n_incr_error = 0
-                self.save()
-
-            if n_incr_error >= self.opt['valid_patience']:
-                print('Early stopping occured. Optimization Finished!')
-                print('Best F1: {}'.format(best_f1))
-                break
-
-    def predict(self, xs, cand_labels, batch_size=32, margin=1, ys=None, verbose=False, silence=False):
+                if (step + 1) % self.opt['grad_accumulated_steps'] == 0 and step + 1 < num_batches \
+                        and self._time_for_checkpoint(last_checkpoint_time):
+                    self.save_checkpoint(epoch, step + 1, order, shuffler, best_f1, n_incr_error, train_loss)
+                    last_checkpoint_time = timeit.default_timer()
+            resume_step = 0
+            train_loss = all_reduce_mean(train_loss) if self.distributed else train_loss
+            self.epoch_train_times.append(timeit.default_timer() - start)
+
+            if epoch % valid_every != 0 and epoch != self.opt['num_epochs']:
+                if self.is_master:
+                    print('Epoch {}/{}: Runtime: {}s, Train loss: {:.4}'.format(epoch, self.opt['num_epochs'], \
+                                                        int(timeit.default_timer() - start), train_loss))
+            else:
+                valid_f1 = 0
+                if self.is_master:
+                    valid_loss, valid_f1, valid_f1_ci = self.validate(valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels)
+                    print('Epoch {}/{}: Runtime: {}s, Train loss: {:.4}, valid loss: {:.4}, valid F1: {:.4} (+/- {:.4})'.format(epoch, self.opt['num_epochs'], \
+                                                            int(timeit.default_timer() - start), train_loss, valid_loss, valid_f1, valid_f1_ci))
+                if self.distributed:
+                    # Every worker must take the same scheduler/early-stopping decisions
+                    valid_f1 = broadcast_scalar(valid_f1, src=0)
+
+                self.scheduler.step(valid_f1)
+                if valid_f1 > best_f1:
+                    best_f1 = valid_f1
+                    n_incr_error = 0
+                    if self.is_master:
+                        self.save()
+
+                if n_incr_error >= self.opt['valid_patience']:
+                    if self.is_master:
+                        print('Early stopping occured. Optimization Finished!')
+                        print('Best F1: {}'.format(best_f1))
+                    break
+
+            every_epochs = self.opt.get('checkpoint_every_epochs', 1)
+            if every_epochs and epoch % every_epochs == 0:
+                self.save_checkpoint(epoch + 1, 0, order, shuffler, best_f1, n_incr_error, 0)
+                last_checkpoint_time = timeit.default_timer()
+
+    def _time_for_checkpoint(self, last_checkpoint_time):
+        minutes = self.opt.get('checkpoint_every_minutes', None)
+        if not minutes or not self.checkpoint_dir:
+            return False
+        due = timeit.default_timer() - last_checkpoint_time >= 60 * minutes
+        # Workers' clocks differ, so rank 0 decides for everybody
+        return bool(broadcast_scalar(due, src=0)) if self.distributed else due
+
+    def validate(self, xs, ys, cand_labels, gold_ans_labels):
+        '''Computes the validation loss (over sampled candidates, as in training) and
+        the F1 (over all candidates, predicted in batches of valid_batch_size).
+        Returns (loss, avg F1, half-width of the 95% confidence interval of the F1).
+        '''
+        memories, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths = xs
+        num_batches = len(queries) // self.opt['batch_size'] + (len(queries) % self.opt['batch_size'] != 0)
+        gen = next_batch(memories, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths, ys, self.opt['batch_size'])
+        valid_loss = 0
+        for step, (batch_xs, batch_ys) in enumerate(gen):
+            valid_loss += self.train_step(batch_xs, batch_ys, step, is_training=False) / num_batches
+
+        batch_size = self.opt.get('valid_batch_size', self.opt['batch_size'])
+        pred, _ = self.predict(xs, cand_labels, batch_size=batch_size, margin=self.opt['test_margin'][0], silence=True)
+        predictions = [unique([cand_labels[qid][x[0]] for x in each]) for qid, each in enumerate(pred)]
+        f1s = np.array([calc_f1(gold, predictions[i])[-1] for i, gold in enumerate(gold_ans_labels)])
+        f1_ci = 1.96 * f1s.std(ddof=1) / np.sqrt(len(f1s)) if len(f1s) > 1 else 0.
+        return valid_loss, float(f1s.mean()), float(f1_ci)
+
+    def predict(self, xs, cand_labels, batch_size=32, margin=1, ys=None, verbose=False, silence=False, top_k=None):
         '''Prediction scores are returned in the verbose mode.
+        With top_k, only the top_k best candidates of each question are ranked.
         '''
         if not silence:
             print('Testing size: {}'.format(len(cand_labels)))
@@ -194,7 +317,7 @@ class BAMnetAgent(object):
         predictions = []
         query_attn = []
         for batch_xs, batch_cands in gen:
-            batch_pred, batch_query_attn = self.predict_step(batch_xs, batch_cands, margin, verbose=verbose)
+            batch_pred, batch_query_attn = self.predict_step(batch_xs, batch_cands, margin, verbose=verbose, top_k=top_k)
             # batch_pred = self.predict_step_agile(batch_xs, batch_cands, margin, topn=300, verbose=verbose)
             predictions.extend(batch_pred)
             query_attn.extend(batch_query_attn)
@@ -208,13 +331,14 @@ class BAMnetAgent(object):
             # Organize inputs for network
             selected_memories, new_ys, ctx_mask = self.dynamic_ctx_negative_sampling(xs[0], ys, self.opt['mem_size'], \
                                     self.opt['ans_ctx_entity_bow_size'], xs[3], xs[4], xs[1], xs[5])
-            selected_memories = [to_cuda(torch.LongTensor(np.array(x)), self.opt['cuda']) for x in zip(*selected_memories)]
+            selected_memories = [to_cuda(x, self.opt['cuda']) for x in selected_memories]
             ctx_mask = to_cuda(ctx_mask, self.opt['cuda'])
             queries = to_cuda(torch.LongTensor(xs[1]), self.opt['cuda'])
             query_words = to_cuda(torch.LongTensor(xs[2]), self.opt['cuda'])
             query_marks = to_cuda(torch.LongTensor(xs[5]), self.opt['cuda'])
             query_lengths = to_cuda(torch.LongTensor(xs[6]), self.opt['cuda'])
-            mem_hop_scores, _ = self.model(selected_memories, queries, query_marks, query_lengths, query_words, ctx_mask=None)
+            model = self.train_model if is_training else self.model
+            mem_hop_scores, _ = model(selected_memories, queries, query_marks, query_lengths, query_words, ctx_mask=None)
             # Set margin
             new_ys, mask_ys = self.pack_gold_ans(new_ys, mem_hop_scores[-1].size(1), placeholder=-1)
 
@@ -237,20 +361,23 @@ class BAMnetAgent(object):
                     self.optimizer.zero_grad()
             return loss_value
 
-    def predict_step(self, xs, cand_labels, margin, verbose=False):
+    def predict_step(self, xs, cand_labels, margin, verbose=False, top_k=None):
         self.model.train(mode=False)
         with torch.set_grad_enabled(False):
             # Organize inputs for network
             memories, ctx_mask = self.pad_ctx_memory(xs[0], self.opt['ans_ctx_entity_bow_size'], xs[3], xs[4], xs[1], xs[5])
-            memories = [to_cuda(torch.LongTensor(np.array(x)), self.opt['cuda']) for x in zip(*memories)]
+            with tracer.span('memory_to_tensors'):
+                memories = [to_cuda(torch.LongTensor(np.array(x)), self.opt['cuda']) for x in zip(*memories)]
             ctx_mask = to_cuda(ctx_mask, self.opt['cuda'])
             queries = to_cuda(torch.LongTensor(xs[1]), self.opt['cuda'])
             query_words = to_cuda(torch.LongTensor(xs[2]), self.opt['cuda'])
             query_marks = to_cuda(torch.LongTensor(xs[5]), self.opt['cuda'])
             query_lengths = to_cuda(torch.LongTensor(xs[6]), self.opt['cuda'])
-            mem_hop_scores, query_attn = self.model(memories, queries, query_marks, query_lengths, query_words, ctx_mask=None)
+            with tracer.span('bamnet_forward', batch_size=len(cand_labels)), profiler.torch_profile('bamnet_forward'):
+                mem_hop_scores, query_attn = self.model(memories, queries, query_marks, query_lengths, query_words, ctx_mask=None)
 
-            predictions = self.ranked_predictions(cand_labels, mem_hop_scores[-1].data, margin)
+            with tracer.span('rank_candidates'):
+                predictions = self.ranked_predictions(cand_labels, mem_hop_scores[-1].data, margin, top_k=top_k)
             return predictions, query_attn.cpu().numpy().tolist()
 
     # def predict_step_agile(self, xs, cand_labels, margin, topn=300, verbose=False):
@@ -290,73 +417,19 @@ class BAMnetAgent(object):
 
     def dynamic_ctx_negative_sampling(self, memories, ys, mem_size, ctx_bow_size, raw_queries, query_mentions, queries, query_marks):
         # Randomly select negative samples from the candidiate answer set
-        ctx_bow_size = max(min(max(map(len, (a for x in list(zip(*memories))[CTX_BOW_INDEX] for y in x for a in y)), default=0), ctx_bow_size), 1)
-
-        selected_memories = []
-        new_ys = []
-        ctx_mask = []
-        for i in range(len(ys)):
-            n = len(memories[i][0]) - 1 # The last element is a dummy candidate
-            num_gold = len(ys[i]) if mem_size > len(ys[i]) else \
-                    (mem_size - min(mem_size // 2, n - len(ys[i]))) # Max possible (pos, neg) pairs
-            selected_gold_inds = np.random.choice(ys[i], num_gold, replace=False).tolist() if len(ys[i]) > 0 else []
-            if n > len(ys[i]):
-                p = np.ones(n)
-                p[ys[i]] = 0
-                p = p / np.sum(p)
-                selected_inds = np.random.choice(n, min(mem_size, n) - num_gold, replace=False, p=p).tolist()
-            else:
-                selected_inds = []
-            augmented_selected_inds = selected_gold_inds + selected_inds + [-1] * max(mem_size - n, 0)
-            xx = [min(mem_size, n)] + [np.array(x)[augmented_selected_inds] for x in memories[i][:CTX_BOW_INDEX]]
-
-            ctx_bow = []
-            ctx_bow_len = []
-            ctx_marks = []
-            ctx_num = []
-            tmp_ctx_mask = np.zeros(mem_size)
-            for _, idx in enumerate(augmented_selected_inds):
-                tmp_ctx = []
-                tmp_ctx_len = []
-                tmp_ctx_marks = []
-                for ctx_ent_names in memories[i][CTX_BOW_INDEX][idx]:
-                    sub_seq = get_text_overlap(raw_queries[i], query_mentions[i], ctx_ent_names, self.vocab2id, self.ctx_stops, queries[i])
-                    if len(sub_seq) > 0:
-                        start_idx, end_idx = string_search(queries[i], sub_seq)
-                        tmp_ctx_mask[_] = 1
-                        tmp_ctx.append(sub_seq[:ctx_bow_size] + [config.RESERVED_TOKENS['PAD']] * max(0, ctx_bow_size - len(sub_seq)))
-                        tmp_ctx_len.append(max(min(ctx_bow_size, len(sub_seq)), 1))
-                        mark_vec = query_marks[i][start_idx: end_idx].tolist()
-                        mark_vec = mark_vec[:ctx_bow_size] + [0] * max(0, ctx_bow_size - len(mark_vec))
-                        tmp_ctx_marks.append(mark_vec)
-
-                ctx_bow.append(tmp_ctx)
-                ctx_bow_len.append(tmp_ctx_len)
-                ctx_num.append(len(tmp_ctx))
-                ctx_marks.append(tmp_ctx_marks)
-
-            xx += [ctx_bow, ctx_marks, ctx_bow_len, ctx_num]
-            xx += [np.array(x)[augmented_selected_inds] for x in memories[i][CTX_BOW_INDEX+1:]]
-            selected_memories.append(xx)
-            new_ys.append(list(range(num_gold)))
-            ctx_mask.append(tmp_ctx_mask)
-
-        max_ctx_num = max(max([y for x in selected_memories for y in x[CTX_BOW_INDEX]]), 1)
-        for i in range(len(selected_memories)): # Example
-            for j in range(len(selected_memories[i][-1])): # Cand
-                count = selected_memories[i][CTX_BOW_INDEX][j]
-                if count < max_ctx_num:
-                    selected_memories[i][CTX_BOW_INDEX - 3][j] += [[config.RESERVED_TOKENS['PAD']] * ctx_bow_size] * (max_ctx_num - count)
-                    selected_memories[i][CTX_BOW_INDEX - 2][j] += [[0] * ctx_bow_size] * (max_ctx_num - count)
-                    selected_memories[i][CTX_BOW_INDEX - 1][j] += [1] * (max_ctx_num - count)
-        return selected_memories, new_ys, torch.Tensor(np.array(ctx_mask))
+        if len(memories) > 0 and not isinstance(memories[0], PreparedMemory):
+            memories = prepare_memories(memories)
+        ctx_matches = make_ctx_matcher(self.vocab2id, self.ctx_stops, raw_queries, query_mentions, queries, query_marks)
+        return sample_ctx_memories(memories, ys, mem_size, ctx_bow_size, ctx_matches)
 
+    @tracer.traced('pad_ctx_memory')
     def pad_ctx_memory(self, memories, ctx_bow_size, raw_queries, query_mentions, queries, query_marks):
         cand_ans_size = max(max(map(len, list(zip(*memories))[0]), default=0) - 1, 1) # The last element is a dummy candidate
         ctx_bow_size = max(min(max(map(len, (a for x in list(zip(*memories))[CTX_BOW_INDEX] for y in x for a in y)), default=0), ctx_bow_size), 1)
 
         pad_memories = []
         ctx_mask = []
+        num_ctx_matches = 0
         for i in range(len(memories)):
             n = len(memories[i][0]) - 1 # The last element is a dummy candidate
             augmented_inds = list(range(n)) + [-1] * (cand_ans_size - n)
@@ -385,6 +458,7 @@ class BAMnetAgent(object):
                 ctx_bow_len.append(tmp_ctx_len)
                 ctx_marks.append(tmp_ctx_marks)
                 ctx_num.append(len(tmp_ctx))
+                num_ctx_matches += len(tmp_ctx)
 
             xx += [ctx_bow, ctx_marks, ctx_bow_len, ctx_num]
             xx += [np.array(x)[augmented_inds] for x in memories[i][CTX_BOW_INDEX+1:]]
@@ -399,6 +473,8 @@ class BAMnetAgent(object):
                     pad_memories[i][CTX_BOW_INDEX - 3][j] += [[config.RESERVED_TOKENS['PAD']] * ctx_bow_size] * (max_ctx_num - count)
                     pad_memories[i][CTX_BOW_INDEX - 2][j] += [[0] * ctx_bow_size] * (max_ctx_num - count)
                     pad_memories[i][CTX_BOW_INDEX - 1][j] += [1] * (max_ctx_num - count)
+        tracer.set_size('memory_width', cand_ans_size)
+        tracer.set_size('ctx_matches', num_ctx_matches)
         return pad_memories, torch.Tensor(np.array(ctx_mask))
 
     def pack_gold_ans(self, x, N, placeholder=-1):
@@ -418,26 +494,138 @@ class BAMnetAgent(object):
         new_scores = scores - (margin - 1) * gold_mask
         return new_scores
 
-    def ranked_predictions(self, cand_labels, scores, margin):
+    def ranked_predictions(self, cand_labels, scores, margin, top_k=None):
+        if top_k is not None:
+            return self.top_k_predictions(cand_labels, scores, margin, top_k)
         _, sorted_inds = scores.sort(descending=True, dim=1)
         return [[(j, scores[i][j]) for j in r if scores[i][j] + margin >= scores[i][r[0]] \
                 and cand_labels[i][j] != 'UNK'] \
                 if len(cand_labels[i]) > 0 and scores[i][r[0]] > -1e4 else [] \
                 for i, r in enumerate(sorted_inds)] # Very large negative ones are dummy candidates
 
+    def top_k_predictions(self, cand_labels, scores, margin, top_k):
+        """Like ranked_predictions, but only the top_k best non-'UNK' candidates of each
+        question are kept. torch.topk is O(n log k) instead of a full O(n log n) sort.
+        """
+        valid = np.zeros(tuple(scores.size()), dtype=bool)
+        for i, labels in enumerate(cand_labels):
+            n = min(len(labels), valid.shape[1])
+            valid[i, :n] = [x != 'UNK' for x in labels[:n]]
+        valid = torch.from_numpy(valid).to(scores.device)
+        masked_scores = scores.masked_fill(~valid, -float('inf'))
+        top_scores, top_inds = masked_scores.topk(min(top_k, scores.size(1)), dim=1)
+        best_scores, _ = scores.max(dim=1) # The margin is relative to the best candidate, as in ranked_predictions
+        return [[(j, s) for j, s in zip(top_inds[i], top_scores[i]) if s + margin >= best_scores[i]] \
+                if len(cand_labels[i]) > 0 and best_scores[i] > -1e4 else [] \
+                for i in range(scores.size(0))]
+
     def save(self, path=None):
         path = self.opt.get('model_file', None) if path is None else path
 
         if path:
             checkpoint = {}
             checkpoint['bamnet'] = self.model.state_dict()
-            checkpoint['bamnet_optim'] = self.optimizer.state_dict()
-            with open(path, 'wb') as write:
-                torch.save(checkpoint, write)
-                print('Saved model to {}'.format(path))
+            if self.optimizer is not None:
+                checkpoint['bamnet_optim'] = self.optimizer.state_dict()
+            atomic_torch_save(checkpoint, path)
+            print('Saved model to {}'.format(path))
+
+    def export_inference(self, path):
+        """Saves the model parameters only (no optimizer state), which is all serving needs."""
+        atomic_torch_save({'bamnet': self.model.state_dict()}, path)
+        print('Exported inference model to {}'.format(path))
 
     def load(self, path):
-        with open(path, 'rb') as read:
-            checkpoint = torch.load(read, map_location=lambda storage, loc: storage)
+        checkpoint = load_trusted_checkpoint(path)
+        self.model.load_state_dict(checkpoint['bamnet'])
+        # Inference exports come without optimizer state, and serving does not need it
+        if 'bamnet_optim' in checkpoint and self.optimizer is not None:
+            self.optimizer.load_state_dict(checkpoint['bamnet_optim'])
+
+    def save_checkpoint(self, epoch, step, order, shuffler, best_f1, n_incr_error, train_loss):
+        """Saves the full training state. `epoch` and `step` denote the next batch to train on.
+        Must be called by all workers in distributed mode (RNG states are gathered to rank 0).
+        """
+        if not self.checkpoint_dir:
+            return
+        rng_states = self._rng_state()
+        rng_states = gather_objects(rng_states) if self.distributed else [rng_states]
+        if not self.is_master:
+            return
+
+        checkpoint = {}
+        checkpoint['bamnet'] = self.model.state_dict()
+        checkpoint['bamnet_optim'] = self.optimizer.state_dict()
+        checkpoint['scheduler'] = self.scheduler.state_dict()
+        checkpoint['epoch'] = epoch
+        checkpoint['step'] = step
+        checkpoint['best_f1'] = best_f1
+        checkpoint['n_incr_error'] = n_incr_error
+        checkpoint['train_loss'] = train_loss
+        checkpoint['order'] = np.asarray(order).tolist()
+        checkpoint['shuffler'] = shuffler.get_state()
+        checkpoint['rng_states'] = rng_states
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = os.path.join(self.checkpoint_dir, 'checkpoint_epoch{:04d}_step{:06d}.pt'.format(epoch, step))
+        atomic_torch_save(checkpoint, path)
+        print('Saved training checkpoint to {}'.format(path))
+
+        # Keep only the last K checkpoints (at least the one just saved, all of them with None)
+        keep = self.opt.get('keep_last_checkpoints', 3)
+        if keep is not None:
+            checkpoints = list_checkpoints(self.checkpoint_dir)
+            for old in checkpoints[:max(len(checkpoints) - max(keep, 1), 0)]:
+                os.remove(old)
+
+    def load_checkpoint(self, path):
+        checkpoint = load_trusted_checkpoint(path)
         self.model.load_state_dict(checkpoint['bamnet'])
         self.optimizer.load_state_dict(checkpoint['bamnet_optim'])
+        self.scheduler.load_state_dict(checkpoint['scheduler'])
+        rng_states = checkpoint['rng_states']
+        self._set_rng_state(rng_states[self.rank] if self.rank < len(rng_states) else rng_states[0])
+        return checkpoint
+
+    def _rng_state(self):
+        state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+        if self.opt['cuda']:
+            state['cuda'] = torch.cuda.get_rng_state_all()
+        return state
+
+    def _set_rng_state(self, state):
+        random.setstate(state['python'])
+        np.random.set_state(state['numpy'])
+        torch.set_rng_state(state['torch'])
+        if self.opt['cuda'] and 'cuda' in state:
+            torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_trusted_checkpoint(path):
+    # Our checkpoints also hold RNG states and the data order, which torch >= 2.6
+    # refuses to unpickle by default (weights_only=True)
+    with open(path, 'rb') as read:
+        try:
+            return torch.load(read, map_location=lambda storage, loc: storage, weights_only=False)
+        except TypeError: # torch < 1.13 has no weights_only and unpickles everything
+            read.seek(0)
+            return torch.load(read, map_location=lambda storage, loc: storage)
+
+def atomic_torch_save(obj, path):
+    # Write to a temporary file first so that an interruption never leaves a truncated checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as write:
+        torch.save(obj, write)
+        write.flush()
+        os.fsync(write.fileno())
+    os.replace(tmp_path, path)
+
+def list_checkpoints(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    return sorted(os.path.join(checkpoint_dir, x) for x in os.listdir(checkpoint_dir) \
+                if x.startswith('checkpoint_') and x.endswith('.pt'))
+
+def find_latest_checkpoint(checkpoint_dir):
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if len(checkpoints) > 0 else None
@@ -4,6 +4,7 @@ Created on Sep, 2017
 @author: hugo
 
 '''
+import warnings
 import numpy as np
 
 import torch
@@ -85,7 +86,10 @@ class BAMnet(nn.Module):
     def init_word_emb(self, init_word_embed):
         if init_word_embed is not None:
             print('[ Using pretrained word embeddings ]')
-            self.word_emb.weight.data.copy_(torch.from_numpy(init_word_embed))
+            with warnings.catch_warnings():
+                # Zero-copy view of a (read-only) memory-mapped array, we only read from it
+                warnings.simplefilter('ignore', UserWarning)
+                self.word_emb.weight.data.copy_(torch.from_numpy(init_word_embed))
         else:
             self.word_emb.weight.data.uniform_(-0.08, 0.08)
 
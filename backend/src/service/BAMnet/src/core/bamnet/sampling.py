@@ -0,0 +1,111 @@
+'''
+Vectorized negative sampling of candidate answer memories.
+
+'''
+import numpy as np
+import torch
+
+from .. import config
+
+
+CTX_BOW_INDEX = -5
+
+class PreparedMemory(object):
+    """Candidate memory of one example with the fixed-size fields converted to
+    NumPy arrays once (instead of on every sampling call). The context/query text
+    overlaps are not cached here: the memories of the whole training set live for
+    all the epochs, so a per-candidate cache would grow to examples x candidates.
+    """
+    __slots__ = ('head', 'tail', 'ctx_ents', 'n', 'max_ctx_ent_len')
+
+    def __init__(self, memory):
+        self.head = [np.asarray(x, dtype=np.int64) for x in memory[:CTX_BOW_INDEX]]
+        self.tail = [np.asarray(x, dtype=np.int64) for x in memory[CTX_BOW_INDEX + 1:]]
+        self.ctx_ents = memory[CTX_BOW_INDEX]
+        self.n = len(memory[0]) - 1 # The last element is a dummy candidate
+        self.max_ctx_ent_len = max((len(a) for y in self.ctx_ents for a in y), default=0)
+
+    def ctx_matches(self, sel, compute):
+        """Overlaps of the selected candidates, computed once per distinct index of sel."""
+        overlaps = {}
+        matches = []
+        for idx in sel:
+            idx = int(idx) % (self.n + 1) # -1 is the dummy candidate (padding)
+            if idx not in overlaps:
+                overlaps[idx] = compute(self.ctx_ents[idx])
+            matches.append(overlaps[idx])
+        return matches
+
+def prepare_memories(memories):
+    return [x if isinstance(x, PreparedMemory) else PreparedMemory(x) for x in memories]
+
+def sample_negative_inds(num_cands, gold_inds, num_negs):
+    """For every example i, draws num_negs[i] distinct indices uniformly at random
+    (and in random order) from range(num_cands[i]) excluding gold_inds[i].
+
+    All examples are sampled at once with the random-key method: every valid index
+    gets a uniform key and the num_negs[i] smallest keys are taken, which is the same
+    distribution as np.random.choice(..., replace=False) with uniform p over non-gold ones.
+    """
+    k_max = max(num_negs, default=0)
+    if k_max == 0:
+        return [np.zeros(0, dtype=np.int64) for _ in num_negs]
+
+    keys = np.random.random_sample((len(num_cands), max(num_cands)))
+    for i, (n, y) in enumerate(zip(num_cands, gold_inds)):
+        keys[i, n:] = np.inf
+        keys[i, y] = np.inf
+    inds = np.argpartition(keys, k_max - 1, axis=1)[:, :k_max]
+    inds = np.take_along_axis(inds, np.argsort(np.take_along_axis(keys, inds, axis=1), axis=1), axis=1)
+    return [inds[i, :k] for i, k in enumerate(num_negs)]
+
+def sample_ctx_memories(memories, ys, mem_size, ctx_bow_size, ctx_matches):
+    """Selects mem_size candidates (gold ones first) per example and returns the padded
+    batch as a list of LongTensors in the layout expected by BAMnet, the new gold indices
+    and the ctx mask.
+
+    memories: list of PreparedMemory
+    ctx_matches: callable(i, ctx_ent_names_list) -> list of (sub_seq, mark_vec) for example i
+    """
+    batch_size = len(memories)
+    ctx_bow_size = max(min(max((m.max_ctx_ent_len for m in memories), default=0), ctx_bow_size), 1)
+
+    num_cands = [m.n for m in memories]
+    num_golds = []
+    gold_sels = []
+    for n, y in zip(num_cands, ys):
+        num_gold = len(y) if mem_size > len(y) else \
+                (mem_size - min(mem_size // 2, n - len(y))) # Max possible (pos, neg) pairs
+        num_golds.append(num_gold)
+        gold_sels.append(np.random.permutation(y)[:num_gold].astype(np.int64) if len(y) > 0 else np.zeros(0, dtype=np.int64))
+    num_negs = [max(min(mem_size, n) - g, 0) for n, g in zip(num_cands, num_golds)]
+    neg_sels = sample_negative_inds(num_cands, ys, num_negs)
+    sels = [np.concatenate([gold_sels[i], neg_sels[i], -np.ones(max(mem_size - num_cands[i], 0), dtype=np.int64)]) \
+            for i in range(batch_size)]
+
+    head = [np.stack([m.head[f][sel] for m, sel in zip(memories, sels)]) for f in range(len(memories[0].head))]
+    tail = [np.stack([m.tail[f][sel] for m, sel in zip(memories, sels)]) for f in range(len(memories[0].tail))]
+
+    matches = [m.ctx_matches(sel, lambda ctx_ents, i=i: ctx_matches(i, ctx_ents)) \
+                for i, (m, sel) in enumerate(zip(memories, sels))]
+    max_ctx_num = max([len(x) for row in matches for x in row] + [1])
+    ctx_bow = np.full((batch_size, mem_size, max_ctx_num, ctx_bow_size), config.RESERVED_TOKENS['PAD'], dtype=np.int64)
+    ctx_marks = np.zeros((batch_size, mem_size, max_ctx_num, ctx_bow_size), dtype=np.int64)
+    ctx_bow_len = np.ones((batch_size, mem_size, max_ctx_num), dtype=np.int64)
+    ctx_num = np.zeros((batch_size, mem_size), dtype=np.int64)
+    ctx_mask = np.zeros((batch_size, mem_size), dtype=np.float32)
+    for i, row in enumerate(matches):
+        for j, cand_matches in enumerate(row):
+            if len(cand_matches) == 0:
+                continue
+            ctx_num[i, j] = len(cand_matches)
+            ctx_mask[i, j] = 1
+            for k, (sub_seq, mark_vec) in enumerate(cand_matches):
+                ctx_bow[i, j, k, :min(len(sub_seq), ctx_bow_size)] = sub_seq[:ctx_bow_size]
+                ctx_bow_len[i, j, k] = max(min(ctx_bow_size, len(sub_seq)), 1)
+                ctx_marks[i, j, k, :min(len(mark_vec), ctx_bow_size)] = mark_vec[:ctx_bow_size]
+
+    lengths = np.array([min(mem_size, n) for n in num_cands], dtype=np.int64)
+    batch = [lengths] + head + [ctx_bow, ctx_marks, ctx_bow_len, ctx_num] + tail
+    new_ys = [list(range(g)) for g in num_golds]
+    return [torch.from_numpy(x) for x in batch], new_ys, torch.from_numpy(ctx_mask)
@@ -5,6 +5,7 @@ Created on Oct, 2017
 
 '''
 import torch
+import torch.distributed as dist
 from torch.autograd import Variable
 import numpy as np
 
@@ -23,3 +24,48 @@ def next_batch(memories, queries, query_words, raw_queries, query_mentions, quer
 def next_ent_batch(memories, queries, query_lengths, gold_inds, batch_size):
     for i in range(0, len(memories), batch_size):
         yield (memories[i: i + batch_size], queries[i: i + batch_size], query_lengths[i: i + batch_size]), gold_inds[i: i + batch_size]
+
+# Data-parallel helpers (only meaningful once torch.distributed is initialized)
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def shard_data(data, rank, world_size):
+    '''Splits every field of `data` (a list of aligned sequences) into `world_size`
+    equally sized shards and returns the shard of `rank`. Like torch's DistributedSampler,
+    the index list is padded by wrapping around so that every worker runs the same
+    number of steps (otherwise DDP's gradient all-reduce would hang).
+    '''
+    n = len(data[0])
+    total = int(np.ceil(n / world_size)) * world_size
+    inds = list(range(n))
+    inds += inds[:total - n]
+    inds = inds[rank:total:world_size]
+    return [[x[i] for i in inds] for x in data]
+
+def broadcast_scalar(value, src=0):
+    if not is_distributed():
+        return value
+    t = torch.tensor([float(value)], dtype=torch.float64)
+    dist.broadcast(t, src=src)
+    return t.item()
+
+def all_reduce_mean(value):
+    if not is_distributed():
+        return value
+    t = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.item() / get_world_size()
+
+def gather_objects(obj):
+    '''Collects a picklable object from every worker (in rank order).'''
+    if not is_distributed():
+        return [obj]
+    out = [None] * get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
@@ -8,13 +8,16 @@ import os
 import math
 import copy
 import argparse
+import multiprocessing
+from functools import lru_cache
 from itertools import count
 from rapidfuzz import fuzz, process
-from collections import defaultdict
+from collections import defaultdict, Counter
 from service.BAMnet.src.core.utils.utils import *
 from service.BAMnet.src.core.utils.generic_utils import normalize_answer, unique
 from service.BAMnet.src.core.utils.data_utils import if_filterout
 from service.BAMnet.src.core import config
+from ...utils.tracing import tracer # Relative, so that the scripts and the API each share one tracer
 
 
 Obser_Count = 500
@@ -129,6 +132,99 @@ def build_qa_vocab(qa, question_field):
             vocabs[token] += 1
     return vocabs
 
+
+# ===================================================================
+#       Parallel (map-reduce) version of build_kb_data/build_qa_vocab
+# ===================================================================
+
+@lru_cache(maxsize=2 ** 20)
+def cached_tokenize(text):
+    # Names and string values repeat a lot across the KB (e.g., ingredients)
+    return tuple(tokenize(text))
+
+def _type_tokens(types):
+    return [y for x in types for y in x.lower().split('/')[-1].split('_')]
+
+def _count_kb_node(v, entity_types, relations, vocabs, hop):
+    '''Counts one KB node the same way as build_kb_data (hop 0: topic entity, 1: neighbor, 2: 2nd-hop neighbor).'''
+    selected_types = v['type'][:ENT_TYPE_HOP]
+    entity_types.update(selected_types)
+    selected_names = v['name'][:1] + v['alias'] if hop == 0 else (v['name'] + v['alias'])[:1]
+    for x in selected_names:
+        vocabs.update(cached_tokenize(x.lower()))
+    vocabs.update(_type_tokens(selected_types))
+    if hop == 2 or not 'neighbors' in v:
+        return
+
+    for kk, vv in v['neighbors'].items():
+        if if_filterout(kk):
+            continue
+        relations[kk] += 1
+        vocabs.update(kk.lower().split('/')[-1].split('_'))
+        for nbr in vv:
+            if isinstance(nbr, str):
+                if not is_number(nbr):
+                    vocabs.update(cached_tokenize(nbr.lower()))
+            elif isinstance(nbr, (bool, float, int)):
+                continue
+            elif isinstance(nbr, dict):
+                _count_kb_node(nbr[list(nbr.keys())[0]], entity_types, relations, vocabs, hop + 1)
+            else:
+                raise RuntimeError('Unknown type: %s' % type(nbr))
+
+_shared_kb = None # Inherited by forked workers, so that the KB is not pickled
+
+def _count_kb_chunk(keys):
+    entity_types, relations, vocabs = Counter(), Counter(), Counter()
+    for k in keys:
+        if k in _shared_kb:
+            _count_kb_node(_shared_kb[k], entity_types, relations, vocabs, 0)
+    return entity_types, relations, vocabs
+
+def _count_qa_chunk(questions):
+    vocabs = Counter()
+    for text in questions:
+        vocabs.update(cached_tokenize(text.lower()))
+    return vocabs
+
+def _chunks(items, num_chunks):
+    size = max(int(math.ceil(len(items) / num_chunks)), 1)
+    return [items[i: i + size] for i in range(0, len(items), size)]
+
+def _map_reduce(func, chunks, num_workers):
+    if num_workers > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            results = pool.map(func, chunks)
+    else:
+        results = [func(x) for x in chunks]
+    return results
+
+def build_kb_data_parallel(kb, used_kbkeys=None, num_workers=None):
+    '''Same counts as build_kb_data, computed by `num_workers` processes over partitions of the KB keys.'''
+    global _shared_kb
+    num_workers = num_workers or os.cpu_count() or 1
+    keys = list(used_kbkeys) if used_kbkeys else list(kb.keys())
+    _shared_kb = kb
+    try:
+        results = _map_reduce(_count_kb_chunk, _chunks(keys, num_workers * 4), num_workers)
+    finally:
+        _shared_kb = None
+
+    entity_types, relations, vocabs = Counter(), Counter(), Counter()
+    for chunk_entity_types, chunk_relations, chunk_vocabs in results:
+        entity_types.update(chunk_entity_types)
+        relations.update(chunk_relations)
+        vocabs.update(chunk_vocabs)
+    return (Counter(), entity_types, relations, vocabs)
+
+def build_qa_vocab_parallel(qa, question_field, num_workers=None):
+    num_workers = num_workers or os.cpu_count() or 1
+    questions = [each[question_field] for each in qa]
+    vocabs = Counter()
+    for chunk_vocabs in _map_reduce(_count_qa_chunk, _chunks(questions, num_workers * 4), num_workers):
+        vocabs.update(chunk_vocabs)
+    return vocabs
+
 def delex_query_topic_ent(query, topic_ent, ent_types):
     if topic_ent == '' or len(ent_types) == 0:
         return query, None
@@ -239,6 +335,28 @@ def augment_kb_subgraph_with_similar_dishs(kb, topic_key, similar_dish_names, ad
     # print('missing dish graph ratio', 1. * missing_dish_graph_count / len(similar_dish_names))
     return new_kb_subgraph
 
+def exclude_dishes_with_ingredients(graph, ingredient_ids):
+    """View of a tag subgraph without the dishes containing any of the ingredient URIs.
+    Only the dish list is copied, the dish graphs are shared with the KG.
+    """
+    dishes = graph.get('neighbors', {}).get('tagged_dishes', None)
+    if not ingredient_ids or not dishes:
+        return graph
+
+    kept_dishes = []
+    for dish_entry in dishes:
+        dish_graph = list(dish_entry.values())[0]
+        ingredients = dish_graph.get('neighbors', {}).get('contains_ingredients', [])
+        if not any(ingredient_id in ingredient_ids for ingredient in ingredients for ingredient_id in ingredient):
+            kept_dishes.append(dish_entry)
+    if len(kept_dishes) == len(dishes):
+        return graph
+
+    view = dict(graph)
+    view['neighbors'] = dict(graph['neighbors'])
+    view['neighbors']['tagged_dishes'] = kept_dishes
+    return view
+
 
 def build_all_data(qa, kb, entity2id, entityType2id, relation2id, vocab2id,
                 pred_seed_ents=None,
@@ -287,10 +405,13 @@ def build_all_data(qa, kb, entity2id, entityType2id, relation2id, vocab2id,
                 query_marks.append(q_mark)
                 nutrition_range = each['persona'].get('nutrition_range', None)
                 guideline = each.get('guideline', None)
+                # KG ingredient URIs the dishes must not contain
+                excluded_ingredients = set(each['persona'].get('excluded_ingredient_ids', []))
             else:
                 query_marks.append({})
                 nutrition_range = None
                 guideline = None
+                excluded_ingredients = None
 
             query_mentions.append([(tokenize(x[0].lower()), x[1].lower()) for x in each['entities'] if not x[0] in topic_men])
             if answer_field in each:
@@ -310,6 +431,7 @@ def build_all_data(qa, kb, entity2id, entityType2id, relation2id, vocab2id,
                 subgraph = augment_kb_subgraph_with_similar_dishs(kb, topic_key_list[0], each['similar_recipes'].keys(), additional_dish_info)
             else:
                 subgraph = kb[topic_key_list[0]]
+            subgraph = exclude_dishes_with_ingredients(subgraph, excluded_ingredients)
 
             ans_cands, ans_path_labels, ans_cand_ids = build_ans_cands(subgraph, entity2id, entityType2id, relation2id, vocab2id, preferred_ans_type=preferred_ans_type, nutrition_range=nutrition_range, guideline=guideline, explicit_nutrition=each.get('explicit_nutrition', None), kg_augmentation=kg_augmentation)
             for tag_index in range(1, len(topic_key_list)):
@@ -317,6 +439,7 @@ def build_all_data(qa, kb, entity2id, entityType2id, relation2id, vocab2id,
                     subgraph = augment_kb_subgraph_with_similar_dishs(kb, topic_key_list[tag_index], each['similar_recipes'].keys(), additional_dish_info)
                 else:
                     subgraph = kb[topic_key_list[tag_index]]
+                subgraph = exclude_dishes_with_ingredients(subgraph, excluded_ingredients)
 
                 ans_cands_b, ans_path_labels_b, ans_cand_ids_b = build_ans_cands(subgraph, entity2id, entityType2id, relation2id, vocab2id, preferred_ans_type=preferred_ans_type, nutrition_range=nutrition_range, guideline=guideline, explicit_nutrition=each.get('explicit_nutrition', None), kg_augmentation=kg_augmentation)
 
@@ -427,11 +550,17 @@ def build_all_data(qa, kb, entity2id, entityType2id, relation2id, vocab2id,
                 cand_path_labels.append(ans_path_labels)
     return [queries, raw_queries, query_mentions, query_marks, memories, cand_labels, gold_ans_inds, gold_ans_labels, cand_path_labels, cand_ids]
 
-def build_vocab(data, kb, used_kbkeys=None, min_freq=1, question_field='qText'):
-    entities, entity_types, relations, kb_vocabs = build_kb_data(kb, used_kbkeys)
+def build_vocab(data, kb, used_kbkeys=None, min_freq=1, question_field='qText', num_workers=1):
+    '''IDs are assigned in sorted order so that rebuilding the vocabs is deterministic.
+    num_workers > 1 counts the KB and questions in parallel (same result).
+    '''
+    if num_workers > 1:
+        entities, entity_types, relations, kb_vocabs = build_kb_data_parallel(kb, used_kbkeys, num_workers=num_workers)
+    else:
+        entities, entity_types, relations, kb_vocabs = build_kb_data(kb, used_kbkeys)
 
     # Entity
-    all_entities = set({ent for ent in entities if entities[ent] >= min_freq})
+    all_entities = sorted({ent for ent in entities if entities[ent] >= min_freq})
     entity2id = dict(zip(all_entities, range(len(config.RESERVED_ENTS), len(all_entities) + len(config.RESERVED_ENTS))))
     for ent, idx in config.RESERVED_ENTS.items():
         entity2id.update({ent: idx})
@@ -439,6 +568,7 @@ def build_vocab(data, kb, used_kbkeys=None, min_freq=1, question_field='qText'):
     # Entity type
     all_ent_types = set({ent_type for ent_type in entity_types if entity_types[ent_type] >= min_freq})
     all_ent_types.update(config.extra_ent_types)
+    all_ent_types = sorted(all_ent_types)
     entityType2id = dict(zip(all_ent_types, range(len(config.RESERVED_ENT_TYPES), len(all_ent_types) + len(config.RESERVED_ENT_TYPES))))
     for ent_type, idx in config.RESERVED_ENT_TYPES.items():
         entityType2id.update({ent_type: idx})
@@ -446,17 +576,19 @@ def build_vocab(data, kb, used_kbkeys=None, min_freq=1, question_field='qText'):
     # Relation
     all_relations = set({rel for rel in relations if relations[rel] >= min_freq})
     all_relations.update(config.extra_rels)
+    all_relations = sorted(all_relations)
     relation2id = dict(zip(all_relations, range(len(config.RESERVED_RELS), len(all_relations) + len(config.RESERVED_RELS))))
     for rel, idx in config.RESERVED_RELS.items():
         relation2id.update({rel: idx})
 
     # Vocab
-    vocabs = build_qa_vocab(data, question_field)
+    vocabs = build_qa_vocab_parallel(data, question_field, num_workers=num_workers) if num_workers > 1 else build_qa_vocab(data, question_field)
     for token, count in kb_vocabs.items():
         vocabs[token] += count
     # sorted_vocabs = sorted(vocabs.items(), key=lambda d:d[1], reverse=True)
     all_tokens = set({token for token in vocabs if vocabs[token] >= min_freq})
     all_tokens.update(config.extra_vocab_tokens)
+    all_tokens = sorted(all_tokens)
     vocab2id = dict(zip(all_tokens, range(len(config.RESERVED_TOKENS), len(all_tokens) + len(config.RESERVED_TOKENS))))
     for token, idx in config.RESERVED_TOKENS.items():
         vocab2id.update({token: idx})
@@ -744,6 +876,7 @@ def build_ans_cands(graph, entity2id, entityType2id, relation2id, vocab2id, pref
     return (cand_ans_bows, cand_ans_entities, cand_ans_type_bows, cand_ans_types, cand_ans_path_bows, cand_ans_paths, cand_ans_ctx, cand_ans_topic_key_type, cand_labels), cand_ans_path_labels, cand_ids
 
 
+@tracer.traced('create_kg_view')
 def create_kg_view(raw_graph, nutrition_range, guideline, explicit_nutrition):
     if len(raw_graph['neighbors']) == 0:
         return raw_graph
@@ -11,6 +11,8 @@ from collections import defaultdict
 import numpy as np
 from scipy.sparse import *
 
+from ..utils.tracing import tracer
+
 RESERVED_TOKENS = {'PAD': 0, 'UNK': 1}
 
 
@@ -62,6 +64,7 @@ def remove_dir(path):
 #                 query.insert(start_idx, token_id)
 
 
+@tracer.traced('vectorize_data')
 def vectorize_data(queries, query_mentions, query_marks, memories, max_query_size=None, max_mem_size=None, \
                 max_ans_bow_size=1, max_ans_type_bow_size=None, max_ans_path_bow_size=None, max_ans_path_size=None, \
                 max_ans_ctx_entity_bows_size=None, max_ans_ctx_relation_bows_size=1, \
@@ -1,9 +1,14 @@
+import torch
+import numpy as np
 
 from .bamnet.bamnet import BAMnetAgent
 
 from .recipe_similarity import RecipeSimilarity
+from .recipe_store import DishInfoStore, is_recipe_store
 from .build_data.foodkg.build_data import build_all_data
 from .build_data.utils import vectorize_data
+from .utils.tracing import tracer
+from .utils.profiling import profiler
 from .utils.utils import *
 from .config import *
 
@@ -21,17 +26,15 @@ class KBQA(object):
         self.relation2id = load_json(os.path.join(config['data_dir'], 'relation2id.json'))
         self.id2entityType = {v:k for k, v in self.entityType2id.items()}
 
-        self.agent = BAMnetAgent(config, STOPWORDS, self.vocab2id)
+        self.agent = BAMnetAgent(config, STOPWORDS, self.vocab2id, inference_only=True)
         for param in self.agent.model.parameters():
             param.requires_grad = False
 
         self.augment_similar_dishs = config.get('augment_similar_dishs', False)
-        if self.augment_similar_dishs or config.get('similarity_augmented_ground_truth_answers', False):
-            self.additional_dish_info = self.load_dish_info(config.get('dish_info_file', None))
-            self.recipe_similairty = RecipeSimilarity(config.get('recipe_emb_file', None), config.get('dish_name2id_file', None))
-        else:
-            self.additional_dish_info = None
-            self.recipe_similairty = None
+        # The dish info and recipe embeddings are only loaded on first use
+        self.use_similar_dishs = self.augment_similar_dishs or config.get('similarity_augmented_ground_truth_answers', False)
+        self._additional_dish_info = None
+        self._recipe_similarity = None
 
         self.find_max_kbqa_score = -float('inf')
         self.find_min_kbqa_score = float('inf')
@@ -50,8 +53,33 @@ class KBQA(object):
 
         return data
 
-    def predict(self, cands, cand_labels, margin=100):
-        pred, query_attn = self.agent.predict(cands, cand_labels, batch_size=1, margin=margin, silence=True)
+    @property
+    def additional_dish_info(self):
+        if self._additional_dish_info is None and self.use_similar_dishs:
+            store_dir = self.config.get('recipe_store_dir', None)
+            if is_recipe_store(store_dir) and os.path.isfile(os.path.join(store_dir, 'dish_names.values.npy')):
+                self._additional_dish_info = DishInfoStore(store_dir)
+            else:
+                self._additional_dish_info = self.load_dish_info(self.config.get('dish_info_file', None))
+        return self._additional_dish_info
+
+    @property
+    def recipe_similairty(self):
+        if self._recipe_similarity is None and self.use_similar_dishs:
+            store_dir = self.config.get('recipe_store_dir', None)
+            if is_recipe_store(store_dir):
+                self._recipe_similarity = RecipeSimilarity.from_store(store_dir)
+            else:
+                self._recipe_similarity = RecipeSimilarity(self.config.get('recipe_emb_file', None), self.config.get('dish_name2id_file', None))
+        return self._recipe_similarity
+
+    def load_similar_dishs(self):
+        """Loads the dish info and the recipe embeddings (and their index) now instead of on first use."""
+        self.additional_dish_info
+        self.recipe_similairty
+
+    def predict(self, cands, cand_labels, margin=100, top_k=None):
+        pred, query_attn = self.agent.predict(cands, cand_labels, batch_size=1, margin=margin, silence=True, top_k=top_k)
         return pred, query_attn
 
     def simple_answer(self, question, topic_entity, entities):
@@ -150,7 +178,7 @@ class KBQA(object):
     def personalized_answer(self, question, topic_entity, entities, multi_tag_type='none',
                             persona={}, guideline=None, explicit_nutrition=[],
                             preferred_rel=None, preferred_answer_type=None,
-                            similar_recipes={}):
+                            similar_recipes={}, top_k=None):
         question_dict = {'qType': 'constraint',
                 'topicKey': topic_entity,
                 'multi_tag_type': multi_tag_type,
@@ -162,12 +190,14 @@ class KBQA(object):
                 'rel_path': [],
                 'similar_recipes': similar_recipes,
                 'answers': []}
-        data_vec = build_all_data([question_dict], self.local_kb, self.entity2id,
-                                self.entityType2id, self.relation2id, self.vocab2id,
-                                preferred_ans_type=preferred_answer_type,
-                                kg_augmentation=not self.config.get('no_kg_augmentation', False),
-                                augment_similar_dishs=self.augment_similar_dishs,
-                                additional_dish_info=self.additional_dish_info)
+        with tracer.span('build_all_data') as span:
+            data_vec = build_all_data([question_dict], self.local_kb, self.entity2id,
+                                    self.entityType2id, self.relation2id, self.vocab2id,
+                                    preferred_ans_type=preferred_answer_type,
+                                    kg_augmentation=not self.config.get('no_kg_augmentation', False),
+                                    augment_similar_dishs=self.augment_similar_dishs,
+                                    additional_dish_info=self.additional_dish_info)
+            span.set_size('candidates', len(data_vec[5][0]))
         queries, raw_queries, query_mentions, query_marks, memories, cand_labels, _, _, cand_rel_paths, cand_ids = data_vec
         queries, query_words, query_marks, query_lengths, memories_vec, cand_ans_types = vectorize_data(queries, query_mentions, query_marks, memories, \
                                             max_query_size=self.config['query_size'], \
@@ -179,36 +209,44 @@ class KBQA(object):
                                             verbose=False)
 
 
-        pred, query_attn = self.predict([memories_vec, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths], cand_labels)
-
-
-        max_kbqa_score = max([x[1].item() for x in pred[0]], default=1)
-        min_kbqa_score = min([x[1].item() for x in pred[0]], default=0)
-
-        answer_scores = {}
-        for x in pred[0]:
-            idx, kbqa_score = x[0].item(), x[1].item()
+        valid_cands = [self.is_valid_answer_path(rel_path, preferred_rel) and self.is_valid_answer_type(ans_type[0], preferred_answer_type) \
+                        for rel_path, ans_type in zip(cand_rel_paths[0], cand_ans_types[0])]
+        xs = [memories_vec, queries, query_words, raw_queries, query_mentions, query_marks, query_lengths]
+        if top_k is not None and not self.augment_similar_dishs:
+            # The answers are the first top_k distinct valid labels in score order, so ranking the
+            # valid candidates only, with one extra slot per duplicated label, gives the same answers.
+            # (Merging similarity scores can reorder the candidates, which needs all of them.)
+            ranked_labels = [label if valid else 'UNK' for label, valid in zip(cand_labels[0], valid_cands)]
+            valid_labels = [label for label in ranked_labels if label != 'UNK']
+            pred, query_attn = self.predict(xs, [ranked_labels], top_k=top_k + len(valid_labels) - len(set(valid_labels)))
+        else:
+            pred, query_attn = self.predict(xs, cand_labels)
 
-            if kbqa_score > self.find_max_kbqa_score:
-                self.find_max_kbqa_score = kbqa_score
-                # print('larger kbqa_score: {}'.format(self.find_max_kbqa_score))
-            if kbqa_score < self.find_min_kbqa_score:
-                self.find_min_kbqa_score = kbqa_score
-                # print('smaller kbqa_score: {}'.format(self.find_min_kbqa_score))
 
-            if self.augment_similar_dishs:
-                answer_scores[idx] = self.get_final_answer_score(kbqa_score, cand_labels[0][idx],
-                                                            similar_recipes,
-                                                            max_kbqa_score=max_kbqa_score,
-                                                            min_kbqa_score=min_kbqa_score)
-            else:
-                answer_scores[idx] = kbqa_score
+        if len(pred[0]) > 0:
+            pred_inds = torch.stack([x[0] for x in pred[0]]).cpu().numpy()
+            kbqa_scores = torch.stack([x[1] for x in pred[0]]).cpu().numpy().astype(np.float64)
+            max_kbqa_score = kbqa_scores.max()
+            min_kbqa_score = kbqa_scores.min()
+            self.find_max_kbqa_score = max(self.find_max_kbqa_score, max_kbqa_score)
+            self.find_min_kbqa_score = min(self.find_min_kbqa_score, min_kbqa_score)
+        else:
+            pred_inds = np.zeros(0, dtype=np.int64)
+            kbqa_scores = np.zeros(0)
+
+        if self.augment_similar_dishs and len(pred_inds) > 0:
+            final_scores = self.get_final_answer_scores(kbqa_scores, [cand_labels[0][idx] for idx in pred_inds],
+                                                        similar_recipes,
+                                                        max_kbqa_score=max_kbqa_score,
+                                                        min_kbqa_score=min_kbqa_score)
+        else:
+            final_scores = kbqa_scores
+        answer_scores = dict(zip(pred_inds.tolist(), final_scores.tolist()))
 
 
         best_valid_score = -float('inf')
         for idx, score in answer_scores.items():
-            if self.is_valid_answer_path(cand_rel_paths[0][idx], preferred_rel)\
-                            and self.is_valid_answer_type(cand_ans_types[0][idx][0], preferred_answer_type):
+            if valid_cands[idx]:
                 if best_valid_score < score:
                     best_valid_score = score
 
@@ -216,37 +254,56 @@ class KBQA(object):
         pred_ans = []
         pred_ans_ids = []
         pred_rel_paths = []
+        seen_ans = set()
         for idx, score in answer_scores.items():
+            if top_k is not None and len(pred_ans) >= top_k:
+                break
             if score + self.config['test_margin'][0] >= best_valid_score:
-                if not cand_labels[0][idx] in pred_ans:
-                    if self.is_valid_answer_path(cand_rel_paths[0][idx], preferred_rel) \
-                            and self.is_valid_answer_type(cand_ans_types[0][idx][0], preferred_answer_type):
+                if not cand_labels[0][idx] in seen_ans:
+                    if valid_cands[idx]:
+                        seen_ans.add(cand_labels[0][idx])
                         pred_ans.append(cand_labels[0][idx])
                         pred_ans_ids.append(cand_ids[0][idx])
                         pred_rel_paths.append(cand_rel_paths[0][idx])
         return pred_ans, pred_ans_ids, pred_rel_paths, query_attn[0] if query_attn is not None else None
 
-    def get_final_answer_score(self, kbqa_score, answer, similar_recipes, max_kbqa_score=1, min_kbqa_score=0):
-        similarity_distance = self.get_recipe_similarity_distance(answer, similar_recipes)
-        if similarity_distance < self.find_min_similarity_distance:
-            self.find_min_similarity_distance = similarity_distance
-            # print('smaller similarity_distance: {}'.format(self.find_min_similarity_distance))
+    def get_final_answer_scores(self, kbqa_scores, answers, similar_recipes, max_kbqa_score=1, min_kbqa_score=0):
+        """Vectorized over all candidate answers (kbqa_scores is an array)."""
+        similarity_distances = self.get_recipe_similarity_distances(answers, similar_recipes)
+        if len(similarity_distances) > 0:
+            self.find_min_similarity_distance = min(self.find_min_similarity_distance, similarity_distances.min())
 
-        final_score = self.merge_kbqa_similarity_score(kbqa_score, similarity_distance,
+        final_scores = self.merge_kbqa_similarity_score(kbqa_scores, similarity_distances,
                                         self.config.get('similarity_score_ratio', 0.2),
                                         max_kbqa_score=max_kbqa_score,
                                         min_kbqa_score=min_kbqa_score)
 
-        return final_score
-
-    def get_recipe_similarity_distance(self, answer, similar_recipes):
-        similarity_distance = similar_recipes.get(answer, {}).get('distance', None)
-
-        if similarity_distance is None:
-            ret_sim = self.recipe_similairty.get_cosine_distance(answer, similar_recipes)
-            similarity_distance = KBQA.max_similarity_distance if ret_sim is None else ret_sim.min()
-
-        return similarity_distance
+        return final_scores
+
+    def get_recipe_similarity_distances(self, answers, similar_recipes):
+        # Distances given in the request take precedence over the embedding ones
+        given = [similar_recipes.get(answer, {}).get('distance', None) for answer in answers]
+        similarity_distances = np.array([np.nan if x is None else x for x in given], dtype=np.float64)
+        missing = np.isnan(similarity_distances)
+        if missing.any():
+            similarity_distances[missing] = self.recipe_similairty.min_cosine_distances(
+                                                [answers[i] for i in np.where(missing)[0]],
+                                                list(similar_recipes.keys()),
+                                                default=KBQA.max_similarity_distance)
+        return similarity_distances
+
+    def get_similar_recipes(self, recipe_names, k=10):
+        """Builds the `similar_recipes` input ({name: {'distance': d}}) server-side
+        from the k nearest recipes of each of recipe_names."""
+        if self.recipe_similairty is None or len(recipe_names) == 0:
+            return {}
+
+        similar_recipes = {}
+        for neighbors in self.recipe_similairty.top_k_similar(recipe_names, k):
+            for name, distance in neighbors:
+                if not name in similar_recipes or distance < similar_recipes[name]['distance']:
+                    similar_recipes[name] = {'distance': distance}
+        return similar_recipes
 
     def merge_kbqa_similarity_score(self, kbqa_score, similarity_distance,
                                     similarity_score_ratio,
@@ -254,7 +311,10 @@ class KBQA(object):
                                     min_kbqa_score):
         """similarity_distance is cosine distance"""
         assert 0 <= similarity_score_ratio <= 1
-        transformed_kbqa_score = (kbqa_score - min_kbqa_score) / (max_kbqa_score - min_kbqa_score)
+        if max_kbqa_score == min_kbqa_score: # All candidates are tied
+            transformed_kbqa_score = np.ones_like(kbqa_score)
+        else:
+            transformed_kbqa_score = (kbqa_score - min_kbqa_score) / (max_kbqa_score - min_kbqa_score)
         transformed_similarity_score = (1 - similarity_distance + 1) / 2
 
         return (1 - similarity_score_ratio) * transformed_kbqa_score + similarity_score_ratio * transformed_similarity_score
@@ -273,13 +333,16 @@ class KBQA(object):
     def is_valid_answer_path(self, ans_path, target_ans_path):
         return target_ans_path is None or ans_path in target_ans_path
 
+    @tracer.traced('kbqa_answer')
+    @profiler.profiled('kbqa_answer', label_arg='topic_entities')
     def answer(self, question, question_type, topic_entities, entities,
                 multi_tag_type='none', persona={}, guideline=None,
-                explicit_nutrition=[], similar_recipes={}):
+                explicit_nutrition=[], similar_recipes={}, top_k=None):
         '''Input:
         question: str
         question_type: str
         topic_entities: list
+        top_k: int, max number of answers of constraint/personalized questions (all by default)
         Output:
         answer_list: list
         rel_path_list: list
@@ -320,7 +383,7 @@ class KBQA(object):
 
                 answer_list, answer_id_list, rel_path_list, query_attn = self.personalized_answer(question, \
                     topic_entities, entities, multi_tag_type=multi_tag_type, persona=persona, guideline=guideline, explicit_nutrition=explicit_nutrition, \
-                    preferred_rel=[['tagged_dishes']], preferred_answer_type=preferred_answer_type, similar_recipes=similar_recipes)
+                    preferred_rel=[['tagged_dishes']], preferred_answer_type=preferred_answer_type, similar_recipes=similar_recipes, top_k=top_k)
                 err_code = 0
                 err_msg = ''
             else:
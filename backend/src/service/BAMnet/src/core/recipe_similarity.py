@@ -1,30 +1,61 @@
-import pickle
+import os
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+
+from .recipe_store import RECIPE_EMB_FILE, StringIndex, StringList, RowNames, load_legacy_recipe_data
 
 
 class RecipeSimilarity(object):
-    """Compute recipe similarity based on pretrained recipe embeddings."""
-    def __init__(self, emb_file, name2id_mapping_file):
+    """Compute recipe similarity based on pretrained recipe embeddings.
+
+    The embeddings are kept as one contiguous L2-normalized float32 matrix
+    (one row per recipe id), so cosine similarities are plain dot products.
+    """
+    exact_search_max_rows = 20000 # Below this size brute force is as fast as any index
+
+    def __init__(self, emb_file, name2id_mapping_file, use_ann=True):
         super(RecipeSimilarity, self).__init__()
-        self.mapping = dict()
-        with open(name2id_mapping_file, 'r', encoding='utf-8') as mfile:
-            lines = mfile.read().strip().split('\n')
-            for line in lines:
-                try:
-                    name, _, r1Mid, _ = line.strip().split('\t')
-                    self.mapping[name] = r1Mid
-                except Exception as e:
-                    print(line)
-                    raise e
-
-        with open(emb_file, 'rb') as f:
-            _ = pickle.load(f)
-            ingre_emb = pickle.load(f)
-            recipe_id = pickle.load(f)
-            _ = pickle.load(f)
-
-        self.emb = {recipe_id[i]:ingre_emb[i] for i in range(len(recipe_id))}
+        mapping, recipe_id, ingre_emb = load_legacy_recipe_data(emb_file, name2id_mapping_file)
+        self._setup(mapping, recipe_id, ingre_emb, use_ann)
+
+    @classmethod
+    def from_arrays(cls, mapping, recipe_id, emb, use_ann=True):
+        """mapping: recipe name -> recipe id, recipe_id: id of each row of emb."""
+        sim = cls.__new__(cls)
+        sim._setup(mapping, recipe_id, emb, use_ann)
+        return sim
+
+    @classmethod
+    def from_store(cls, store_dir, use_ann=True):
+        """Memory-maps a store written by build_recipe_store (see recipe_store.py)."""
+        sim = cls.__new__(cls)
+        sim.emb = np.load(os.path.join(store_dir, RECIPE_EMB_FILE), mmap_mode='r')
+        sim.name2row = StringIndex(os.path.join(store_dir, 'recipe_names'))
+        sim.row2name = RowNames(StringList(os.path.join(store_dir, 'recipe_row_names')))
+        sim._build_index(use_ann)
+        return sim
+
+    def _setup(self, mapping, recipe_id, ingre_emb, use_ann):
+        id2row = {}
+        for i, rid in enumerate(recipe_id):
+            id2row[rid] = i # The last duplicate wins
+        self.emb = normalize_rows(np.asarray(ingre_emb, dtype=np.float32))
+        self.name2row = {name: id2row[rid] for name, rid in mapping.items() if rid in id2row}
+
+        # Names of the recipes of each row (for returning search results)
+        self.row2name = {}
+        for name, row in self.name2row.items():
+            if row not in self.row2name:
+                self.row2name[row] = name
+        self._build_index(use_ann)
+
+    def _build_index(self, use_ann):
+        self.index = None
+        if use_ann and len(self.emb) > RecipeSimilarity.exact_search_max_rows:
+            self.index = build_ann_index(self.emb)
+
+    def get_rows(self, recipe_names):
+        rows = (self.name2row.get(each, None) for each in recipe_names)
+        return np.array([x for x in rows if x is not None], dtype=np.int64)
 
     def get_cosine_distance(self, rec1, rec2):
         if isinstance(rec1, str):
@@ -33,10 +64,129 @@ class RecipeSimilarity(object):
         if isinstance(rec2, str):
             rec2 = [rec2]
 
-        list1 = [self.emb[self.mapping.get(each, None)] for each in rec1 if self.mapping.get(each, None) in self.emb]
-        list2 = [self.emb[self.mapping.get(each, None)] for each in rec2 if self.mapping.get(each, None) in self.emb]
-        if len(list1) > 0 and len(list2) > 0:
-            cosine_distance = 1 - cosine_similarity(list1, list2)
+        rows1 = self.get_rows(rec1)
+        rows2 = self.get_rows(rec2)
+        if len(rows1) > 0 and len(rows2) > 0:
+            cosine_distance = 1 - self.emb[rows1] @ self.emb[rows2].T
             return cosine_distance
         else:
             return None
+
+    def min_cosine_distances(self, recipe_names, reference_names, default=None):
+        """For each of recipe_names, the min cosine distance to any of reference_names,
+        computed with one matmul. Unknown recipes (or no known references) get `default`."""
+        distances = np.full(len(recipe_names), np.nan if default is None else default, dtype=np.float64)
+        ref_rows = self.get_rows(reference_names)
+        if len(ref_rows) == 0 or len(recipe_names) == 0:
+            return distances
+
+        rows = np.array([self.name2row.get(each, -1) for each in recipe_names], dtype=np.int64)
+        known = rows >= 0
+        if known.any():
+            distances[known] = 1 - (self.emb[rows[known]] @ self.emb[ref_rows].T).max(axis=1)
+        return distances
+
+    def top_k_similar(self, recipe_names, k=10, exclude_self=True):
+        """Finds the k most similar recipes for every recipe in recipe_names (batched).
+        Returns a list (one entry per query, empty for unknown recipes) of [(name, cosine distance)].
+        """
+        if isinstance(recipe_names, str):
+            recipe_names = [recipe_names]
+
+        query_rows = [self.name2row.get(each, None) for each in recipe_names]
+        known = [i for i, row in enumerate(query_rows) if row is not None]
+        results = [[] for _ in recipe_names]
+        if len(known) == 0:
+            return results
+
+        rows = np.array([query_rows[i] for i in known], dtype=np.int64)
+        # Ask for a few more to make up for the query itself and recipes without names
+        num = min(k + 1 + 4 if exclude_self else k + 4, len(self.emb))
+        if self.index is not None:
+            top_rows, top_sims = self.index.search(self.emb[rows], num)
+        else:
+            top_rows, top_sims = exact_search(self.emb, self.emb[rows], num)
+
+        for i, query_row, cand_rows, cand_sims in zip(known, rows, top_rows, top_sims):
+            for row, sim in zip(cand_rows, cand_sims):
+                if row < 0 or (exclude_self and row == query_row) or not row in self.row2name:
+                    continue
+                results[i].append((self.row2name[row], float(1 - sim)))
+                if len(results[i]) == k:
+                    break
+        return results
+
+
+def normalize_rows(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(x / norms, dtype=np.float32)
+
+def exact_search(matrix, queries, k):
+    """Brute-force inner product search, returns (rows, scores) sorted by decreasing score."""
+    scores = queries @ matrix.T
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+def build_ann_index(matrix):
+    try:
+        import faiss
+    except ImportError:
+        return IVFIndex(matrix)
+    return FaissIndex(matrix)
+
+
+class IVFIndex(object):
+    """Inverted file index (spherical k-means coarse quantizer) over L2-normalized rows.
+    A query only scores the rows of its n_probe closest clusters; when that yields
+    fewer than k rows it falls back to exact search.
+    """
+    def __init__(self, matrix, n_lists=None, n_probe=None, n_iter=10, seed=1234):
+        self.matrix = matrix
+        self.n_lists = n_lists or max(int(np.sqrt(len(matrix))), 1)
+        self.n_probe = n_probe or max(self.n_lists // 16, 4)
+
+        rng = np.random.RandomState(seed)
+        train = matrix[rng.choice(len(matrix), min(len(matrix), self.n_lists * 64), replace=False)]
+        centroids = train[rng.choice(len(train), self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            assign = np.argmax(train @ centroids.T, axis=1)
+            for c in range(self.n_lists):
+                members = train[assign == c]
+                if len(members) > 0:
+                    centroids[c] = members.sum(0)
+            centroids = normalize_rows(centroids)
+        self.centroids = centroids
+
+        assign = np.concatenate([np.argmax(matrix[i: i + 4096] @ centroids.T, axis=1) for i in range(0, len(matrix), 4096)])
+        self.lists = [np.where(assign == c)[0] for c in range(self.n_lists)]
+
+    def search(self, queries, k):
+        probe = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :self.n_probe]
+        all_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probe)):
+            cand_rows = np.concatenate([self.lists[c] for c in lists])
+            if len(cand_rows) < k:
+                rows, scores = exact_search(self.matrix, query[None], k)
+            else:
+                rows, scores = exact_search(self.matrix[cand_rows], query[None], k)
+                rows = cand_rows[rows]
+            all_rows[i, :rows.shape[1]] = rows[0]
+            all_scores[i, :rows.shape[1]] = scores[0]
+        return all_rows, all_scores
+
+
+class FaissIndex(object):
+    """HNSW index from the optional faiss package."""
+    def __init__(self, matrix, m=32):
+        import faiss
+        self.index = faiss.IndexHNSWFlat(matrix.shape[1], m, faiss.METRIC_INNER_PRODUCT)
+        self.index.add(matrix)
+
+    def search(self, queries, k):
+        scores, rows = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        return rows, scores
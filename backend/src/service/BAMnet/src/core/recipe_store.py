@@ -0,0 +1,180 @@
+'''
+Binary (memory-mappable) storage of the recipe embeddings, the recipe name index
+and the additional dish info used for similarity augmentation.
+
+A store directory contains only .npy files, so opening it is a handful of
+np.load(..., mmap_mode='r') calls and pages are read on demand:
+    recipe_embeddings.npy           L2-normalized float32 matrix, rows sorted by recipe id
+    recipe_ids.*.npy                recipe id of each row
+    recipe_row_names.*.npy          recipe name of each row ('' if unnamed)
+    recipe_names.*.npy              recipe name -> row (hash index)
+    dish_info.*.npy                 json of each dish
+    dish_names.*.npy                dish name -> dish info entry (hash index)
+
+'''
+import os
+import json
+import pickle
+import zlib
+import numpy as np
+
+
+RECIPE_EMB_FILE = 'recipe_embeddings.npy'
+
+class StringList(object):
+    """Read-only list of strings stored as one utf-8 blob plus offsets."""
+    def __init__(self, prefix, mmap_mode='r'):
+        self.blob = np.load(prefix + '.blob.npy', mmap_mode=mmap_mode)
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, i):
+        return self.blob[self.offsets[i]: self.offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        return self.get_bytes(i).decode('utf-8')
+
+    @staticmethod
+    def write(prefix, strings):
+        strings = [x.encode('utf-8') if isinstance(x, str) else x for x in strings]
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in strings], out=offsets[1:])
+        np.save(prefix + '.blob.npy', np.frombuffer(b''.join(strings), dtype=np.uint8))
+        np.save(prefix + '.offsets.npy', offsets)
+
+
+class StringIndex(object):
+    """Read-only str -> int map. Keys are hash-bucketed (crc32, which is stable
+    across processes) so a lookup only compares the few keys of one bucket.
+    """
+    def __init__(self, prefix, mmap_mode='r'):
+        self.keys = StringList(prefix + '.keys', mmap_mode=mmap_mode)
+        self.buckets = np.load(prefix + '.buckets.npy', mmap_mode=mmap_mode)
+        self.values = np.load(prefix + '.values.npy', mmap_mode=mmap_mode)
+        self.n_buckets = len(self.buckets) - 1
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        if not isinstance(key, str):
+            return default
+        key = key.encode('utf-8')
+        h = zlib.crc32(key) % self.n_buckets
+        for i in range(self.buckets[h], self.buckets[h + 1]):
+            if self.keys.get_bytes(i) == key:
+                return int(self.values[i])
+        return default
+
+    @staticmethod
+    def write(prefix, mapping):
+        keys = [k.encode('utf-8') for k in mapping.keys()]
+        values = np.array(list(mapping.values()), dtype=np.int64)
+        n_buckets = max(len(keys), 1)
+        bucket_of = np.array([zlib.crc32(k) % n_buckets for k in keys], dtype=np.int64)
+        order = np.argsort(bucket_of, kind='stable')
+        StringList.write(prefix + '.keys', [keys[i] for i in order])
+        np.save(prefix + '.buckets.npy', np.searchsorted(bucket_of[order], np.arange(n_buckets + 1)).astype(np.int64))
+        np.save(prefix + '.values.npy', values[order])
+
+
+class RowNames(object):
+    """row -> recipe name lookup of a store, rows without a name are absent."""
+    def __init__(self, names):
+        self.names = names
+
+    def __contains__(self, row):
+        return 0 <= row < len(self.names) and self.names.offsets[row] != self.names.offsets[row + 1]
+
+    def __getitem__(self, row):
+        return self.names[row]
+
+    def get(self, row, default=None):
+        return self[row] if row in self else default
+
+
+class DishInfoStore(object):
+    """Dish name -> dish graph, parsed on access (a drop-in for the json dict)."""
+    def __init__(self, store_dir, mmap_mode='r'):
+        self.index = StringIndex(os.path.join(store_dir, 'dish_names'), mmap_mode=mmap_mode)
+        self.data = StringList(os.path.join(store_dir, 'dish_info'), mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name, default=None):
+        i = self.index.get(name)
+        return default if i is None else json.loads(self.data.get_bytes(i))
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+
+def load_legacy_recipe_data(emb_file, name2id_mapping_file):
+    """Reads the pickled embeddings and the tab-separated name mapping.
+    Returns (name -> recipe id, recipe id of each row, embedding matrix)."""
+    mapping = dict()
+    with open(name2id_mapping_file, 'r', encoding='utf-8') as mfile:
+        lines = mfile.read().strip().split('\n')
+        for line in lines:
+            try:
+                name, _, r1Mid, _ = line.strip().split('\t')
+                mapping[name] = r1Mid
+            except Exception as e:
+                print(line)
+                raise e
+
+    with open(emb_file, 'rb') as f:
+        _ = pickle.load(f)
+        ingre_emb = pickle.load(f)
+        recipe_id = pickle.load(f)
+        _ = pickle.load(f)
+    return mapping, recipe_id, ingre_emb
+
+def build_recipe_store(emb_file, name2id_mapping_file, dish_info_file, out_dir):
+    from .recipe_similarity import normalize_rows
+
+    os.makedirs(out_dir, exist_ok=True)
+    mapping, recipe_id, ingre_emb = load_legacy_recipe_data(emb_file, name2id_mapping_file)
+    emb = np.asarray(ingre_emb, dtype=np.float32)
+
+    id2row = {}
+    for i, rid in enumerate(recipe_id):
+        id2row[rid] = i # The last duplicate wins
+    ids = sorted(id2row.keys())
+    emb = normalize_rows(emb[[id2row[rid] for rid in ids]])
+    id2row = {rid: i for i, rid in enumerate(ids)}
+
+    name2row = {name: id2row[rid] for name, rid in mapping.items() if rid in id2row}
+    row_names = [''] * len(ids)
+    for name, row in name2row.items():
+        if row_names[row] == '':
+            row_names[row] = name
+
+    np.save(os.path.join(out_dir, RECIPE_EMB_FILE), emb)
+    StringList.write(os.path.join(out_dir, 'recipe_ids'), [str(x) for x in ids])
+    StringList.write(os.path.join(out_dir, 'recipe_row_names'), row_names)
+    StringIndex.write(os.path.join(out_dir, 'recipe_names'), name2row)
+    print('Saved {} recipe embeddings ({} names)'.format(len(ids), len(name2row)))
+
+    if dish_info_file:
+        with open(dish_info_file, 'r') as f:
+            dish_info = json.load(f)
+        names = list(dish_info.keys())
+        StringList.write(os.path.join(out_dir, 'dish_info'), [json.dumps(dish_info[x]) for x in names])
+        StringIndex.write(os.path.join(out_dir, 'dish_names'), {x: i for i, x in enumerate(names)})
+        print('Saved info of {} dishes'.format(len(names)))
+
+def is_recipe_store(path):
+    return bool(path) and os.path.isfile(os.path.join(path, RECIPE_EMB_FILE))
@@ -4,7 +4,10 @@ Created on Oct, 2017
 @author: hugo
 
 '''
+import os
 import re, string
+import timeit
+import multiprocessing
 import numpy as np
 from rapidfuzz import fuzz, process
 
@@ -74,32 +77,6 @@ def normalize_answer(s):
 
     return white_space_fix(remove_articles(lower(s)))
 
-def load_embeddings(vocab_dict, emb_file, out_path, scale=0.08, seed=123, dtype=np.float32):
-    np.random.seed(seed)
-
-    embeddings = None
-    hit_words = set()
-    vocab_size = len(vocab_dict)
-    with open(emb_file, 'rb') as f:
-        for line in f:
-            line = line.split()
-            word = line[0].decode('utf-8')
-            idx = vocab_dict.get(word.lower(), None)
-            if idx is None or idx in hit_words:
-                continue
-
-            vec = np.array(line[1:], dtype=dtype)
-            if embeddings is None:
-                n_dims = len(vec)
-                embeddings = np.array(np.random.uniform(low=-scale, high=scale, size=(vocab_size, n_dims)), dtype=dtype)
-                embeddings[config.RESERVED_TOKENS['PAD']] = np.zeros(n_dims)
-            embeddings[idx] = vec
-            hit_words.add(idx)
-    print('Pretrained word embeddings hit ratio: {}'.format(len(hit_words) / len(vocab_dict)))
-    dump_ndarray(embeddings, out_path)
-    return embeddings
-
-
 def dump_embeddings(vocab_dict, emb_file, out_path, emb_size=300, binary=False, seed=123):
     vocab_emb = get_embeddings(emb_file, vocab_dict, binary)
 
@@ -142,28 +119,142 @@ class PreTrainEmbedding():
                 continue
         return None
 
-def load_embeddings(word2index, file_path, out_path, scale=0.08, seed=123, dtype=np.float32):
-    np.random.seed(seed)
-    hit_words = set()
-    vocab_size = len(word2index)
+def load_embeddings(word2index, file_path, out_path, scale=0.08, seed=123, dtype=np.float32, out_dtype=None, num_workers=1):
+    """Builds the (vocab_size x dim) pretrained embedding matrix for `word2index` and saves it to out_path.
 
+    file_path can be a GloVe/word2vec text file, a binary word2vec file (*.bin) or a
+    cache written by dump_embedding_cache (*.npy with a *.vocab file next to it).
+    Words are matched lowercased and the first occurrence in the file wins.
+    Text files are scanned by `num_workers` processes over byte ranges of the file.
+    out_dtype (e.g., np.float16) is the dtype of the saved matrix.
+    """
+    start = timeit.default_timer()
+    if file_path.endswith('.npy'):
+        hits = _read_embedding_cache(file_path, word2index)
+    elif file_path.endswith('.bin'):
+        hits = _read_word2vec_binary(file_path, word2index)
+    else:
+        hits = _read_text_embeddings(file_path, word2index, num_workers)
+
+    vocab_size = len(word2index)
     embeddings = None
+    if len(hits) > 0:
+        # Same random init as before: one uniform draw over the whole matrix
+        np.random.seed(seed)
+        n_dims = len(next(iter(hits.values())))
+        embeddings = np.array(np.random.uniform(low=-scale, high=scale, size=(vocab_size, n_dims)), dtype=dtype)
+        embeddings[config.RESERVED_TOKENS['PAD']] = np.zeros(n_dims)
+        for idx, vec in hits.items():
+            embeddings[idx] = vec
+        if out_dtype is not None:
+            embeddings = embeddings.astype(out_dtype)
+    print('Pretrained word embeddings hit ratio: {}'.format(len(hits) / vocab_size))
+    dump_ndarray(embeddings, out_path)
+    print('saved pretrained word embeddings to {} in {:.2f}s'.format(out_path, timeit.default_timer() - start))
+    return embeddings
+
+def _parse_embedding_lines(lines, word2index, hits):
+    for line in lines:
+        # The word ends at the first whitespace, like with line.split()
+        parts = line.split(None, 1)
+        if len(parts) < 2:
+            continue
+        # Only parse the floats of the words we need
+        idx = word2index.get(parts[0].decode('utf-8', errors='ignore').lower(), None)
+        if idx is None or idx in hits:
+            continue
+        hits[idx] = np.array(parts[1].split(), dtype=np.float32)
+    return hits
+
+def _read_text_chunk(args):
+    file_path, word2index, start, end, skip_first_line = args
+    hits = {}
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        if skip_first_line:
+            f.readline() # The header, or a partial line belonging to the previous chunk
+        lines = []
+        while f.tell() <= end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+            if len(lines) == 10000:
+                _parse_embedding_lines(lines, word2index, hits)
+                lines = []
+        _parse_embedding_lines(lines, word2index, hits)
+    return hits
+
+def _read_text_embeddings(file_path, word2index, num_workers=1):
+    with open(file_path, 'rb') as f:
+        header = f.readline().split()
+    # Skip the word2vec text header (`num_words dim`)
+    skip_header = len(header) == 2 and all(x.isdigit() for x in header)
+
+    size = os.path.getsize(file_path)
+    num_chunks = max(num_workers, 1)
+    bounds = [size * i // num_chunks for i in range(num_chunks + 1)]
+    # Chunk i owns the lines starting in [bounds[i], bounds[i + 1])
+    chunks = [(file_path, word2index, bounds[i] - 1 if i > 0 else 0, bounds[i + 1] - 1, i > 0 or skip_header) for i in range(num_chunks)]
+    if num_chunks > 1:
+        with multiprocessing.Pool(num_chunks) as pool:
+            results = pool.map(_read_text_chunk, chunks)
+    else:
+        results = [_read_text_chunk(chunks[0])]
+
+    hits = {}
+    for chunk_hits in results: # Merge in file order so that the first occurrence wins
+        for idx, vec in chunk_hits.items():
+            if idx not in hits:
+                hits[idx] = vec
+    return hits
+
+def _read_word2vec_binary(file_path, word2index):
+    hits = {}
     with open(file_path, 'rb') as f:
-        for line in f:
-            line = line.split()
-            word = line[0].decode('utf-8')
-            idx = word2index.get(word.lower(), None)
-            if idx is None or idx in hit_words:
+        num_words, n_dims = map(int, f.readline().split())
+        vec_bytes = np.dtype(np.float32).itemsize * n_dims
+        for _ in range(num_words):
+            word = bytearray()
+            while True:
+                ch = f.read(1)
+                if ch == b' ' or ch == b'':
+                    break
+                if ch != b'\n':
+                    word.extend(ch)
+            data = f.read(vec_bytes)
+            idx = word2index.get(word.decode('utf-8', errors='ignore').lower(), None)
+            if idx is None or idx in hits:
                 continue
+            hits[idx] = np.frombuffer(data, dtype=np.float32)
+    return hits
 
-            vec = np.array(line[1:], dtype=dtype)
-            if embeddings is None:
-                n_dims = len(vec)
-                embeddings = np.array(np.random.uniform(low=-scale, high=scale, size=(vocab_size, n_dims)), dtype=dtype)
-                embeddings[0] = np.zeros(n_dims)
+def _read_embedding_cache(file_path, word2index):
+    matrix = np.load(file_path, mmap_mode='r')
+    with open(file_path[:-len('.npy')] + '.vocab', 'r', encoding='utf-8') as f:
+        words = f.read().split('\n')
+    hits = {}
+    for row, word in enumerate(words):
+        idx = word2index.get(word.lower(), None)
+        if idx is None or idx in hits:
+            continue
+        hits[idx] = np.array(matrix[row], dtype=np.float32)
+    return hits
 
-            embeddings[idx] = vec
-            hit_words.add(idx)
-    print('Pretrained word embeddings hit ratio: {}'.format(len(hit_words) / vocab_size))
-    dump_ndarray(embeddings, out_path)
-    print('saved pretrained word embeddings to {}'.format(out_path))
+def dump_embedding_cache(file_path, cache_prefix, dtype=np.float32):
+    """Converts a full text embedding file into `cache_prefix`.npy + `cache_prefix`.vocab,
+    which load_embeddings reads (memory-mapped) much faster than the text file.
+    """
+    words = []
+    vecs = []
+    with open(file_path, 'rb') as f:
+        for i, line in enumerate(f):
+            parts = line.rstrip().split(b' ')
+            if i == 0 and len(parts) == 2 and all(x.isdigit() for x in parts):
+                continue
+            words.append(parts[0].decode('utf-8', errors='ignore'))
+            vecs.append(np.array(parts[1:], dtype=dtype))
+    dump_ndarray(np.stack(vecs), cache_prefix + '.npy')
+    with open(cache_prefix + '.vocab', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words))
+    print('saved embedding cache ({} words) to {}.npy/.vocab'.format(len(words), cache_prefix))
@@ -0,0 +1,165 @@
+'''
+Approximate memory accounting of the loaded KBQA state.
+
+deep_sizeof walks the objects reachable from a component and adds up
+sys.getsizeof of each, plus the buffers of numpy arrays and torch tensors.
+Memory-mapped files are reported separately as mapped bytes, since they only
+become resident when their pages are touched. Objects shared between
+components are counted once, for the first component they appear in.
+Tracemalloc snapshots (see TracemallocSnapshots) point at the allocation sites.
+'''
+import gc
+import mmap
+import sys
+import time
+import types
+import threading
+import tracemalloc
+from collections import deque
+
+import numpy as np
+import torch
+
+
+# Shared, not owned by the state (and potentially huge to walk)
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                  types.MethodType, types.CodeType, types.FrameType)
+
+
+def deep_sizeof(obj, seen=None):
+    '''Returns (bytes, mapped_bytes) reachable from obj. Pass the same `seen` set
+    to several calls to not count their shared objects twice.
+    '''
+    seen = set() if seen is None else seen
+    size = 0
+    mapped = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if obj is None or id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+
+        if isinstance(obj, mmap.mmap):
+            mapped += len(obj)
+            continue
+        size += sys.getsizeof(obj)
+        if torch.is_tensor(obj):
+            size += obj.element_size() * obj.nelement()
+            continue
+        if isinstance(obj, np.ndarray):
+            # Arrays owning their data include it in getsizeof, views refer to their base
+            stack.append(obj.base)
+            if obj.dtype == object and obj.flags.owndata:
+                stack.extend(obj.ravel().tolist())
+            continue
+        if isinstance(obj, (str, bytes, int, float, bool, complex)):
+            continue
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if isinstance(slot, str) and slot != '__dict__':
+                stack.append(getattr(obj, slot, None))
+    return size, mapped
+
+def process_rss():
+    '''Resident set size of this process in bytes (None where /proc is not available).'''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def kbqa_components(kbqa):
+    '''(name, object) pairs of the state held by a KBQA instance. The dish info and
+    recipe embeddings are None unless the similar dish options are on.
+    '''
+    agent = kbqa.agent
+    similarity = kbqa._recipe_similarity
+    return [
+        ('kbqa.local_kb', kbqa.local_kb),
+        ('kbqa.vocab2id', kbqa.vocab2id),
+        ('kbqa.entity2id', kbqa.entity2id),
+        ('kbqa.entityType2id', kbqa.entityType2id),
+        ('kbqa.relation2id', kbqa.relation2id),
+        ('kbqa.id2entityType', kbqa.id2entityType),
+        ('kbqa.additional_dish_info', kbqa._additional_dish_info),
+        ('recipe_similarity.emb', similarity.emb if similarity is not None else None),
+        ('recipe_similarity.index', similarity), # Whatever is left of it besides emb
+        ('bamnet.parameters', list(agent.model.parameters()) + list(agent.model.buffers())),
+        ('bamnet.optimizer', agent.optimizer),
+        ('bamnet.scheduler', agent.scheduler),
+    ]
+
+def memory_report(components):
+    '''Deep size of each (name, object) component, in order; None components are reported as not loaded.'''
+    gc.collect()
+    start = time.time()
+    seen = set()
+    rows = []
+    for name, obj in components:
+        if obj is None:
+            rows.append({'component': name, 'loaded': False, 'bytes': 0, 'mapped_bytes': 0})
+            continue
+        size, mapped = deep_sizeof(obj, seen)
+        rows.append({'component': name, 'loaded': True, 'bytes': size, 'mapped_bytes': mapped})
+    return {
+        'components': rows,
+        'total_bytes': sum(row['bytes'] for row in rows),
+        'total_mapped_bytes': sum(row['mapped_bytes'] for row in rows),
+        'rss_bytes': process_rss(),
+        'report_seconds': time.time() - start,
+    }
+
+
+class TracemallocSnapshots(object):
+    '''Takes tracemalloc snapshots on demand; each one is also compared to the previous one.
+    Allocations made before start() are not traced, so start it before loading the state
+    to attribute that (or set PYTHONTRACEMALLOC).
+    '''
+    def __init__(self):
+        self.previous = None
+        self._lock = threading.Lock()
+
+    def start(self, nframes=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(nframes)
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self.previous = None
+
+    def take(self, limit=20, key_type='lineno'):
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('tracemalloc is not tracing, start it first')
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            current, peak = tracemalloc.get_traced_memory()
+            result = {
+                'traced_bytes': current,
+                'peak_traced_bytes': peak,
+                'top': [{'traceback': [str(frame) for frame in stat.traceback], 'bytes': stat.size, 'count': stat.count} \
+                        for stat in snapshot.statistics(key_type)[:limit]],
+            }
+            if self.previous is not None:
+                result['top_growth'] = [{'traceback': [str(frame) for frame in stat.traceback], \
+                                        'bytes_diff': stat.size_diff, 'count_diff': stat.count_diff} \
+                                        for stat in snapshot.compare_to(self.previous, key_type)[:limit]]
+            self.previous = snapshot
+        return result
+
+
+tracemalloc_snapshots = TracemallocSnapshots()
@@ -0,0 +1,203 @@
+'''
+Opt-in profiling of the KBQA path.
+
+A call of a function decorated with profiler.profiled is profiled when it was
+requested (see Profiler.request, e.g. by an HTTP header) or, with the KBQA_PROFILE
+env var set to a fraction (1 for all), at that rate. At most max_per_minute calls
+are profiled either way. A profiled call runs under a stack-sampling profiler
+(mode 'sampling') or cProfile (mode 'cprofile'), and the blocks within it wrapped
+in profiler.torch_profile (the BAMnet forward) run under torch.profiler. Files
+are written to out_dir (KBQA_PROFILE_DIR), of which only the newest max_files
+are kept, prefixed with the profile id:
+    <id>.folded              collapsed stacks (flamegraph.pl, inferno, speedscope)
+    <id>.prof                pstats dump (snakeviz, flameprof)
+    <id>.<block>.json        chrome trace of a torch block (chrome://tracing, perfetto)
+    <id>.<block>.folded      collapsed stacks of a torch block
+'''
+import os
+import re
+import sys
+import time
+import random
+import cProfile
+import functools
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import torch
+try:
+    from torch import profiler as torch_profiler
+except ImportError: # torch < 1.8.1
+    torch_profiler = None
+
+
+def _env_sample_rate():
+    value = os.environ.get('KBQA_PROFILE', '').strip().lower()
+    if value in ('', '0', 'false', 'no', 'off'):
+        return 0.
+    try:
+        return min(max(float(value), 0.), 1.)
+    except ValueError:
+        return 1.
+
+
+class StackSampler(object):
+    '''Samples the stack of one thread every `interval` seconds into collapsed-stack counts.'''
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+class Profiler(object):
+    def __init__(self, out_dir='profiles', sample_rate=0., max_per_minute=6, mode='sampling',
+                 sampling_interval=0.001, torch_blocks=True, max_files=100):
+        assert mode in ('sampling', 'cprofile')
+        self.out_dir = out_dir
+        self.sample_rate = sample_rate
+        self.max_per_minute = max_per_minute
+        self.mode = mode
+        self.sampling_interval = sampling_interval
+        self.torch_blocks = torch_blocks
+        self.max_files = max_files
+        self._recent = deque() # Start times of the profiles of the last minute
+        self._lock = threading.Lock()
+        self._cprofile_lock = threading.Lock() # Only one cProfile can be active at a time
+        self._count = 0
+        self._requested = contextvars.ContextVar('profile_requested', default=None)
+        self._session = contextvars.ContextVar('profile_session', default=None)
+
+    @contextmanager
+    def request(self, enabled=True):
+        '''Profiles the profiled calls within the block; yields the list the ids of the profiles taken are added to.'''
+        profile_ids = []
+        token = self._requested.set(profile_ids if enabled else None)
+        try:
+            yield profile_ids
+        finally:
+            self._requested.reset(token)
+
+    def profiled(self, name, label_arg=None):
+        '''Decorator profiling the calls of fn when requested or sampled. The profile id
+        includes the (first) value of the keyword argument label_arg, e.g. the tag.
+        '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if self._session.get() is not None or not self._should_profile():
+                    return fn(*args, **kwargs)
+                return self._run_profiled(self._profile_id(name, kwargs.get(label_arg)), fn, args, kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def torch_profile(self, block):
+        '''Runs the block under torch.profiler when it is part of a profiled call.'''
+        prefix = self._session.get()
+        if prefix is None or not self.torch_blocks or torch_profiler is None:
+            yield
+            return
+
+        use_cuda = torch.cuda.is_available()
+        activities = [torch_profiler.ProfilerActivity.CPU] + ([torch_profiler.ProfilerActivity.CUDA] if use_cuda else [])
+        with torch_profiler.profile(activities=activities, record_shapes=True, with_stack=True) as prof:
+            yield
+        prof.export_chrome_trace('{}.{}.json'.format(prefix, block))
+        prof.export_stacks('{}.{}.folded'.format(prefix, block), 'self_cuda_time_total' if use_cuda else 'self_cpu_time_total')
+
+    def _should_profile(self):
+        if self._requested.get() is None and not (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_per_minute:
+                return False
+            self._recent.append(now)
+            self._count += 1
+            return True
+
+    def _profile_id(self, name, label):
+        if isinstance(label, (list, tuple)):
+            label = label[0] if len(label) > 0 else None
+        parts = [time.strftime('%Y%m%d-%H%M%S'), str(self._count), name]
+        if label:
+            parts.append(re.sub(r'[^A-Za-z0-9_.-]+', '_', str(label).rstrip('/').split('/')[-1])[:64])
+        return '-'.join(parts)
+
+    def _run_profiled(self, profile_id, fn, args, kwargs):
+        if self.mode == 'cprofile' and not self._cprofile_lock.acquire(blocking=False):
+            return fn(*args, **kwargs)
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, profile_id)
+        token = self._session.set(prefix)
+        try:
+            if self.mode == 'cprofile':
+                prof = cProfile.Profile()
+                prof.enable()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    prof.disable()
+                    prof.dump_stats(prefix + '.prof')
+                    self._cprofile_lock.release()
+            else:
+                sampler = StackSampler(threading.get_ident(), self.sampling_interval)
+                sampler.start()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    sampler.stop()
+                    sampler.write_folded(prefix + '.folded')
+        finally:
+            self._session.reset(token)
+            profile_ids = self._requested.get()
+            if profile_ids is not None:
+                profile_ids.append(profile_id)
+            print('Saved profile {} to {}'.format(profile_id, self.out_dir))
+            self._remove_old_files()
+
+    def _remove_old_files(self):
+        if not self.max_files:
+            return
+        with self._lock:
+            paths = [os.path.join(self.out_dir, name) for name in os.listdir(self.out_dir)]
+            paths = sorted((path for path in paths if os.path.isfile(path)), key=os.path.getmtime)
+            for path in paths[:max(len(paths) - self.max_files, 0)]:
+                try:
+                    os.remove(path)
+                except OSError: # Removed concurrently
+                    pass
+
+
+# Shared by the model code and the API; the API configures it from its config
+profiler = Profiler(out_dir=os.environ.get('KBQA_PROFILE_DIR', 'profiles'), sample_rate=_env_sample_rate())
@@ -0,0 +1,193 @@
+'''
+Lightweight tracing of the serving path.
+
+Spans record the duration of a stage, and optionally sizes (e.g. the number of
+candidates), into histograms which are rendered in the Prometheus text format.
+Within a request trace (see Tracer.trace) the stage durations are also collected
+per request, e.g. for a Server-Timing header. A disabled tracer hands out a
+shared no-op span.
+'''
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is the +Inf bucket
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield le, total
+
+
+class Trace(object):
+    '''Stage durations (seconds, summed over repeated stages) of one request.'''
+    def __init__(self):
+        self.durations = OrderedDict()
+        self._lock = threading.Lock() # Stages may run in the threadpool
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.) + seconds
+
+    def server_timing(self):
+        with self._lock:
+            return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in self.durations.items())
+
+
+class Span(object):
+    def __init__(self, tracer, name, sizes):
+        self.tracer = tracer
+        self.name = name
+        self.sizes = sizes
+        self._token = None
+
+    def set_size(self, name, value):
+        self.sizes[name] = value
+
+    def __enter__(self):
+        self._token = self.tracer._current_span.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self._start
+        self.tracer._current_span.reset(self._token)
+        self.tracer.observe(self.name, seconds, self.sizes)
+        return False
+
+
+class _NullSpan(object):
+    def set_size(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    def __init__(self, enabled=False, duration_buckets=DURATION_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.enabled = enabled
+        self.duration_buckets = duration_buckets
+        self.size_buckets = size_buckets
+        self._durations = OrderedDict() # stage -> Histogram
+        self._sizes = OrderedDict() # (stage, size name) -> Histogram
+        self._lock = threading.Lock()
+        self._current_span = contextvars.ContextVar('current_span', default=None)
+        self._current_trace = contextvars.ContextVar('current_trace', default=None)
+
+    def span(self, name, **sizes):
+        '''with tracer.span('stage', candidates=n) as span: ...'''
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, sizes)
+
+    def traced(self, name=None):
+        '''Decorator running the function in a span named after it.'''
+        def decorator(fn):
+            stage = name or fn.__name__
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with Span(self, stage, {}):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def set_size(self, name, value):
+        '''Records a size on the innermost active span (of this thread/task), if any.'''
+        if self.enabled:
+            span = self._current_span.get()
+            if span is not None:
+                span.set_size(name, value)
+
+    @contextmanager
+    def trace(self):
+        '''Collects the stage durations of the spans run within the block (None when disabled).'''
+        trace = Trace() if self.enabled else None
+        token = self._current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            self._current_trace.reset(token)
+
+    def observe(self, name, seconds, sizes=None):
+        with self._lock:
+            histogram = self._durations.get(name)
+            if histogram is None:
+                histogram = self._durations[name] = Histogram(self.duration_buckets)
+            histogram.observe(seconds)
+            for size_name, value in (sizes or {}).items():
+                histogram = self._sizes.get((name, size_name))
+                if histogram is None:
+                    histogram = self._sizes[(name, size_name)] = Histogram(self.size_buckets)
+                histogram.observe(value)
+        trace = self._current_trace.get()
+        if trace is not None:
+            trace.add(name, seconds)
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._sizes.clear()
+
+    def render_prometheus(self, prefix='kbqa'):
+        '''Histograms in the Prometheus text exposition format (version 0.0.4).'''
+        lines = []
+        with self._lock:
+            self._render_histograms(lines, prefix + '_stage_duration_seconds',
+                                    'Duration of the stages of the recipe request path.',
+                                    [((('stage', name),), h) for name, h in self._durations.items()])
+            self._render_histograms(lines, prefix + '_stage_size',
+                                    'Sizes (candidates, memory width, ...) seen by the stages of the recipe request path.',
+                                    [((('stage', name), ('size', size_name)), h) for (name, size_name), h in self._sizes.items()])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histograms(lines, metric, help_text, labeled_histograms):
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for labels, histogram in labeled_histograms:
+            label_str = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+            for le, count in histogram.cumulative_counts():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, label_str, _format_le(le), count))
+            lines.append('{}_sum{{{}}} {}'.format(metric, label_str, repr(float(histogram.sum))))
+            lines.append('{}_count{{{}}} {}'.format(metric, label_str, histogram.count))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_le(le):
+    return '+Inf' if le == float('inf') else repr(float(le))
+
+
+# Shared by the model code and the API; the API enables it from its config
+tracer = Tracer()
@@ -51,10 +51,14 @@ def dump_ndarray(data, path_to_file):
     except Exception as e:
         raise e
 
-def load_ndarray(path_to_file):
+def load_ndarray(path_to_file, mmap_mode=None):
     try:
-        with open(path_to_file, 'rb') as f:
-            data = np.load(f)
+        if mmap_mode:
+            # np.load needs the path (not a file object) to memory-map
+            data = np.load(path_to_file, mmap_mode=mmap_mode)
+        else:
+            with open(path_to_file, 'rb') as f:
+                data = np.load(f)
     except Exception as e:
         raise e
 
@@ -2,25 +2,23 @@ import timeit
 import argparse
 import numpy as np
 
-from core.bamnet.bamnet import BAMnetAgent
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from core.bamnet.bamnet import BAMnetAgent, find_latest_checkpoint
+from core.bamnet.utils import shard_data
 from core.build_data.utils import vectorize_data
 from core.utils.utils import *
 from core.config import *
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-config', '--config', required=True, type=str, help='path to the config file')
-    parser.add_argument('--sample', action='store_true', help='flag: run on sample data')
-    cfg = vars(parser.parse_args())
-    opt = get_config(cfg['config'])
-    print_config(opt)
-
+def load_data(opt, sample=False):
     # Ensure data is built
     train_vec = load_json(os.path.join(opt['data_dir'], opt['train_data']))
     valid_vec = load_json(os.path.join(opt['data_dir'], opt['valid_data']))
 
-    if cfg['sample']:
+    if sample:
         train_vec = [x[:5] for x in train_vec]
         valid_vec = [x[:5] for x in valid_vec]
 
@@ -40,14 +38,93 @@ if __name__ == '__main__':
                                         max_ans_path_bow_size=opt['ans_path_bow_size'], \
                                         vocab2id=vocab2id)
 
+    train_X = [train_memories, train_queries, train_query_words, train_raw_queries, train_query_mentions, train_query_marks, train_query_lengths]
+    valid_X = [valid_memories, valid_queries, valid_query_words, valid_raw_queries, valid_query_mentions, valid_query_marks, valid_query_lengths]
+    return vocab2id, train_X, train_gold_ans_inds, valid_X, valid_gold_ans_inds, valid_cand_labels, valid_gold_ans_labels
+
+def resolve_resume_path(agent, resume):
+    if resume == 'latest':
+        path = find_latest_checkpoint(agent.checkpoint_dir) if agent.checkpoint_dir else None
+        if path is None:
+            print('No checkpoint found, training from scratch')
+        return path
+    return resume
+
+def run_worker(rank, world_size, opt, sample, port, result_queue=None, resume=None):
+    '''Entry point of one CPU data-parallel worker (spawned by torch.multiprocessing).'''
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=world_size)
+    # Avoid oversubscribing the cores with intra-op threads
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(opt.get('seed', 1234))
+    np.random.seed(opt.get('seed', 1234) + rank) # Different negative samples on every worker
+
+    vocab2id, train_X, train_y, valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels = load_data(opt, sample)
+    shard = shard_data(train_X + [train_y], rank, world_size)
+    train_X, train_y = shard[:-1], shard[-1]
+
+    opt = dict(opt, distributed=True)
+    model = BAMnetAgent(opt, STOPWORDS, vocab2id)
+    model.train(train_X, train_y, valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels, resume_from=resolve_resume_path(model, resume))
+
+    if rank == 0 and result_queue is not None:
+        result_queue.put((len(train_y) * world_size, model.epoch_train_times))
+    dist.destroy_process_group()
+
+def train_distributed(opt, world_size, sample=False, port=29500, result_queue=None, resume=None):
+    mp.spawn(run_worker, args=(world_size, opt, sample, port, result_queue, resume), nprocs=world_size, join=True)
+
+def report_scaling(opt, worker_counts, num_epochs=1, sample=False, port=29500):
+    '''Trains for a few epochs with each number of workers (no checkpointing) and
+    prints throughput, speedup and scaling efficiency relative to the smallest run.
+    '''
+    opt = dict(opt, num_epochs=num_epochs, model_file=None)
+    ctx = mp.get_context('spawn')
+    results = []
+    for i, n in enumerate(worker_counts):
+        result_queue = ctx.SimpleQueue()
+        train_distributed(opt, n, sample=sample, port=port + i, result_queue=result_queue)
+        num_examples, epoch_times = result_queue.get()
+        results.append((n, num_examples, float(np.mean(epoch_times))))
+
+    base_n, _, base_time = results[0]
+    print('workers\tsec/epoch\texamples/s\tspeedup\tefficiency')
+    for n, num_examples, epoch_time in results:
+        speedup = base_time / epoch_time
+        print('{}\t{:.2f}\t{:.1f}\t{:.2f}\t{:.2%}'.format(n, epoch_time, num_examples / epoch_time, speedup, speedup * base_n / n))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', '--config', required=True, type=str, help='path to the config file')
+    parser.add_argument('--sample', action='store_true', help='flag: run on sample data')
+    parser.add_argument('--distributed', action='store_true', help='flag: data-parallel training on CPU workers (gloo backend)')
+    parser.add_argument('--num_workers', default=2, type=int, help='number of data-parallel workers')
+    parser.add_argument('--port', default=29500, type=int, help='rendezvous port for the process group')
+    parser.add_argument('--scaling', default=None, type=str, help='report scaling efficiency for these worker counts, e.g. 1,2,4,8')
+    parser.add_argument('--resume', nargs='?', const='latest', default=None, type=str, help='resume from a training checkpoint (default: the latest one)')
+    parser.add_argument('--export_inference', default=None, type=str, help='export the model in model_file without optimizer state to this path and exit')
+    parser.add_argument('--scaling_epochs', default=1, type=int, help='number of epochs per run when reporting scaling efficiency')
+    cfg = vars(parser.parse_args())
+    opt = get_config(cfg['config'])
+    print_config(opt)
+
     start = timeit.default_timer()
 
-    model_name = opt.get('model_name', 'bamnet')
-    Agent = BAMnetAgent
+    if cfg['export_inference']:
+        vocab2id = load_json(os.path.join(opt['data_dir'], 'vocab2id.json'))
+        BAMnetAgent(opt, STOPWORDS, vocab2id, inference_only=True).export_inference(cfg['export_inference'])
+    elif cfg['scaling']:
+        report_scaling(opt, [int(x) for x in cfg['scaling'].split(',')], num_epochs=cfg['scaling_epochs'], sample=cfg['sample'], port=cfg['port'])
+    elif cfg['distributed']:
+        train_distributed(opt, cfg['num_workers'], sample=cfg['sample'], port=cfg['port'], resume=cfg['resume'])
+    else:
+        vocab2id, train_X, train_y, valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels = load_data(opt, cfg['sample'])
+
+        model_name = opt.get('model_name', 'bamnet')
+        Agent = BAMnetAgent
 
-    model = Agent(opt, STOPWORDS, vocab2id)
-    model.train([train_memories, train_queries, train_query_words, train_raw_queries, train_query_mentions, train_query_marks, train_query_lengths], train_gold_ans_inds, \
-        [valid_memories, valid_queries, valid_query_words, valid_raw_queries, valid_query_mentions, valid_query_marks, valid_query_lengths], \
-        valid_gold_ans_inds, valid_cand_labels, valid_gold_ans_labels)
+        model = Agent(opt, STOPWORDS, vocab2id)
+        model.train(train_X, train_y, valid_X, valid_y, valid_cand_labels, valid_gold_ans_labels, resume_from=resolve_resume_path(model, cfg['resume']))
 
     print('Runtime: %ss' % (timeit.default_timer() - start))
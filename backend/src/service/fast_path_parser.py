@@ -0,0 +1,94 @@
+import re
+from typing import Dict, List, Optional, Set
+
+from service.ingredient_lexicon import IngredientLexicon, tokenize
+
+POSITIVE_PREPS = {"with", "including"}
+NEGATIVE_PREPS = {"without", "excluding", "no", "not"}
+SEPARATORS = {"and", "or", "but", "also", "any", "some"}
+# Tokens which mean the question has a shape the templates don't cover
+NON_TOPIC_TOKENS = {"what", "which", "how", "can", "could", "would", "i", "you", "we", "me", "make", "cook",
+                    "have", "don't", "do", "is", "are"} | POSITIVE_PREPS | NEGATIVE_PREPS
+
+_GENERIC = r"(?:dishes|recipes|dish|recipe)"
+_CLAUSES = r"(?P<clauses>(?:with|without|including|excluding|no) .+)"
+TEMPLATES = [
+    # "<topic> dishes without X", "can you suggest <topic> recipes with X and Y", "recipes with X"
+    re.compile(
+        r"^(?:(?:can|could|would) you |please )?"
+        r"(?:(?:suggest|recommend|show|find|give|list)(?: me)? |what are )?"
+        r"(?:some |any )?"
+        r"(?:(?P<topic>.+?) )?" + _GENERIC + r"(?: " + _CLAUSES + r")?$"
+    ),
+    # "what about <topic>"
+    re.compile(r"^(?:what|how) about (?P<topic>.+?)(?: " + _GENERIC + r")?$"),
+]
+
+
+class FastPathParser:
+    """
+    Rule-based parser for the most common question shapes. The question frame is
+    matched by a few compiled templates and the ingredient lists by the KG
+    ingredient lexicon; parse() returns None as soon as anything is not
+    understood so the caller can fall back to the dependency parser.
+    """
+
+    def __init__(self, lexicon: IngredientLexicon):
+        self.lexicon = lexicon
+
+    def parse(self, question_text: str) -> Optional[Dict[str, List[str]]]:
+        text = " ".join(tokenize(question_text))
+        for template in TEMPLATES:
+            match = template.match(text)
+            if match is None:
+                continue
+            topics = self._parse_topics(match.group("topic"))
+            if topics is None:
+                continue
+            likes, dislikes = set(), set()
+            clauses = match.groupdict().get("clauses")
+            if clauses and not self._parse_clauses(clauses.split(" "), likes, dislikes):
+                continue
+            return {
+                "topics": sorted(topics),
+                "likes_from_question": sorted(likes),
+                "dislikes_from_question": sorted(dislikes),
+            }
+        return None
+
+    def _parse_topics(self, topic: Optional[str]) -> Optional[Set[str]]:
+        """Splits "turkish or beef-ribs" into topics, None if it doesn't look like a topic."""
+        if not topic:
+            return set()
+        tokens = topic.split(" ")
+        if any(token in NON_TOPIC_TOKENS for token in tokens):
+            return None
+        topics, current = set(), []
+        for token in tokens + ["or"]:
+            if token in ("and", "or"):
+                if current:
+                    topics.add(" ".join(current))
+                current = []
+            else:
+                current.append(token)
+        return topics
+
+    def _parse_clauses(self, tokens: List[str], likes: Set[str], dislikes: Set[str]) -> bool:
+        """Assigns every ingredient to the set of the preceding preposition, fails on unknown words."""
+        keys = self.lexicon.keys(tokens)
+        target = None
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token in POSITIVE_PREPS or token in NEGATIVE_PREPS:
+                target = likes if token in POSITIVE_PREPS else dislikes
+                i += 1
+            elif token in SEPARATORS:
+                i += 1
+            else:
+                end, entry = self.lexicon.match_at(keys, i)
+                if target is None or entry is None:
+                    return False
+                target.add(" ".join(tokens[i:end]))
+                i = end
+        return True
@@ -0,0 +1,188 @@
+import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+_END = "$"  # Key of the (name, ingredient id) entry stored in a trie node
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, punctuation other than inner hyphens/apostrophes is dropped."""
+    return _TOKEN.findall(text.lower())
+
+
+def number_variants(token: str) -> List[str]:
+    """
+    Candidate singular and plural forms of a lowercased token ("quiches" -> "quiche",
+    "leaf" -> "leaves", ...). Used instead of the (disabled) spaCy lemmatizer: a
+    candidate only matters if it is a word of the lexicon, so wrong ones are harmless.
+    """
+    if len(token) < 3:
+        return []
+    variants = [token + "s", token + "es"]
+    if token.endswith("y"):
+        variants.append(token[:-1] + "ies")
+    elif token.endswith("f"):
+        variants.append(token[:-1] + "ves")
+    elif token.endswith("fe"):
+        variants.append(token[:-2] + "ves")
+    if token.endswith("s") and not token.endswith("ss"):
+        variants.append(token[:-1])
+        if token.endswith("es"):
+            variants.append(token[:-2])
+        if token.endswith("ies"):
+            variants.append(token[:-3] + "y")
+        elif token.endswith("ves"):
+            variants.extend((token[:-3] + "f", token[:-3] + "fe"))
+    return variants
+
+
+class IngredientLexicon:
+    """
+    Token trie over the ingredient names of the knowledge graph, mapping to
+    (canonical name, ingredient URI). The trie is keyed on the first form of each
+    word added to the lexicon, the singular and plural forms of a word get the same
+    key (see keys). Scanning a question for ingredients is a single left-to-right
+    pass with longest match, i.e. O(len(question)) for a bounded ingredient name length.
+    """
+
+    def __init__(self):
+        self.root: Dict[str, Any] = {}
+        self.word_keys: Dict[str, str] = {}  # Words of the lexicon -> trie key
+        self.num_entries = 0
+
+    def __len__(self) -> int:
+        return self.num_entries
+
+    def key(self, token: str) -> str:
+        """Trie key of a token: that of the token or of its singular/plural form in the lexicon."""
+        key = self.word_keys.get(token)
+        if key is None:
+            key = next((self.word_keys[v] for v in number_variants(token) if v in self.word_keys), token)
+        return key
+
+    def keys(self, tokens: List[str]) -> List[str]:
+        return [self.key(token) for token in tokens]
+
+    def add(self, name: str, ingredient_id: Optional[str] = None) -> None:
+        tokens = tokenize(name)
+        if not tokens:
+            return
+        keys = self.keys(tokens)
+        for token, key in zip(tokens, keys):
+            self.word_keys.setdefault(token, key)
+        node = self.root
+        for key in keys:
+            node = node.setdefault(key, {})
+        if _END not in node:  # The first URI of a name is the canonical one
+            self.num_entries += 1
+            node[_END] = (" ".join(tokens), ingredient_id)
+
+    def match_at(self, tokens: List[str], start: int) -> Tuple[int, Optional[Tuple[str, Optional[str]]]]:
+        """
+        Longest entry starting at tokens[start] (lexicon keys, see keys),
+        returns (end, (name, ingredient id)) or (start, None).
+        """
+        node = self.root
+        end, entry = start, None
+        for i in range(start, len(tokens)):
+            node = node.get(tokens[i])
+            if node is None:
+                break
+            if _END in node:
+                end, entry = i + 1, node[_END]
+        return end, entry
+
+    def find_all(self, tokens: List[str]) -> List[Tuple[int, int, Tuple[str, Optional[str]]]]:
+        """Non-overlapping leftmost-longest matches as (start, end, (name, ingredient id))."""
+        matches = []
+        i = 0
+        while i < len(tokens):
+            end, entry = self.match_at(tokens, i)
+            if entry is None:
+                i += 1
+            else:
+                matches.append((i, end, entry))
+                i = end
+        return matches
+
+    def lookup(self, phrase: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Entry of the phrase if it is exactly an ingredient name (up to singular/plural)."""
+        keys = self.keys(tokenize(phrase))
+        end, entry = self.match_at(keys, 0)
+        return entry if keys and end == len(keys) else None
+
+    def link(self, phrase: str) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Entry of a free-text ingredient phrase: the exact name if there is one, else
+        the last ingredient mentioned in it (the head of "fresh red onions" is "red onions").
+        """
+        entry = self.lookup(phrase)
+        if entry is None:
+            matches = self.find_all(self.keys(tokenize(phrase)))
+            entry = matches[-1][2] if matches else None
+        return entry
+
+    def find_mentions(self, text: str) -> List[Tuple[str, Optional[str]]]:
+        """Ingredients mentioned in a question as (surface phrase, ingredient id), in one pass."""
+        tokens = tokenize(text)
+        return [(" ".join(tokens[start:end]), entry[1]) for start, end, entry in self.find_all(self.keys(tokens))]
+
+    @classmethod
+    def from_kg_entries(cls, entries: Optional[Iterable[Dict[str, Any]]]) -> "IngredientLexicon":
+        """Builds the lexicon from the ndjson entries of the recipe KG (tag -> tagged_dishes -> contains_ingredients)."""
+        lexicon = cls()
+        for entry in entries or []:
+            for tag_data in entry.values():
+                for dish_entry in tag_data.get("neighbors", {}).get("tagged_dishes", []):
+                    for dish_data in dish_entry.values():
+                        for ingredient_entry in dish_data.get("neighbors", {}).get("contains_ingredients", []):
+                            for ingredient_uri, ingredient_data in ingredient_entry.items():
+                                for name in ingredient_data.get("name", []):
+                                    lexicon.add(name.replace("\\", ""), ingredient_uri)
+        logger.info(f"Ingredient lexicon built with {len(lexicon)} ingredient names.")
+        return lexicon
+
+
+# ===================================================================
+#   Singular/plural round trip and compound names (python ingredient_lexicon.py)
+# ===================================================================
+
+NUMBER_PAIRS = [
+    ("quiche", "quiches"), ("cookie", "cookies"), ("leaf", "leaves"), ("loaf", "loaves"),
+    ("knife", "knives"), ("tomato", "tomatoes"), ("berry", "berries"), ("peach", "peaches"),
+    ("radish", "radishes"), ("egg", "eggs"), ("red onion", "red onions"), ("bay leaf", "bay leaves"),
+]
+
+# Compound names whose head word is another ingredient: lookup must not return the head,
+# since dislike ids from it exclude dishes (disliking peanut butter is not disliking butter)
+COMPOUND_NAMES = [("peanut butter", "butter"), ("chicken broth", "broth"), ("egg noodles", "egg")]
+
+if __name__ == "__main__":
+    failures = []
+    for singular, plural in NUMBER_PAIRS:
+        for name, question in ((singular, plural), (plural, singular)):
+            lexicon = IngredientLexicon()
+            lexicon.add(name, f"http://example.com/ingredient/{name}")
+            if lexicon.lookup(question) is None or not lexicon.find_mentions(f"dishes with {question} please"):
+                failures.append((name, question))
+    print(f"{len(NUMBER_PAIRS) * 2 - len(failures)}/{len(NUMBER_PAIRS) * 2} round trips linked")
+    for name, question in failures:
+        print(f"  lexicon name {name!r} does not link {question!r}")
+
+    compound_failures = []
+    for compound, head in COMPOUND_NAMES:
+        lexicon = IngredientLexicon()
+        lexicon.add(head, f"http://example.com/ingredient/{head}")
+        head_only = lexicon.lookup(compound)
+        lexicon.add(compound, f"http://example.com/ingredient/{compound}")
+        both = lexicon.lookup(compound)
+        if head_only is not None or both is None or both[1] != f"http://example.com/ingredient/{compound}":
+            compound_failures.append((compound, head))
+    print(f"{len(COMPOUND_NAMES) - len(compound_failures)}/{len(COMPOUND_NAMES)} compound names looked up exactly")
+    for compound, head in compound_failures:
+        print(f"  {compound!r} is confused with {head!r}")
+    if failures or compound_failures:
+        raise SystemExit(1)
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import re
+import string
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION = re.compile("[{}]".format(re.escape(string.punctuation)))
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question_text: str) -> str:
+    """Cache key of a question: case, punctuation and whitespace are folded."""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", question_text.lower())).strip()
+
+
+class ParseCache:
+    """
+    Bounded LRU cache of the (user-independent) entities extracted from a question,
+    keyed on the normalized question. It can be persisted to a JSON file so it
+    survives restarts.
+    """
+
+    def __init__(self, max_size: int = 10000, path: Optional[str] = None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict[str, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[Dict[str, List[str]]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Dict[str, List[str]]) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+        }
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load the parse cache from {path}: {e}")
+            return
+        for key, value in entries:  # Saved from the least to the most recently used
+            self.put(key, value)
+        logger.info(f"Loaded {len(self._entries)} cached question parses from {path}")
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved {len(entries)} cached question parses to {path}")
+
+
+def read_query_log(path: str, max_queries: Optional[int] = None) -> Iterable[str]:
+    """Questions of a query log: one per line, either plain text or a JSON object with a "question" field."""
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if max_queries is not None and i >= max_queries:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                try:
+                    line = json.loads(line).get("question", "")
+                except ValueError:
+                    pass
+            if line:
+                yield line
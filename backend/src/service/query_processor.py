@@ -1,5 +1,16 @@
+import os
+import time
+from collections import Counter
+
 import spacy
-from typing import Dict, List, Set
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from service.fast_path_parser import FastPathParser
+from service.ingredient_lexicon import IngredientLexicon
+from service.parse_cache import ParseCache, normalize_question, read_query_log
+
+# Only the POS tags and dependency labels are used, the other components are skipped
+DISABLED_COMPONENTS = ["ner", "lemmatizer"]
 
 class QueryProcessor:
     """
@@ -7,18 +18,103 @@ class QueryProcessor:
     ingredients, then merges them with a user's saved preferences and request data.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        batch_size: int = 64,
+        cache_size: int = 10000,
+        cache_file: Optional[str] = None,
+        query_log_file: Optional[str] = None,
+        lexicon: Optional[IngredientLexicon] = None,
+        fast_path: bool = True,
+        nlp: Optional[spacy.language.Language] = None,
+    ):
         """
-        Initializes the QueryProcessor by loading the spaCy NLP model.
+        Initializes the QueryProcessor by loading the spaCy NLP model (unless an
+        already loaded one is given, see load_nlp), then warms the
+        parse cache from the query log if there is one. With an ingredient
+        lexicon, the extracted ingredients are linked to KG ingredient ids and
+        common question shapes can be parsed by the rule-based fast path.
         """
+        self.batch_size = batch_size
+        self.cache = ParseCache(max_size=cache_size, path=cache_file)
+        self.lexicon = lexicon if lexicon is not None and len(lexicon) > 0 else None
+        self.fast_path = FastPathParser(self.lexicon) if fast_path and self.lexicon is not None else None
+        self.path_counts = Counter()  # Questions served by the cache, the fast path and spaCy
+        self.nlp = nlp if nlp is not None else self.load_nlp()
+
+        if query_log_file and os.path.isfile(query_log_file):
+            start = time.perf_counter()
+            num_parsed = self.warm_up(read_query_log(query_log_file, max_queries=cache_size))
+            print(f"QueryProcessor parse cache warmed with {num_parsed} questions in {time.perf_counter() - start:.2f}s.")
+
+    @staticmethod
+    def load_nlp() -> spacy.language.Language:
+        """Loads the spaCy model without the components the parsing rules don't need."""
         try:
-            self.nlp = spacy.load("en_core_web_sm")
-            print("QueryProcessor initialized: spaCy model loaded.")
+            nlp = spacy.load("en_core_web_sm", disable=DISABLED_COMPONENTS)
+            print(f"QueryProcessor: spaCy model loaded with pipes {nlp.pipe_names}.")
+            return nlp
         except OSError:
             print("\n[ERROR] spaCy model 'en_core_web_sm' not found.")
             print("Please run: python -m spacy download en_core_web_sm\n")
             raise
 
+    def warm_up(self, question_texts: Iterable[str]) -> int:
+        """Parses the questions which are not cached yet (without counting cache lookups)."""
+        pending = {}
+        for question_text in question_texts:
+            key = normalize_question(question_text)
+            if key not in self.cache and key not in pending:
+                pending[key] = question_text
+        self._parse_uncached(pending, count=False)
+        return len(pending)
+
+    def _parse_uncached(
+        self,
+        pending: Dict[str, str],
+        batch_size: Optional[int] = None,
+        count: bool = True,
+    ) -> Dict[str, Dict[str, List[str]]]:
+        """Parses {cache key: question} with the fast path, then spaCy for the rest, and caches the results."""
+        parsed = {}
+        if self.fast_path is not None:
+            for key, question_text in pending.items():
+                entities = self.fast_path.parse(question_text)
+                if entities is not None:
+                    parsed[key] = entities
+        if count:
+            self.path_counts["fast_path"] += len(parsed)
+            self.path_counts["spacy"] += len(pending) - len(parsed)
+
+        remaining = {key: question_text for key, question_text in pending.items() if key not in parsed}
+        if len(remaining) == 1:
+            key, question_text = next(iter(remaining.items()))
+            parsed[key] = self._extract_entities_from_question(question_text)
+        elif remaining:
+            docs = self.nlp.pipe(remaining.values(), batch_size=batch_size or self.batch_size)
+            for key, doc in zip(remaining.keys(), docs):
+                parsed[key] = self._extract_entities_from_doc(doc)
+
+        for key, entities in parsed.items():
+            if self.lexicon is not None:
+                entities["ingredient_mentions"] = self.lexicon.find_mentions(pending[key])
+            self.cache.put(key, entities)
+        return parsed
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
+
+    def path_stats(self) -> Dict[str, Any]:
+        """Number and fraction of the processed questions served by each parsing path."""
+        total = sum(self.path_counts.values())
+        return {
+            path: {"count": self.path_counts[path], "fraction": self.path_counts[path] / total if total else 0.0}
+            for path in ("cache", "fast_path", "spacy")
+        }
+
+    def save_cache(self) -> None:
+        self.cache.save()
+
     def _get_full_noun_phrase(self, token: spacy.tokens.Token) -> str:
         """
         Recursively finds the full noun phrase for a given token,
@@ -43,8 +139,10 @@ class QueryProcessor:
         Uses dependency parsing to extract topics, liked ingredients, and
         disliked ingredients from a question.
         """
-        doc = self.nlp(question_text)
-        
+        return self._extract_entities_from_doc(self.nlp(question_text))
+
+    def _extract_entities_from_doc(self, doc: spacy.tokens.Doc) -> Dict[str, List[str]]:
+        """Extracts the entities from an already parsed question."""
         topics = set()
         likes = set()
         dislikes = set()
@@ -109,17 +207,94 @@ class QueryProcessor:
         """
         The main public method to process a query.
         """
-        extracted_entities = self._extract_entities_from_question(question_text)
-    
-        
+        key = normalize_question(question_text)
+        extracted_entities = self.cache.get(key)
+        if extracted_entities is None:
+            extracted_entities = self._parse_uncached({key: question_text})[key]
+        else:
+            self.path_counts["cache"] += 1
+        # User preferences are merged after the cache so cached parses are shared by all users
+        return self._merge_preferences(extracted_entities, user_prohibited)
+
+    def process_queries(
+        self,
+        question_texts: List[str],
+        user_prohibited: Iterable[List[str]],
+        batch_size: Optional[int] = None,
+    ) -> List[Dict[str, List[str]]]:
+        """
+        Batched version of process_query: the questions which are neither cached
+        nor handled by the fast path go through nlp.pipe, one list of prohibited
+        ingredients per question.
+        """
+        keys = [normalize_question(question_text) for question_text in question_texts]
+        extracted = [self.cache.get(key) for key in keys]
+        pending = {}
+        for key, question_text, entities in zip(keys, question_texts, extracted):
+            if entities is None and key not in pending:
+                pending[key] = question_text
+            elif entities is not None:
+                self.path_counts["cache"] += 1
+
+        parsed = self._parse_uncached(pending, batch_size=batch_size)
+
+        return [
+            self._merge_preferences(entities if entities is not None else parsed[key], prohibited)
+            for key, entities, prohibited in zip(keys, extracted, user_prohibited)
+        ]
+
+    def _merge_preferences(
+        self,
+        extracted_entities: Dict[str, List[str]],
+        user_prohibited: List[str],
+    ) -> Dict[str, List[str]]:
         saved_dislikes = set(user_prohibited)
         question_dislikes = set(extracted_entities["dislikes_from_question"])
         merged_dislikes = sorted(list(saved_dislikes.union(question_dislikes)))
+        final_likes = sorted(list(set(extracted_entities["likes_from_question"])))
 
-        return {
-            "final_likes": sorted(list(set(extracted_entities["likes_from_question"]))),
+        processed = {
+            "final_likes": final_likes,
             "final_dislikes": merged_dislikes,
         }
+        if self.lexicon is not None:
+            processed.update(self._link_ingredients(final_likes, merged_dislikes, extracted_entities))
+        return processed
+
+    def _link_ingredients(
+        self,
+        likes: List[str],
+        dislikes: List[str],
+        extracted_entities: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """
+        Canonical KG ingredient ids of the likes/dislikes, and the phrases of the
+        question which mention them (so they can be marked in the query even when
+        the wording differs, e.g. a saved "red onion" and "red onions" in the question).
+        The ids only come from exact ingredient names, as dishes are excluded by them:
+        the head-word fallback of IngredientLexicon.link ("peanut butter" -> butter)
+        is only used for the mentions, which are soft constraints of the model.
+        """
+        mentions: Dict[str, List[str]] = {}
+        for phrase, ingredient_id in extracted_entities.get("ingredient_mentions", []):
+            mentions.setdefault(ingredient_id, []).append(phrase)
+
+        linked = {}
+        for ids_key, mentions_key, phrases in (
+            ("final_like_ids", "like_mentions", likes),
+            ("final_dislike_ids", "dislike_mentions", dislikes),
+        ):
+            exact_ids, linked_ids = set(), set()
+            for phrase in phrases:
+                entry = self.lexicon.lookup(phrase)
+                if entry is not None and entry[1] is not None:
+                    exact_ids.add(entry[1])
+                entry = entry or self.lexicon.link(phrase)
+                if entry is not None and entry[1] is not None:
+                    linked_ids.add(entry[1])
+            linked[ids_key] = sorted(exact_ids)
+            linked[mentions_key] = sorted({m for i in linked_ids for m in mentions.get(i, [])})
+        return linked
 
 # ===================================================================
 #                      Example Usage (for testing)
@@ -1,6 +1,6 @@
 import json
 import logging
-from typing import List, Dict, Any, Optional
+from typing import Iterator, List, Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +18,12 @@ class RecipeDataExtractor:
         self.kg_path = kg_path
         print(f"Initializing RecipeDataExtractor with kg_path: {self.kg_path}")
         self.data = self._load_data()
+        # Tag URL -> tag data, and the dish lookup maps of the tags requested so far
+        self._tag_index: Dict[str, Dict[str, Any]] = {}
+        for entry in self.data or []:
+            for tag_url, tag_data in entry.items():
+                self._tag_index.setdefault(tag_url, tag_data)  # The first entry of a tag wins, as in a scan
+        self._tag_dishes: Dict[str, Dict[str, Dict[str, Any]]] = {}
         if self.data:
             logger.info(f"RecipeDataExtractor initialized successfully with data from '{kg_path}'.")
         else:
@@ -86,39 +92,36 @@ class RecipeDataExtractor:
         """
         Extracts and formats information for a list of dishes under a specific tag.
         """
-        results = []
+        return list(self.iter_dishes_by_urls(tag_url, dish_urls))
+
+    def iter_dishes_by_urls(self, tag_url: str, dish_urls: List[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Like get_dishes_by_urls, but formats the dishes lazily (in the order of
+        dish_urls) so callers can stream them.
+        """
         if not self.data:
             logger.warning("Cannot get dishes; KG data is not loaded.")
-            return results
+            return
 
-        tag_data = None
-        for entry in self.data:
-            if tag_url in entry:
-                tag_data = entry[tag_url]
-                break
-        if tag_data is None:
+        dishes_map = self._get_tag_dishes(tag_url)
+        if dishes_map is None:
             logger.warning(f"Tag URL '{tag_url}' not found in the knowledge graph.")
-            return results
-
-        tagged_dishes = tag_data.get("neighbors", {}).get("tagged_dishes", [])
-
-
-        if tag_data is None:
-            print(f"Error: Tag URL '{tag_url}' not found in the JSON file.")
-            return results
-
-        tagged_dishes = tag_data.get("neighbors", {}).get("tagged_dishes", [])
-        
-        # Create a lookup map for efficient searching
-        dishes_map = {k: v for dish_entry in tagged_dishes for k, v in dish_entry.items()}
+            return
 
         for url in dish_urls: 
             if url in dishes_map:
                 raw_dish_data = dishes_map[url]
                 # Pass the dish URL to the processing function
-                processed_data = self._process_dish_data(url, raw_dish_data)
-                results.append(processed_data)
+                yield self._process_dish_data(url, raw_dish_data)
             else:
                 logger.warning(f"Dish URL '{url}' not found under the tag '{tag_url}'.")
-        
-        return results
\ No newline at end of file
+
+    def _get_tag_dishes(self, tag_url: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Dish URL -> dish data of a tag, built on first use instead of scanning the KG on every request."""
+        if tag_url not in self._tag_dishes:
+            tag_data = self._tag_index.get(tag_url)
+            if tag_data is None:
+                return None
+            tagged_dishes = tag_data.get("neighbors", {}).get("tagged_dishes", [])
+            self._tag_dishes[tag_url] = {k: v for dish_entry in tagged_dishes for k, v in dish_entry.items()}
+        return self._tag_dishes[tag_url]
@@ -1,39 +1,124 @@
 import logging
-from typing import Dict, List, Tuple, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple, Any, Optional
 
 import schemas
 
 from service.BAMnet.src.core.kbqa import KBQA
+from service.BAMnet.src.core.utils.memory import kbqa_components, memory_report
+from service.BAMnet.src.core.utils.tracing import tracer
 from repository import models
+from service.ingredient_lexicon import IngredientLexicon
 from service.query_processor import QueryProcessor
 from service.recipe_data_extractor import RecipeDataExtractor  # Import the new class
 
 logger = logging.getLogger(__name__)
 tag_url_prefix = 'http://idea.rpi.edu/heals/kb/tag/'
 
+def paginate(items: List[Any], limit: Optional[int] = None, offset: int = 0) -> List[Any]:
+    offset = max(offset, 0)
+    return items[offset:] if limit is None else items[offset:offset + max(limit, 0)]
+
+def ranking_depth(top_k: Optional[int] = None, limit: Optional[int] = None, offset: int = 0) -> Optional[int]:
+    """Number of recipes the model has to rank: at most top_k, and no more than the requested page needs."""
+    if limit is None:
+        return top_k
+    page_end = max(offset, 0) + max(limit, 0)
+    return page_end if top_k is None else min(top_k, page_end)
+
 class RecipeService:
     def __init__(self, config: Dict):
+        """
+        Loads the heavy components concurrently: the KBQA model, the KG used by
+        the extractor and the spaCy model are independent. The ingredient lexicon
+        and the query processor are built once their inputs are ready.
+        """
         logger.info("Initializing RecipeService...")
-        self.model = KBQA.from_pretrained(config)
-        self.query_processor = QueryProcessor()
-        
-        # Initialize the new RecipeDataExtractor
-        self.recipe_extractor = RecipeDataExtractor(kg_path=config.get("kb_path"))
-
-        logger.info("RecipeService initialized successfully.")
+        start = time.perf_counter()
+        self.num_similar_recipes = config.get('num_similar_recipes', 10)
+        self.exclude_disliked_ingredients = config.get('exclude_disliked_ingredients', True)
+        self.startup_timings: Dict[str, float] = {}
+
+        with ThreadPoolExecutor(max_workers=config.get('startup_workers', 3), thread_name_prefix='startup') as pool:
+            model_future = pool.submit(self._timed, 'kbqa_model', KBQA.from_pretrained, config)
+            # Initialize the new RecipeDataExtractor
+            extractor_future = pool.submit(self._timed, 'recipe_extractor', RecipeDataExtractor, kg_path=config.get("kb_path"))
+            nlp_future = pool.submit(self._timed, 'spacy_model', QueryProcessor.load_nlp)
+
+            self.recipe_extractor = extractor_future.result()
+            lexicon = None
+            if config.get('ingredient_linking', True) or config.get('fast_path_parsing', True):
+                lexicon = self._timed('ingredient_lexicon', IngredientLexicon.from_kg_entries, self.recipe_extractor.data)
+            self.query_processor = self._timed(
+                'query_processor',
+                QueryProcessor,
+                batch_size=config.get('query_batch_size', 64),
+                cache_size=config.get('query_cache_size', 10000),
+                cache_file=config.get('query_cache_file'),
+                query_log_file=config.get('query_log_file'),
+                lexicon=lexicon,
+                fast_path=config.get('fast_path_parsing', True),
+                nlp=nlp_future.result(),
+            )
+            self.model = model_future.result()
+            # Loading them (and building the ANN index) takes seconds, better not in the first request using them
+            if self.model.use_similar_dishs:
+                self._timed('similar_dishs', self.model.load_similar_dishs)
+
+        self.startup_timings['total'] = time.perf_counter() - start
+        breakdown = ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in self.startup_timings.items())
+        logger.info(f"RecipeService initialized successfully ({breakdown}).")
+
+    def _timed(self, name: str, fn: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.startup_timings[name] = time.perf_counter() - start
+        logger.info(f"Startup: {name} loaded in {self.startup_timings[name]:.2f}s")
+        return result
 
     def find_recipes(
         self,
         request: schemas.QuestionRequest,
-        user: models.User
+        user: models.User,
+        processed_query: Optional[Dict[str, List[str]]] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        top_k: Optional[int] = None,
     ) -> List[Dict[str, Any]]:
+        """
+        Ranked recipes for the request, out of the top_k best ones; only the page
+        [offset, offset + limit) is ranked and formatted.
+        """
+        primary_tag_url, answer_id_list = self.rank_recipes(
+            request, user, processed_query, top_k=ranking_depth(top_k, limit, offset)
+        )
+        with tracer.span('format_recipes') as span:
+            recipe_data = list(self.format_recipes(primary_tag_url, paginate(answer_id_list, limit, offset)))
+            span.set_size('recipes', len(recipe_data))
+        logger.info(f"Successfully formatted data for {len(recipe_data)} recipes.")
+        return recipe_data
+
+    def rank_recipes(
+        self,
+        request: schemas.QuestionRequest,
+        user: models.User,
+        processed_query: Optional[Dict[str, List[str]]] = None,
+        top_k: Optional[int] = None,
+    ) -> Tuple[Optional[str], List[str]]:
+        """
+        Runs the model, returns the tag the dishes are looked up under and the (top_k
+        best, or all) ranked dish URLs.
+        """
         logger.info(f"Finding recipes for user: {user.email} with question: '{request.question}'")
 
         # Use QueryProcessor to get final merged topics and preferences
-        processed_query = self.query_processor.process_query(
-            question_text=request.question,
-            user_prohibited=user.prohibited_ingredients or [],
-        )
+        if processed_query is None:
+            with tracer.span('query_parse'):
+                processed_query = self.query_processor.process_query(
+                    question_text=request.question,
+                    user_prohibited=user.prohibited_ingredients or [],
+                )
         logger.debug(f"Processed Query Entities: {processed_query}")
         topics = request.tags
         if len(topics) == 0:
@@ -58,15 +143,27 @@ class RecipeService:
             'ingredient_likes': final_likes,
             'ingredient_dislikes': final_dislikes,
         }
+        # Dishes containing the KG ingredients linked to the dislikes are dropped from the candidates
+        if self.exclude_disliked_ingredients and processed_query.get('final_dislike_ids'):
+            model_persona['excluded_ingredient_ids'] = processed_query['final_dislike_ids']
+
+        # The question phrases linked to the same ingredients let annotate_query mark differently worded ones
+        constrained_likes = sorted(set(final_likes) | set(processed_query.get('like_mentions', [])))
+        constrained_dislikes = sorted(set(final_dislikes) | set(processed_query.get('dislike_mentions', [])))
         constrained_entities = {}
-        if final_likes:
-            constrained_entities['1'] = final_likes
-        if final_dislikes:
-            constrained_entities['2'] = final_dislikes
+        if constrained_likes:
+            constrained_entities['1'] = constrained_likes
+        if constrained_dislikes:
+            constrained_entities['2'] = constrained_dislikes
         
         if constrained_entities:
             model_persona['constrained_entities'] = constrained_entities
 
+        similar_to = getattr(request, 'similar_to', [])
+        if similar_to and not self.model.augment_similar_dishs:
+            raise ValueError("similar_to is not supported: the model is served without augment_similar_dishs.")
+        similar_recipes = self.model.get_similar_recipes(similar_to, k=self.num_similar_recipes)
+
         logger.info(f"Final topics sent to model: {tags}")
         logger.info(f"Constructed final persona for model: {model_persona}")
         
@@ -79,7 +176,8 @@ class RecipeService:
             persona=model_persona,
             guideline={},
             explicit_nutrition=[],
-            similar_recipes={},
+            similar_recipes=similar_recipes,
+            top_k=top_k,
         )
 
         # Step 4: Handle the response from the model
@@ -89,18 +187,57 @@ class RecipeService:
 
         logger.info(f"Model returned {len(answer_id_list)} recipe URLs.")
 
-        # Step 5: Use the RecipeDataExtractor to get and format the recipe data
         if not answer_id_list or not tags:
             logger.info("No recipe IDs returned or no tags provided, returning empty list.")
-            return []
+            return None, []
 
         # We use the first tag as the entry point to find the dishes.
-        primary_tag_url = tags[0]
-        recipe_data = self.recipe_extractor.get_dishes_by_urls(
-            tag_url=primary_tag_url,
-            dish_urls=answer_id_list
+        return tags[0], answer_id_list
+
+    def format_recipes(self, primary_tag_url: Optional[str], dish_urls: List[str]) -> Iterator[Dict[str, Any]]:
+        """Step 5: Use the RecipeDataExtractor to format the recipe data, one dish at a time in rank order."""
+        if primary_tag_url is None:
+            return iter(())
+        return self.recipe_extractor.iter_dishes_by_urls(tag_url=primary_tag_url, dish_urls=dish_urls)
+
+    def find_recipes_batch(
+        self,
+        requests: List[schemas.QuestionRequest],
+        users: List[models.User],
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Like find_recipes (with the limit, offset and top_k of each request) for
+        several requests, parsing all the questions in one spaCy batch.
+        """
+        processed_queries = self.query_processor.process_queries(
+            [request.question for request in requests],
+            [user.prohibited_ingredients or [] for user in users],
         )
+        return [
+            self.find_recipes(
+                request,
+                user,
+                processed_query=processed_query,
+                limit=getattr(request, 'limit', None),
+                offset=getattr(request, 'offset', 0),
+                top_k=getattr(request, 'top_k', None),
+            )
+            for request, user, processed_query in zip(requests, users, processed_queries)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'query_cache': self.query_processor.cache_stats(),
+            'query_parsing_paths': self.query_processor.path_stats(),
+        }
 
-        logger.info(f"Successfully formatted data for {len(recipe_data)} recipes.")
-        return recipe_data
+    def memory_report(self) -> Dict[str, Any]:
+        """Approximate deep memory of the loaded state per component; walks all of it, so it takes a while."""
+        return memory_report(kbqa_components(self.model) + [
+            ('recipe_extractor.data', self.recipe_extractor.data),
+            ('query_processor.lexicon', self.query_processor.lexicon),
+            ('query_processor.cache', self.query_processor.cache),
+        ])
 
+    def shutdown(self) -> None:
+        self.query_processor.save_cache()
@@ -0,0 +1,38 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Dict
+
+
+class LatencyStats:
+    """Counts and latency percentiles over a sliding window of the most recent calls."""
+
+    def __init__(self, window: int = 2048):
+        self.count = 0
+        self.errors = 0
+        self._samples = deque(maxlen=window)  # (finish time, seconds)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            self.count += 1
+            self.errors += int(error)
+            self._samples.append((time.monotonic(), seconds))
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples)
+        latencies = sorted(seconds for _, seconds in samples)
+
+        def percentile(q):
+            return latencies[int(q * (len(latencies) - 1))] * 1000 if latencies else 0.0
+
+        # Throughput over the window: calls per second between the first and last finish
+        elapsed = samples[-1][0] - samples[0][0] if len(samples) > 1 else 0.0
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "throughput_per_s": (len(samples) - 1) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+        }
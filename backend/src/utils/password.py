@@ -1,14 +1,23 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 
+from config import config
+
 # --- Configuration (remains the same) ---
 SECRET_KEY = "a-very-secret-key-for-a-recipe-app"
 ALGORITHM = "HS256"
 
-# --- Password Hashing (remains the same) ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# --- Password Hashing ---
+# Changing the cost factor upgrades the stored hashes on the users' next login
+BCRYPT_ROUNDS = config.get('bcrypt_rounds', 12)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -16,14 +25,65 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def needs_rehash(hashed_password: str) -> bool:
+    """Whether a bcrypt hash ($2b$<rounds>$...) was made with another cost factor."""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def verify_and_rehash(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """(valid, new hash if the stored one should be upgraded else None)."""
+    if not pwd_context.verify(plain_password, hashed_password):
+        return False, None
+    return True, get_password_hash(plain_password) if needs_rehash(hashed_password) else None
+
+# bcrypt runs in a few dedicated processes so a burst of logins neither holds
+# request threads nor takes more than these cores away from model inference.
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_pool_lock = threading.Lock()
+_pending_hashes: Optional[asyncio.Semaphore] = None
+
+def _get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool, _pending_hashes
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            workers = config.get('password_hash_workers') or max(1, min(2, (os.cpu_count() or 1) // 4))
+            # The pool starts on the first login, when this process already has threads and
+            # holds the model: forking it could deadlock on a lock held by another thread
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _hash_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+            # Bounds the queue: callers beyond this wait instead of piling up work
+            _pending_hashes = asyncio.Semaphore(workers * config.get('password_hash_queue_per_worker', 4))
+        return _hash_pool
+
+async def _run_in_hash_pool(fn, *args):
+    pool = _get_hash_pool()
+    async with _pending_hashes:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_in_hash_pool(get_password_hash, password)
+
+async def verify_and_rehash_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return await _run_in_hash_pool(verify_and_rehash, plain_password, hashed_password)
+
+def shutdown_hash_pool() -> None:
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not None:
+            _hash_pool.shutdown(wait=False)
+            _hash_pool = None
+
 # --- JWT Creation (remains the same) ---
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    now = datetime.utcnow()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+        expire = now + timedelta(minutes=15)
+    to_encode.update({"exp": expire, "iat": now})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 